@@ -0,0 +1,305 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILY_TREES, phase_arrays, axis_view, evaluate_grid,
+                                    evaluate_family)
+
+
+#### This code compiles a diagnostic algorithm written as a short expression,
+#### for example  A and ((B and C) or D or (F and G)),  into a single
+#### vectorised kernel. The kernel returns the sensitivity, specificity,
+#### expected costs and expected times of the algorithm for every combination
+#### of tests, so new pathway designs can be tried without hand writing the
+#### CAS/COS chain and the matching *_cost polynomial.
+
+## 'and' combines two tests in serial with CAS: the second test is only run
+## if the first one is positive. 'or' combines them with COS: the second test
+## is only run if the first one is negative. 'and' binds tighter than 'or' and
+## both group from the left, so  B or D or E  is  (B or D) or E.
+##
+## The expected cost of a node follows from the tree:
+##     cost(X and Y) = cost(X) + P(X positive) * cost(Y)
+##     cost(X or Y)  = cost(X) + P(X negative) * cost(Y)
+## where P(X positive) is 1 - spec(X) for patients without HAT (cost-0) and
+## sens(X) for patients with HAT (cost-1). The expected time to diagnosis
+## (time-0 and time-1) follows the same rule with the Wait_Time of each test.
+
+###############################################################################
+############## Code Section One - Parsing #####################################
+###############################################################################
+
+TOKEN   = re.compile(r'(\()|(\))|([A-Za-z_][A-Za-z0-9_]*)')
+SPACE   = re.compile(r'\s*')
+
+## Marks the end of the token list (never a valid test name)
+END     = 'end of expression'
+
+## The eight hand coded families of SensSpecCostCalculator as expressions
+TOPOLOGIES = {
+    'NOXP'  : 'A and ((B and C) or D)',
+    'XP1'   : '(B and C) or (A and D)',
+    'XP2'   : 'A and ((B and C) or D or E)',
+    'XP3'   : 'A and ((B and C) or D or (F and G))',
+    'XP23'  : 'A and ((B and C) or D or E or (F and G))',
+    'XP12'  : '(B and C) or (A and (D or E))',
+    'XP13'  : '(B and C) or (A and (D or (F and G)))',
+    'XP123' : '(B and C) or (A and (D or E or (F and G)))',
+}
+
+def tokenize(text):
+    '''Splits an expression into brackets, operators and test names
+
+    Inputs
+    text            : String        : e.g. 'A and (B or C)'
+
+    Output
+    tokens          : List          : [(token, position in text)]
+    '''
+
+    tokens      = []
+    position    = SPACE.match(text).end()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValueError('unexpected character %r at position %d in %r'
+                             % (text[position], position, text))
+        tokens.append((match.group(match.lastindex), position))
+        position = SPACE.match(text, match.end()).end()
+    return(tokens)
+
+def parse(text):
+    '''Parses an expression into a tree of nested tuples
+
+    Inputs
+    text            : String        : e.g. 'A and ((B and C) or D)'
+
+    Output
+    tree            : Tuple         : ('and', left, right), ('or', left, right)
+                                      or ('test', name)
+    '''
+
+    tokens  = tokenize(text) + [(END, len(text))]
+    where   = [0]
+
+    def peek():
+        return(tokens[where[0]][0])
+
+    def take(expected):
+        token, position = tokens[where[0]]
+        if token != expected:
+            raise ValueError('expected %r at position %d in %r, found %r'
+                             % (expected, position, text, token))
+        where[0] += 1
+        return(token)
+
+    def chain(operator, operand):
+        tree = operand()
+        while peek() == operator:
+            take(operator)
+            tree = (operator, tree, operand())
+        return(tree)
+
+    def disjunction():
+        return(chain('or', conjunction))
+
+    def conjunction():
+        return(chain('and', operand))
+
+    def operand():
+        token, position = tokens[where[0]]
+        if token == '(':
+            take('(')
+            tree = disjunction()
+            take(')')
+            return(tree)
+        if token in (END, '(', ')', 'and', 'or'):
+            raise ValueError('expected a test at position %d in %r, found %r'
+                             % (position, text, token))
+        take(token)
+        return(('test', token))
+
+    tree = disjunction()
+    take(END)
+    return(tree)
+
+def leaves(tree):
+    '''Returns the set of test names used in a tree'''
+
+    if tree[0] == 'test':
+        return({tree[1]})
+    return(leaves(tree[1]) | leaves(tree[2]))
+
+###############################################################################
+############## Code Section Two - Code Generation #############################
+###############################################################################
+
+def generate(tree, tests):
+    '''Writes the source of the kernel for a tree. Every node becomes six
+    straight line numpy expressions, so the kernel has no branches or loops.
+
+    Inputs
+    tree            : Tuple         : output of parse
+    tests           : List          : test names in argument order
+
+    Output
+    source          : String        : source of a function named kernel
+    '''
+
+    lines   = []
+    count   = [0]
+
+    def emit(node):
+        if node[0] == 'test':
+            i = tests.index(node[1])
+            return('s%d' % i, 'p%d' % i, 'c%d' % i, 'c%d' % i, 'w%d' % i, 'w%d' % i)
+        left    = emit(node[1])
+        right   = emit(node[2])
+        count[0] += 1
+        s, p, c0, c1, w0, w1 = ['%s_%d' % (x, count[0])
+                                for x in ('s', 'p', 'c0', 'c1', 'w0', 'w1')]
+        (ls, lp, lc0, lc1, lw0, lw1), (rs, rp, rc0, rc1, rw0, rw1) = left, right
+        if node[0] == 'and':
+            lines.append('%s = %s * %s' % (s, ls, rs))
+            lines.append('%s = %s + (1 - %s) * %s' % (p, lp, lp, rp))
+            lines.append('%s = %s + (1 - %s) * %s' % (c0, lc0, lp, rc0))
+            lines.append('%s = %s + %s * %s' % (c1, lc1, ls, rc1))
+            lines.append('%s = %s + (1 - %s) * %s' % (w0, lw0, lp, rw0))
+            lines.append('%s = %s + %s * %s' % (w1, lw1, ls, rw1))
+        else:
+            lines.append('%s = %s + (1 - %s) * %s' % (s, ls, ls, rs))
+            lines.append('%s = %s * %s' % (p, lp, rp))
+            lines.append('%s = %s + %s * %s' % (c0, lc0, lp, rc0))
+            lines.append('%s = %s + (1 - %s) * %s' % (c1, lc1, ls, rc1))
+            lines.append('%s = %s + %s * %s' % (w0, lw0, lp, rw0))
+            lines.append('%s = %s + (1 - %s) * %s' % (w1, lw1, ls, rw1))
+        return(s, p, c0, c1, w0, w1)
+
+    result  = emit(tree)
+    args    = ', '.join('s%d, p%d, c%d, w%d' % (i, i, i, i) for i in range(len(tests)))
+    body    = lines + ['return(%s, %s, %s, %s, %s, %s)' % result]
+    return('def kernel(%s):\n    %s\n' % (args, '\n    '.join(body)))
+
+class Topology(object):
+    '''A compiled diagnostic algorithm
+
+    Attributes
+    expression      : String        : the expression it was compiled from
+    code            : String        : suffix used in the Algorithm column
+    tree            : Tuple         : parse tree
+    tests           : List          : test names (phase letters) in the order
+                                      the kernel takes them, alphabetical
+    source          : String        : source of the generated kernel
+    kernel          : Function      : kernel(s0, p0, c0, w0, s1, ...) ->
+                                      (sens, spec, cost-0, cost-1, time-0,
+                                      time-1)
+    '''
+
+    def __init__(self, expression, code = None):
+        self.expression = expression
+        self.code       = code if code is not None else expression
+        self.tree       = parse(expression)
+        self.tests      = sorted(leaves(self.tree))
+        self.source     = generate(self.tree, self.tests)
+        namespace       = {}
+        exec(compile(self.source, '<algorithm %s>' % self.code, 'exec'), namespace)
+        self.kernel     = namespace['kernel']
+
+    def __repr__(self):
+        return('Topology(%r, code=%r)' % (self.expression, self.code))
+
+    def __call__(self, *tests):
+        '''Runs the kernel on (sens, spec, cost, wait) tuples given in the
+        order of self.tests. The arrays are broadcast against each other.'''
+
+        return(self.kernel(*[x for test in tests for x in test]))
+
+    def grid(self, phases):
+        '''Evaluates the algorithm for every combination of tests
+
+        Inputs
+        phases          : Dictionary    : test name -> phase, as for
+                                          SensSpecCostCalculator.evaluate_family
+
+        Output
+        shape           : Tuple         : size of the grid, one axis per test
+        values          : List          : sens, spec, cost-0, cost-1, time-0
+                                          and time-1 arrays broadcastable to
+                                          shape
+        arrays          : List          : output of phase_arrays for each test
+        '''
+
+        arrays  = [phase_arrays(phases[test], test) for test in self.tests]
+        shape   = tuple(len(sens) for sens, _, _, _, _ in arrays)
+        ndim    = len(shape)
+        tests   = [[axis_view(x, axis, ndim) for x in test[:4]]
+                   for axis, test in enumerate(arrays)]
+        return(shape, list(self(*tests)), arrays)
+
+    def evaluate(self, phases, rules = None):
+        '''Evaluates the algorithm for every combination of tests that breaks
+        none of the rules (SensSpecCostCalculator.RULES by default) and
+        returns the same Dataframe layout as evaluate_family'''
+
+        arrays = [phase_arrays(phases[test], test) for test in self.tests]
+        return(evaluate_grid(lambda tests: self(*tests), self.tests, arrays,
+                             self.code, rules))
+
+def compile_algorithm(expression, code = None):
+    '''Compiles an expression such as 'A and ((B and C) or D)' into a Topology'''
+
+    return(Topology(expression, code))
+
+def compile_families():
+    '''Compiles the eight families in TOPOLOGIES, keyed by their code'''
+
+    return({code : Topology(expression, code)
+            for code, expression in TOPOLOGIES.items()})
+
+###############################################################################
+############## Code Section Three - Checks ####################################
+###############################################################################
+
+def plain_tree(tree):
+    '''Writes a parse tree in the form of SensSpecCostCalculator.FAMILY_TREES'''
+
+    if tree[0] == 'test':
+        return(tree[1])
+    return((tree[0], plain_tree(tree[1]), plain_tree(tree[2])))
+
+def check_times(phases, families = None, rules = None, tolerance = 1e-9):
+    '''Checks the time-0 and time-1 columns of the families of
+    SensSpecCostCalculator against their compiled topologies
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family in
+                                      TOPOLOGIES by default
+    tolerance       : Float         : largest difference allowed
+
+    Output
+    report          : Pandas Dataframe : one row per family with the number of
+                                         algorithms, of negative times, the
+                                         largest difference from the topology
+                                         and ok (same tree in FAMILY_TREES and
+                                         TOPOLOGIES, no negative time and no
+                                         difference above tolerance)
+    '''
+
+    families    = list(TOPOLOGIES) if families is None else families
+    rows        = []
+    for family in families:
+        topology    = Topology(TOPOLOGIES[family], family)
+        frame       = evaluate_family(family, phases, rules)
+        compiled    = topology.evaluate(phases, rules)
+        times       = frame[['time-0', 'time-1']].to_numpy()
+        negative    = int((times < 0).any(axis = 1).sum())
+        difference  = float(np.abs(times - compiled[['time-0', 'time-1']].to_numpy())
+                            .max(initial = 0))
+        same_tree   = plain_tree(topology.tree) == FAMILY_TREES[family]
+        rows.append((family, len(frame), negative, difference,
+                     same_tree and not negative and difference <= tolerance))
+    return(pd.DataFrame(rows, columns = ['family', 'algorithms', 'negative', 'difference',
+                                         'ok']))
@@ -0,0 +1,256 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, PHASE_TYPES, Phase, TestCatalog,
+                                    phase_arrays, apply_family, position_names,
+                                    axis_view, compile_rules, conflict_mask)
+from ParetoFront import OBJECTIVES, orient, skyline
+
+
+#### This code evaluates many test catalogs at once, e.g. one variant of
+#### algorithmcsv.csv per country programme with its own costs and locally
+#### validated sensitivities. The catalogs must list the same tests; their
+#### arrays are stacked on a leading catalog axis and every family is
+#### evaluated for every catalog in one broadcast pass. Per catalog Pareto
+#### fronts and a table comparing the algorithms across catalogs are then
+#### built from the stacked results.
+
+## The grid engine keeps any leading axes of the test arrays in front of the
+## grid (see axis_view), so a Phase whose arrays have shape (catalogs, tests)
+## runs through apply_family unchanged. A and G are scenario parameters and
+## are shared by every catalog.
+##
+## The tests of each phase are put in the order of the first catalog, so every
+## catalog has the same algorithms in the same rows and the names (and the
+## rules) are worked out once. Algorithms are matched across catalogs by that
+## row (the row column), not by name: the name does not hold the A scenario,
+## so with several A scenarios it is not unique.
+
+## Rough number of float64 arrays alive per evaluated value (see
+## UncertaintyAnalysis.WORKING_ARRAYS), used to turn the memory cap into the
+## number of catalogs evaluated at once
+WORKING_ARRAYS = 16
+
+###############################################################################
+############## Code Section One - Stacking ####################################
+###############################################################################
+
+def load_catalogs(sources, percent = True):
+    '''Reads several catalogs
+
+    Inputs
+    sources         : List or Dictionary : paths of catalog files (named after
+                                      the file) or name -> path, Dataframe or
+                                      TestCatalog
+    percent         : Boolean       : as for TestCatalog
+
+    Output
+    catalogs        : Dictionary    : name -> TestCatalog, in the given order
+    '''
+
+    if not isinstance(sources, dict):
+        sources = {os.path.splitext(os.path.basename(path))[0] : path for path in sources}
+    catalogs = {}
+    for name, source in sources.items():
+        if isinstance(source, TestCatalog):
+            catalogs[name] = source
+        elif isinstance(source, pd.DataFrame):
+            catalogs[name] = TestCatalog(source, percent)
+        else:
+            catalogs[name] = TestCatalog.from_csv(source, percent)
+    return(catalogs)
+
+def stack_catalogs(catalogs, A, G):
+    '''Stacks catalogs that list the same tests into one set of phases
+
+    Inputs
+    catalogs        : Dictionary    : name -> TestCatalog, see load_catalogs
+    A, G            : List          : the A and G phases, shared by every
+                                      catalog
+
+    Output
+    phases          : Dictionary    : phase letter -> phase, for evaluate_batch.
+                                      The arrays of B-F have shape (catalogs,
+                                      tests).
+    '''
+
+    if not catalogs:
+        raise ValueError('no catalogs to stack')
+    names   = list(catalogs)
+    first   = catalogs[names[0]]
+    phases  = {'A' : A, 'G' : G}
+    for label, type_ in PHASE_TYPES.items():
+        reference   = first.phase(type_)
+        order       = list(reference.names)
+        arrays      = {field : [] for field in Phase.FIELDS}
+        for name in names:
+            phase   = catalogs[name].phases.get(type_)
+            tests   = [] if phase is None else list(phase.names)
+            if sorted(tests) != sorted(order):
+                raise ValueError('catalog %r has the tests %s in phase %s, %r has %s'
+                                 % (name, tests, label, names[0], order))
+            ## Put the tests in the order of the first catalog
+            position = [tests.index(test) for test in order]
+            for field in Phase.FIELDS:
+                arrays[field].append(getattr(phase, field)[position])
+        phases[label] = Phase(reference.ids, reference.table,
+                              **{field : np.stack(values) for field, values in arrays.items()})
+    return(phases)
+
+def catalog_phases(phases, catalog):
+    '''The phases of one catalog (a position on the catalog axis), as for
+    evaluate_family'''
+
+    output = {}
+    for label, phase in phases.items():
+        if isinstance(phase, Phase):
+            phase = Phase(phase.ids, phase.table,
+                          **{field : getattr(phase, field)[catalog] for field in Phase.FIELDS})
+        output[label] = phase
+    return(output)
+
+###############################################################################
+############## Code Section Two - Evaluation ##################################
+###############################################################################
+
+def evaluate_batch(phases, catalogs, families = None, rules = None, memory = 2 ** 28):
+    '''Evaluates every family for every catalog
+
+    Inputs
+    phases          : Dictionary    : output of stack_catalogs
+    catalogs        : List          : names of the catalogs, in stacking order
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+    memory          : Integer       : rough cap on the working memory in bytes
+
+    Output
+    output          : Pandas Dataframe : the COLUMNS of evaluate_family, a
+                                         categorical catalog column and row,
+                                         the position of the algorithm in its
+                                         catalog. The rows of each catalog
+                                         are in the order of
+                                         evaluate_families.
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    count       = len(catalogs)
+    frames      = []
+    offset      = 0
+    for family in families:
+        labels  = FAMILIES[family][2]
+        arrays  = [phase_arrays(phases[label], label) for label in labels]
+        shape   = tuple(np.shape(sens)[-1] for sens, _, _, _, _ in arrays)
+        ## The names and rules are the same for every catalog
+        keep    = np.flatnonzero(~conflict_mask(compile_rules([x[4] for x in arrays],
+                                                              rules), shape))
+        names   = position_names([x[4] for x in arrays], np.unravel_index(keep, shape),
+                                 family)
+        values  = np.empty((len(COLUMNS) - 1, count, len(keep)))
+        block   = max(1, int(memory // (8 * WORKING_ARRAYS * max(1, np.prod(shape)))))
+        for start in range(0, count, block):
+            rows    = slice(start, min(start + block, count))
+            tests   = [tuple(axis_view(x if np.ndim(x) == 1 else x[rows], axis, len(labels))
+                             for x in test[:4])
+                       for axis, test in enumerate(arrays)]
+            size    = (rows.stop - rows.start,) + shape
+            for j, value in enumerate(apply_family(family, tests)):
+                values[j, rows] = np.broadcast_to(value, size).reshape(size[0], -1)[:, keep]
+        output  = {column : values[j].ravel() for j, column in enumerate(COLUMNS[:-1])}
+        output['Algorithm'] = np.tile(names, count)
+        output['catalog']   = np.repeat(np.arange(count), len(keep))
+        output['row']       = np.tile(np.arange(offset, offset + len(keep)), count)
+        offset              += len(keep)
+        frames.append(pd.DataFrame(output))
+    output  = pd.concat(frames, ignore_index = True)
+    ## Catalog by catalog, each in family order
+    output  = output.iloc[np.argsort(output['catalog'].to_numpy(), kind = 'stable')]
+    output['catalog'] = pd.Categorical.from_codes(output['catalog'].to_numpy(),
+                                                  categories = list(catalogs))
+    return(output.reset_index(drop = True))
+
+def run_catalogs(catalogs, A, G, families = None, rules = None, objectives = None,
+                 memory = 2 ** 28):
+    '''Evaluates every family for several catalogs in one run
+
+    Inputs
+    catalogs        : List or Dictionary : see load_catalogs
+    A, G            : List          : the A and G phases
+    objectives      : Dictionary    : column -> 'max' or 'min', OBJECTIVES by
+                                      default
+
+    Output
+    results         : Pandas Dataframe : output of evaluate_batch
+    fronts          : Dictionary    : catalog -> its Pareto front
+    comparison      : Pandas Dataframe : output of compare_catalogs
+    '''
+
+    catalogs    = load_catalogs(catalogs)
+    phases      = stack_catalogs(catalogs, A, G)
+    results     = evaluate_batch(phases, list(catalogs), families, rules, memory)
+    fronts      = catalog_fronts(results, objectives)
+    return(results, fronts, compare_catalogs(results, fronts))
+
+###############################################################################
+############## Code Section Three - Comparison ################################
+###############################################################################
+
+def catalog_fronts(results, objectives = None):
+    '''The Pareto front of each catalog
+
+    Inputs
+    results         : Pandas Dataframe : output of evaluate_batch
+
+    Output
+    fronts          : Dictionary    : catalog -> Dataframe of its non-dominated
+                                      algorithms
+    '''
+
+    objectives  = dict(OBJECTIVES if objectives is None else objectives)
+    fronts      = {}
+    for catalog, frame in results.groupby('catalog', sort = False, observed = True):
+        keep            = skyline(orient(frame, objectives))
+        fronts[catalog] = frame.iloc[keep].reset_index(drop = True)
+    return(fronts)
+
+def compare_catalogs(results, fronts):
+    '''Compares every algorithm across the catalogs
+
+    Inputs
+    results         : Pandas Dataframe : output of evaluate_batch
+    fronts          : Dictionary    : output of catalog_fronts
+
+    Output
+    comparison      : Pandas Dataframe : one row per algorithm with its row
+                                         (see evaluate_batch), Algorithm,
+                                         fronts (the number of catalogs on
+                                         whose front it is), the min, mean and
+                                         max of each metric over the
+                                         catalogs, and one boolean column per
+                                         catalog telling whether it is on that
+                                         front. Sorted by fronts, most first.
+    '''
+
+    metrics     = COLUMNS[:-1]
+    grouped     = results.groupby('row')
+    values      = grouped[metrics]
+    comparison  = pd.concat([values.min().add_suffix('_min'),
+                             values.mean().add_suffix('_mean'),
+                             values.max().add_suffix('_max')], axis = 1)
+    comparison  = comparison[['%s_%s' % (metric, stat) for metric in metrics
+                              for stat in ('min', 'mean', 'max')]]
+    members     = pd.DataFrame({catalog : comparison.index.isin(front['row'])
+                                for catalog, front in fronts.items()},
+                               index = comparison.index)
+    comparison.insert(0, 'fronts', members.sum(axis = 1))
+    comparison.insert(0, 'Algorithm', grouped['Algorithm'].first())
+    comparison  = pd.concat([comparison, members], axis = 1)
+    comparison  = comparison.sort_values('fronts', ascending = False, kind = 'stable')
+    return(comparison.reset_index())
+
+def pivot_metric(results, metric):
+    '''One metric of every algorithm (rows, indexed by row and Algorithm) in
+    every catalog (columns)'''
+
+    return(results.pivot(index = ['row', 'Algorithm'], columns = 'catalog', values = metric))
@@ -0,0 +1,452 @@
+import heapq
+import fnmatch
+
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import phase_arrays
+from AlgorithmCompiler import TOPOLOGIES, parse, Topology
+from CompactResults import CompactResults
+
+
+#### This code simulates a clinic that runs a diagnostic algorithm on a stream
+#### of patients with a limited number of technicians and machines. The
+#### expected costs and times of SensSpecCostCalculator assume every test
+#### starts as soon as it is asked for; here tests queue for the staff or
+#### equipment they need, so the simulation tells how many patients a day the
+#### clinic can diagnose, how long they wait and how busy each resource is.
+
+## Patients arrive as a Poisson process over the opening hours and have HAT
+## with probability prevalence. Each one walks the tree of its algorithm
+## ('and': the second test is only run after a positive, 'or': only after a
+## negative), and each test holds one server of its pool for its Wait_Time
+## (minutes in algorithmcsv.csv). Requests are served first come first
+## served. A and G have no wait and need no resource. The clinic keeps going
+## after closing time until every patient who arrived has a result.
+##
+## Many (algorithm, day) pairs are simulated at once, one row each. Every
+## step serves the earliest request of every row, so the number of steps is
+## the number of requests in the busiest day, not that times the number of
+## rows. With identical servers, giving each request the server that frees
+## first, in request order, starts every test exactly when a first come first
+## served queue would. simulate_events is the plain event driven version of
+## one row, a heap of arrivals and completions, kept to check the batched
+## core against.
+
+## Pool -> number of servers, and test name pattern -> pool (first match)
+POOLS   = {'staff' : 2}
+USES    = {'*' : 'staff'}
+
+## Opening hours of a clinic day in minutes, and a month of clinic days
+HOURS   = 8 * 60
+DAYS    = 22
+
+## Next node values that end the walk with a result
+NEGATIVE = -1
+POSITIVE = -2
+
+## Rough number of bytes held per (row, patient) while a block is simulated,
+## used to turn the memory cap into block sizes (plus 4 per node for draws)
+ROW_BYTES = 64
+
+###############################################################################
+############## Code Section One - Clinics and programs ########################
+###############################################################################
+
+class Clinic(object):
+    '''The resources and the patient stream of a clinic
+
+    Inputs
+    pools           : Dictionary    : pool name -> number of servers (staff
+                                      or machines that run one test at a time)
+    uses            : Dictionary    : test name pattern (fnmatch) -> pool, the
+                                      first match is used. None means the
+                                      test needs no resource.
+    patients        : Float         : mean number of arrivals per day
+    prevalence      : Float         : share of the patients that have HAT
+    hours           : Float         : opening hours in minutes
+    '''
+
+    def __init__(self, pools = None, uses = None, patients = 60, prevalence = 0.05,
+                 hours = HOURS):
+        self.pools      = dict(POOLS if pools is None else pools)
+        self.uses       = dict(USES if uses is None else uses)
+        self.patients   = patients
+        self.prevalence = prevalence
+        self.hours      = hours
+        for pool in self.uses.values():
+            if pool is not None and pool not in self.pools:
+                raise ValueError('unknown pool %r' % pool)
+
+    def __repr__(self):
+        return('Clinic(%r, patients=%r)' % (self.pools, self.patients))
+
+    @property
+    def servers(self):
+        '''Number of servers of each pool, in the order of pools'''
+
+        return(np.array(list(self.pools.values()), dtype = np.intp))
+
+    def pool_of(self, names):
+        '''Returns the pool number of each test name (-1 for none, and for A
+        and G, whose names are None)'''
+
+        pools = list(self.pools)
+        if names is None:
+            return(None)
+        output = np.full(len(names), -1, dtype = np.intp)
+        for i, name in enumerate(names):
+            for pattern, pool in self.uses.items():
+                if fnmatch.fnmatchcase(str(name), pattern):
+                    output[i] = -1 if pool is None else pools.index(pool)
+                    break
+        return(output)
+
+def program(tree):
+    '''Turns the tree of an algorithm into nodes, one per test
+
+    Inputs
+    tree            : Tuple         : output of AlgorithmCompiler.parse
+
+    Output
+    entry           : Integer       : first node
+    labels          : List          : test (phase letter) of each node
+    positive        : List          : next node after a positive result, or
+                                      POSITIVE / NEGATIVE
+    negative        : List          : next node after a negative result
+    '''
+
+    labels      = []
+    positive    = []
+    negative    = []
+
+    def emit(node, on_positive, on_negative):
+        if node[0] == 'test':
+            labels.append(node[1])
+            positive.append(on_positive)
+            negative.append(on_negative)
+            return(len(labels) - 1)
+        if node[0] == 'and':
+            return(emit(node[1], emit(node[2], on_positive, on_negative), on_negative))
+        return(emit(node[1], on_positive, emit(node[2], on_positive, on_negative)))
+
+    entry = emit(tree, POSITIVE, NEGATIVE)
+    return(entry, labels, positive, negative)
+
+def candidate_tables(candidates, phases, clinic, topologies = None):
+    '''The node tables of every candidate algorithm
+
+    Inputs
+    candidates      : Pandas Dataframe : a family column and one test
+                                         position column per phase letter, as
+                                         in CompactResults.frame
+    topologies      : Dictionary    : family -> expression or Topology,
+                                      AlgorithmCompiler.TOPOLOGIES by default
+
+    Output
+    tables          : Dictionary    : entry (candidates,) and sens, spec,
+                                      wait, pool, positive, negative
+                                      (candidates, nodes)
+    '''
+
+    topologies  = dict(TOPOLOGIES, **(topologies or {}))
+    programs    = {}
+    for family in pd.unique(candidates['family'].astype(str)):
+        topology = topologies[family]
+        tree     = topology.tree if isinstance(topology, Topology) else parse(topology)
+        programs[family] = program(tree)
+    nodes       = max(len(labels) for _, labels, _, _ in programs.values())
+    size        = (len(candidates), nodes)
+    tables      = {'entry'      : np.zeros(len(candidates), dtype = np.intp),
+                   'sens'       : np.zeros(size),
+                   'spec'       : np.ones(size),
+                   'wait'       : np.zeros(size),
+                   'pool'       : np.full(size, -1, dtype = np.intp),
+                   'positive'   : np.full(size, POSITIVE, dtype = np.intp),
+                   'negative'   : np.full(size, NEGATIVE, dtype = np.intp)}
+    arrays      = {}
+    family      = candidates['family'].astype(str).to_numpy()
+    for code, (entry, labels, positive, negative) in programs.items():
+        rows = np.flatnonzero(family == code)
+        tables['entry'][rows] = entry
+        for node, label in enumerate(labels):
+            if label not in arrays:
+                sens, spec, _, wait, names = phase_arrays(phases[label], label)
+                pool = clinic.pool_of(names)
+                arrays[label] = (sens, spec, wait,
+                                 pool if pool is not None else np.full(len(sens), -1))
+            position = candidates[label].to_numpy()[rows]
+            for field, values in zip(('sens', 'spec', 'wait', 'pool'), arrays[label]):
+                tables[field][rows, node] = values[position]
+            tables['positive'][rows, node] = positive[node]
+            tables['negative'][rows, node] = negative[node]
+    return(tables)
+
+###############################################################################
+############## Code Section Two - Simulation ##################################
+###############################################################################
+
+def draw_days(clinic, rows, nodes, rng):
+    '''Draws the patients of rows clinic days
+
+    Output
+    arrivals        : Numpy array   : (rows, patients) arrival times in
+                                      increasing order, inf where a day had
+                                      fewer patients
+    diseased        : Numpy array   : (rows, patients) boolean
+    draws           : Numpy array   : (rows, patients, nodes) uniforms that
+                                      decide the result of each test
+    '''
+
+    counts      = rng.poisson(clinic.patients, rows)
+    patients    = max(int(counts.max()) if rows else 0, 1)
+    arrivals    = np.sort(rng.uniform(0, clinic.hours, (rows, patients)), axis = 1)
+    arrivals[np.arange(patients) >= counts[:, None]] = np.inf
+    diseased    = rng.random((rows, patients)) < clinic.prevalence
+    draws       = rng.random((rows, patients, nodes), dtype = np.float32)
+    return(arrivals, diseased, draws)
+
+def day_statistics(rows, pools):
+    '''Empty per row counters, see simulate_batch'''
+
+    stats = {name : np.zeros(rows) for name in
+             ('patients', 'diagnosed', 'turnaround', 'last', 'true_positive',
+              'diseased', 'true_negative', 'healthy')}
+    stats['queued'] = np.zeros((rows, pools))
+    stats['busy']   = np.zeros((rows, pools))
+    return(stats)
+
+def simulate_batch(tables, candidate, arrivals, diseased, draws, servers, hours):
+    '''Simulates one clinic day per row, every row at once
+
+    Inputs
+    tables          : Dictionary    : output of candidate_tables
+    candidate       : Numpy array   : candidate simulated on each row
+    arrivals, diseased, draws : Numpy array : output of draw_days
+    servers         : Numpy array   : number of servers of each pool
+    hours           : Float         : opening hours
+
+    Output
+    stats           : Dictionary    : per row patients, diagnosed (before
+                                      closing), turnaround (total minutes
+                                      from arrival to result), last (time of
+                                      the last result), true_positive,
+                                      diseased, true_negative, healthy and,
+                                      per pool, queued (total minutes spent
+                                      waiting) and busy (server minutes)
+    '''
+
+    rows, patients  = arrivals.shape
+    stats   = day_statistics(rows, len(servers))
+    ready   = arrivals.copy()
+    node    = np.broadcast_to(tables['entry'][candidate][:, None], (rows, patients)).copy()
+    ## Time at which each server is next free, inf for servers a pool lacks
+    free    = np.where(np.arange(max(servers.max(), 1)) < servers[:, None], 0.0, np.inf)
+    free    = np.broadcast_to(free, (rows,) + free.shape).copy()
+    ## Row of stats held by each working row
+    origin  = np.arange(rows)
+
+    stats['patients'] = np.isfinite(arrivals).sum(axis = 1).astype(float)
+    stats['diseased'] = (diseased & np.isfinite(arrivals)).sum(axis = 1).astype(float)
+    stats['healthy']  = stats['patients'] - stats['diseased']
+    while True:
+        ## The earliest request of every row that still has one
+        first   = ready.argmin(axis = 1)
+        time    = ready[np.arange(len(origin)), first]
+        live    = np.flatnonzero(time < np.inf)
+        if not len(live):
+            break
+        if 2 * len(live) < len(origin):
+            ## Most days are over, carry on with the others only
+            ready, node, free, origin, candidate = (ready[live], node[live], free[live],
+                                                    origin[live], candidate[live])
+            arrivals, diseased, draws = arrivals[live], diseased[live], draws[live]
+            first, time = first[live], time[live]
+            live    = np.arange(len(origin))
+        p       = first[live]
+        time    = time[live]
+        c       = candidate[live]
+        m       = node[live, p]
+        pool    = tables['pool'][c, m]
+        wait    = tables['wait'][c, m]
+
+        start   = time.copy()
+        held    = np.flatnonzero(pool >= 0)
+        r, k    = live[held], pool[held]
+        server  = free[r, k].argmin(axis = 1)
+        start[held] = np.maximum(time[held], free[r, k, server])
+        finish  = start + wait
+        free[r, k, server]      = finish[held]
+        stats['queued'][origin[r], k]   += start[held] - time[held]
+        stats['busy'][origin[r], k]     += wait[held]
+
+        sick    = diseased[live, p]
+        chance  = np.where(sick, tables['sens'][c, m], 1 - tables['spec'][c, m])
+        result  = draws[live, p, m] < chance
+        after   = np.where(result, tables['positive'][c, m], tables['negative'][c, m])
+        done    = after < 0
+        node[live, p]   = np.where(done, m, after)
+        ready[live, p]  = np.where(done, np.inf, finish)
+
+        ## Patients who got their result
+        r, p    = live[done], p[done]
+        row     = origin[r]
+        finish  = finish[done]
+        found   = after[done] == POSITIVE
+        stats['diagnosed'][row]     += finish <= hours
+        stats['turnaround'][row]    += finish - arrivals[r, p]
+        stats['last'][row]          = np.maximum(stats['last'][row], finish)
+        stats['true_positive'][row] += found & diseased[r, p]
+        stats['true_negative'][row] += ~found & ~diseased[r, p]
+    return(stats)
+
+def simulate_events(tables, candidate, arrivals, diseased, draws, servers, hours):
+    '''The same as simulate_batch for a single row, as a plain discrete event
+    simulation: a heap of arrival and completion events and a first come
+    first served queue per pool
+
+    Inputs
+    candidate       : Integer       : candidate simulated
+    arrivals, diseased, draws : Numpy array : one row of draw_days
+    '''
+
+    stats   = {name : value[0] for name, value in day_statistics(1, len(servers)).items()}
+    table   = {name : values[candidate] for name, values in tables.items()}
+    node    = {}
+    idle    = list(servers)
+    queues  = [[] for _ in servers]
+    ## Events are (time, kind, patient), completions (0) before requests (1)
+    events  = [(time, 1, p) for p, time in enumerate(arrivals) if time < np.inf]
+    heapq.heapify(events)
+    stats['patients'] = float(len(events))
+    stats['diseased'] = float(sum(diseased[p] for _, _, p in events))
+    stats['healthy']  = stats['patients'] - stats['diseased']
+
+    def start(p, requested, now):
+        m = node[p]
+        stats['queued'][table['pool'][m]]   += now - requested
+        stats['busy'][table['pool'][m]]     += table['wait'][m]
+        heapq.heappush(events, (now + table['wait'][m], 0, p))
+
+    while events:
+        now, kind, p = heapq.heappop(events)
+        m    = node.setdefault(p, int(table['entry']))
+        pool = table['pool'][m]
+        if kind == 1:
+            if pool < 0:
+                heapq.heappush(events, (now + table['wait'][m], 0, p))
+            elif idle[pool]:
+                idle[pool] -= 1
+                start(p, now, now)
+            else:
+                heapq.heappush(queues[pool], (now, p))
+            continue
+
+        ## A test is over: hand its server on and route the patient
+        if pool >= 0:
+            if queues[pool]:
+                requested, q = heapq.heappop(queues[pool])
+                start(q, requested, now)
+            else:
+                idle[pool] += 1
+        chance  = table['sens'][m] if diseased[p] else 1 - table['spec'][m]
+        result  = draws[p, m] < chance
+        after   = table['positive'][m] if result else table['negative'][m]
+        if after >= 0:
+            node[p] = int(after)
+            heapq.heappush(events, (now, 1, p))
+            continue
+        found = after == POSITIVE
+        stats['diagnosed']      += now <= hours
+        stats['turnaround']     += now - arrivals[p]
+        stats['last']           = max(stats['last'], now)
+        stats['true_positive']  += found and diseased[p]
+        stats['true_negative']  += (not found) and (not diseased[p])
+    return(stats)
+
+###############################################################################
+############## Code Section Three - Reports ###################################
+###############################################################################
+
+def summarise(stats, candidates, days, clinic):
+    '''Averages the days of each candidate
+
+    Output
+    output          : Dictionary    : column -> one value per candidate
+    '''
+
+    def per_candidate(values):
+        return(values.reshape((candidates, days) + values.shape[1:]).sum(axis = 1))
+
+    length  = np.maximum(stats['last'], clinic.hours)
+    output  = {'throughput' : per_candidate(stats['diagnosed']) / days,
+               'patients'   : per_candidate(stats['patients']) / days,
+               'turnaround' : (per_candidate(stats['turnaround'])
+                               / np.maximum(per_candidate(stats['patients']), 1)),
+               'overtime'   : per_candidate(length - clinic.hours) / days,
+               'sens'       : (per_candidate(stats['true_positive'])
+                               / np.maximum(per_candidate(stats['diseased']), 1)),
+               'spec'       : (per_candidate(stats['true_negative'])
+                               / np.maximum(per_candidate(stats['healthy']), 1))}
+    for k, (pool, servers) in enumerate(clinic.pools.items()):
+        ## Time average of the queue length (Little's law) and of the share
+        ## of servers in use, over the whole working day
+        output['queue-' + pool]         = per_candidate(stats['queued'][:, k] / length) / days
+        output['utilization-' + pool]   = (per_candidate(stats['busy'][:, k]
+                                                         / (servers * length)) / days)
+    return(output)
+
+def simulate_clinic(candidates, phases, clinic = None, days = DAYS, topologies = None,
+                    memory = 2 ** 28, seed = None):
+    '''Simulates a run of clinic days for every candidate algorithm
+
+    Inputs
+    candidates      : CompactResults : or its frame (or any rows of it, e.g.
+                                       a Pareto front or a TopK result)
+    phases          : Dictionary    : phase letter -> phase, those the
+                                      candidates were evaluated with
+    clinic          : Clinic        : Clinic() by default
+    days            : Integer       : clinic days per candidate
+    topologies      : Dictionary    : family -> expression or Topology for
+                                      families not in TOPOLOGIES
+    memory          : Integer       : rough cap on the working memory in bytes
+    seed            : Integer       : seed of the random generator
+
+    Output
+    output          : Pandas Dataframe : one row per candidate with the
+                                         Algorithm, the mean throughput
+                                         (results before closing per day),
+                                         patients per day, turnaround (mean
+                                         minutes to a result), overtime
+                                         (minutes after closing per day), the
+                                         simulated sens and spec, and the
+                                         queue (mean length) and utilization
+                                         of each pool
+    '''
+
+    clinic  = Clinic() if clinic is None else clinic
+    rng     = np.random.default_rng(seed)
+    frame   = candidates.frame if isinstance(candidates, CompactResults) else candidates
+    frame   = frame.reset_index(drop = True)
+    tables  = candidate_tables(frame, phases, clinic, topologies)
+    nodes   = tables['sens'].shape[1]
+    servers = clinic.servers
+
+    ## Whole candidates per block, all of their days in one batch
+    patients    = clinic.patients + 6 * np.sqrt(clinic.patients) + 1
+    block       = max(1, int(memory // (days * patients * (ROW_BYTES + 4 * nodes))))
+    parts       = []
+    for first in range(0, len(frame), block):
+        chosen      = np.arange(first, min(first + block, len(frame)))
+        candidate   = np.repeat(chosen, days)
+        arrivals, diseased, draws = draw_days(clinic, len(candidate), nodes, rng)
+        stats       = simulate_batch(tables, candidate, arrivals, diseased, draws,
+                                     servers, clinic.hours)
+        parts.append(summarise(stats, len(chosen), days, clinic))
+    output = pd.DataFrame({column : np.concatenate([part[column] for part in parts])
+                           for column in parts[0]} if parts else {})
+    if 'Algorithm' in frame:
+        output.insert(0, 'Algorithm', frame['Algorithm'].to_numpy())
+    elif isinstance(candidates, CompactResults):
+        output.insert(0, 'Algorithm', candidates.names())
+    return(output)
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, SubexpressionCache, phase_arrays,
+                                    evaluate_family, index_dtype, metric_columns)
+
+
+#### This code holds results without their Algorithm names. Every row keeps
+#### the position of its test in each phase (a small integer per phase letter,
+#### -1 for phases its family does not use) and a categorical family code,
+#### and the metrics can be stored in single precision. The names are only
+#### built when rows are shown or exported, and then only for those rows.
+
+## Bytes per row with every phase: 4 float64 (32) or 4 float32 (16), one
+## int8 per phase (7, int16 for phases of more than 127 tests) and one for the
+## family, against about 100 for the Algorithm string and its pointer.
+
+## 'double' keeps the float64 results bit for bit
+PRECISIONS = {'double' : np.float64, 'single' : np.float32}
+
+###############################################################################
+############## Code Section One - Compact results #############################
+###############################################################################
+
+class CompactResults(object):
+    '''Results held as test positions
+
+    Inputs
+    frame           : Pandas Dataframe : the metric columns, one integer
+                                         column per phase letter and a
+                                         categorical family column
+    tables          : Dictionary    : phase letter -> names of its tests (None
+                                      for A), as given by phase_arrays
+
+    Attributes
+    frame           : Pandas Dataframe : as given, usable as it is by
+                                         ParetoFront, TopK and ResultStore
+    '''
+
+    def __init__(self, frame, tables):
+        self.frame  = frame
+        self.tables = tables
+
+    def __len__(self):
+        return(len(self.frame))
+
+    @property
+    def nbytes(self):
+        '''Memory held by the results'''
+
+        return(int(self.frame.memory_usage(index = False, deep = True).sum()))
+
+    def names(self, rows = None):
+        '''Builds the Algorithm names of some rows (all by default)
+
+        Output
+        names           : Numpy array   : object array, as in evaluate_family
+        '''
+
+        frame   = self.frame if rows is None else self.frame.iloc[rows]
+        names   = np.empty(len(frame), dtype = object)
+        codes   = frame['family'].cat.codes.to_numpy()
+        for code, family in enumerate(frame['family'].cat.categories):
+            members = np.flatnonzero(codes == code)
+            if not len(members):
+                continue
+            name = np.full(len(members), '', dtype = object)
+            for label in FAMILIES[family][2]:
+                table = self.tables[label]
+                if table is not None:
+                    name = name + (table + ' ')[frame[label].to_numpy()[members]]
+            names[members] = name + family
+        return(names)
+
+    def decode(self, rows = None):
+        '''Returns some rows (all by default) with the columns of
+        evaluate_family, prevalence metrics included'''
+
+        frame   = self.frame if rows is None else self.frame.iloc[rows]
+        metrics = [column for column in frame.columns
+                   if column != 'family' and column not in self.tables]
+        output  = {column : frame[column].to_numpy() for column in metrics}
+        output['Algorithm'] = self.names(rows)
+        return(pd.DataFrame(output, columns = metrics + ['Algorithm']))
+
+    def chunks(self, chunk_size = 2 ** 16):
+        '''Decodes the rows one chunk at a time, e.g. for
+        ResultWriter.write_results'''
+
+        for start in range(0, len(self.frame), chunk_size):
+            yield(self.decode(np.arange(start, min(start + chunk_size, len(self.frame)))))
+
+    def take(self, rows):
+        '''Returns the given rows as CompactResults'''
+
+        return(CompactResults(self.frame.iloc[rows].reset_index(drop = True), self.tables))
+
+def evaluate_compact(phases, families = None, rules = None, precision = 'double',
+                     memory = 2 ** 28, prevalences = None):
+    '''Evaluates families without building any name
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+    precision       : String        : 'double' or 'single' for the metrics
+    memory          : Integer       : budget of the SubexpressionCache
+    prevalences     : List          : also give PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
+
+    Output
+    results         : CompactResults : rows in the order of evaluate_families
+    '''
+
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of %s' % list(PRECISIONS))
+    families    = list(FAMILIES) if families is None else families
+    labels      = sorted(set(''.join(FAMILIES[family][2] for family in families)))
+    tables      = {label : phase_arrays(phases[label], label)[4] for label in labels}
+    dtypes      = {label : index_dtype(len(phase_arrays(phases[label], label)[0]))
+                   for label in labels}
+    metrics     = metric_columns(prevalences)
+    cache       = SubexpressionCache(memory)
+    frames      = []
+    for family in families:
+        frame = evaluate_family(family, phases, rules, cache, compact = True,
+                                prevalences = prevalences)
+        frame = frame.astype({column : PRECISIONS[precision] for column in metrics})
+        frame = frame.astype({label : dtypes[label] for label in FAMILIES[family][2]})
+        for label in labels:
+            if label not in frame:
+                frame[label] = np.full(len(frame), -1, dtype = dtypes[label])
+        frame['family'] = family
+        frames.append(frame[metrics + labels + ['family']])
+    frame       = pd.concat(frames, ignore_index = True)
+    frame['family'] = pd.Categorical(frame['family'], categories = families)
+    return(CompactResults(frame, tables))
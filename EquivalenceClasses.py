@@ -0,0 +1,397 @@
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, FAMILY_TREES, phase_arrays,
+                                    apply_family, compile_rules, conflict_mask,
+                                    axis_view, index_dtype, position_names)
+
+
+#### This code finds algorithms that are bound to give the same results and
+#### evaluates only one representative of each class. For example No_Dilution
+#### (phase E) has sensitivity 0, specificity 1 and no cost, so it is never
+#### positive and every XP2 algorithm that uses it is the NOXP algorithm with
+#### the same A-D. The classes are found from the tests alone, before any
+#### algorithm is evaluated, and every algorithm keeps a link to its
+#### representative so the full table can be rebuilt.
+
+## Two kinds of equivalence are used:
+##
+## Duplicate tests. Tests of a phase with the same sens, spec, cost and wait
+## are interchangeable, so each phase is cut down to one test per group of
+## identical tests (its classes).
+##
+## Absent tests. A test with sens 0, spec 1, cost 0 and wait 0 is never
+## positive and costs nothing. In the tree of a family (FAMILY_TREES) it is
+## the identity of 'or' and absorbs 'and':
+##     X or never  = never or X = X
+##     never and X = never
+##     X and never = never          when X costs nothing (only A and G)
+## so the tree of an algorithm with absent tests shrinks, and tests that drop
+## out with it (G when F is absent) no longer matter. The algorithm is then
+## mapped to the first family (in FAMILIES order) whose tree shrinks to the
+## same tree, e.g. XP2 with an absent E to NOXP and XP23 to XP3.
+##
+## The hand written formulas do not always follow their tree, so a mapping
+## between families is only used when the formulas of both families agree on
+## random test values (see agrees). Otherwise the algorithm stays in its
+## family and only the choice of absent test (and of duplicates) is merged.
+##
+## Everything works on the axes of the grids, never on single algorithms.
+## The grid of a family splits into boxes, one per choice of the phases that
+## take an absent test. Each box is mapped to a reduced grid: the classes of
+## the phases left in the shrunken tree, on the axes of the family it maps
+## to. Families and boxes that shrink to the same tree share their reduced
+## grid. The representative of every algorithm is then a sum over the axes of
+## its class times the stride of that axis in the reduced grid, which is
+## broadcast over the box like the formulas are.
+
+## Leaf of a tree that is never positive and costs nothing
+NEVER = ('never',)
+
+## Phases that cost nothing
+COST_FREE = 'AG'
+
+## Test values of an absent test: sens, spec, cost, wait
+ABSENT = (0.0, 1.0, 0.0, 0.0)
+
+## Number of random test values on which two formulas must agree
+PROBES = 32
+
+###############################################################################
+############## Code Section One - Trees #######################################
+###############################################################################
+
+def cost_free(tree):
+    '''True if no test of a tree costs anything'''
+
+    if tree == NEVER:
+        return(True)
+    if not isinstance(tree, tuple):
+        return(tree in COST_FREE)
+    return(cost_free(tree[1]) and cost_free(tree[2]))
+
+def simplify(tree, absent):
+    '''Removes absent tests from a tree
+
+    Inputs
+    tree            : Tuple/String  : a tree of FAMILY_TREES
+    absent          : Set           : phase letters whose test is absent
+
+    Output
+    tree            : Tuple/String  : the simplified tree, NEVER if it is never
+                                      positive and costs nothing
+    '''
+
+    if not isinstance(tree, tuple):
+        return(NEVER if tree in absent else tree)
+    left    = simplify(tree[1], absent)
+    right   = simplify(tree[2], absent)
+    if tree[0] == 'or':
+        if left == NEVER:
+            return(right)
+        if right == NEVER:
+            return(left)
+    else:
+        if left == NEVER or (right == NEVER and cost_free(left)):
+            return(NEVER)
+    return((tree[0], left, right))
+
+def tree_labels(tree):
+    '''Phase letters of the tests left in a tree'''
+
+    if tree == NEVER:
+        return(set())
+    if not isinstance(tree, tuple):
+        return({tree})
+    return(tree_labels(tree[1]) | tree_labels(tree[2]))
+
+###############################################################################
+############## Code Section Two - Classes #####################################
+###############################################################################
+
+def random_tests(rng):
+    '''Random (sens, spec, cost, wait) values of PROBES tests in every phase.
+    A and G cost nothing and the pair of G is [g, 1 - g].'''
+
+    values = {}
+    for label in 'ABCDEFG':
+        sens, spec, cost, wait = rng.random((4, PROBES))
+        if label in COST_FREE:
+            cost, wait = np.zeros(PROBES), np.zeros(PROBES)
+        if label == 'G':
+            spec = 1 - sens
+        values[label] = (sens, spec, cost, wait)
+    return(values)
+
+def agrees(source, absent, target, target_absent, kept, seed = 0):
+    '''Checks that the formulas of two families give the same results when
+    the tests in kept are shared, the absent tests are absent and every other
+    test takes any value
+
+    Inputs
+    source, target  : String        : keys of FAMILIES
+    absent          : Set           : absent phases of the source
+    target_absent   : Set           : absent phases of the target
+    kept            : Set           : phases whose tests are shared
+    '''
+
+    rng     = np.random.default_rng(seed)
+    shared  = random_tests(rng)
+    other   = random_tests(rng)
+
+    def tests(family, absent, values):
+        return([tuple(np.full(PROBES, x) for x in ABSENT) if label in absent
+                else shared[label] if label in kept else values[label]
+                for label in FAMILIES[family][2]])
+
+    first   = apply_family(source, tests(source, absent, shared))
+    second  = apply_family(target, tests(target, target_absent, other))
+    return(all(np.allclose(x, y, rtol = 1e-12, atol = 1e-12)
+               for x, y in zip(first, second)))
+
+def resolve(family, absent, available, families):
+    '''Finds the family an algorithm with absent tests is mapped to
+
+    Inputs
+    family          : String        : key of FAMILIES
+    absent          : Set           : phase letters whose test is absent
+    available       : Set           : phase letters that have an absent test
+    families        : List          : the families it may be mapped to
+
+    Output
+    target          : String        : key of FAMILIES
+    target_absent   : Set           : phases of the target that take an
+                                      absent test
+    kept            : Set           : phases whose tests are carried over,
+                                      the other phases of the target take
+                                      their first test
+    '''
+
+    tree = simplify(FAMILY_TREES[family], absent)
+    kept = tree_labels(tree)
+    for target in [target for target in FAMILIES if target in families]:
+        labels          = set(FAMILIES[target][2])
+        target_absent   = labels - kept - set(COST_FREE)
+        if not kept <= labels or not target_absent <= available:
+            continue
+        if simplify(FAMILY_TREES[target], target_absent) != tree:
+            continue
+        if agrees(family, absent, target, target_absent, kept):
+            return(target, target_absent, kept)
+    ## No family matches: only the choice of absent test is merged
+    return(family, set(absent), set(FAMILIES[family][2]) - set(absent))
+
+def phase_classes(arrays, label):
+    '''Groups the identical tests of a phase
+
+    Inputs
+    arrays          : Tuple         : output of phase_arrays
+    label           : String        : letter of the phase
+
+    Output
+    first           : Numpy array   : position of the first test of each
+                                      class, classes in order of appearance
+    inverse         : Numpy array   : class of each test
+    absent          : Numpy array   : True for a class of absent tests (never
+                                      for A and G)
+    '''
+
+    values      = np.stack(arrays[:4], axis = 1)
+    _, first, inverse = np.unique(values, axis = 0, return_index = True,
+                                  return_inverse = True)
+    order       = np.argsort(first)
+    rank        = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    first       = first[order]
+    absent      = (values[first] == ABSENT).all(axis = 1) & (label not in COST_FREE)
+    return(first, rank[inverse.ravel()], absent)
+
+def reduced_grid(target, target_absent, kept, classes):
+    '''The classes on each axis of a reduced grid
+
+    Output
+    choices         : List          : per phase of the target, the classes on
+                                      its axis: every class that is not
+                                      absent for kept phases, the first
+                                      absent class for absent phases and the
+                                      first class for phases that dropped out
+    '''
+
+    choices = []
+    for label in FAMILIES[target][2]:
+        _, _, absent = classes[label]
+        if label in target_absent:
+            choices.append(np.flatnonzero(absent)[:1])
+        elif label in kept:
+            choices.append(np.flatnonzero(~absent))
+        else:
+            choices.append(np.zeros(1, dtype = np.intp))
+    return(choices)
+
+def canonicalize(phases, families = None, rules = None):
+    '''Groups the viable algorithms of several families into classes of
+    algorithms with the same results
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+
+    Output
+    representatives : Pandas Dataframe : one row per class, with the family of
+                                         the representative and the position
+                                         of its test in each phase (-1 for
+                                         phases it does not use)
+    mapping         : Pandas Dataframe : every viable algorithm, in the order
+                                         of evaluate_families, as its family
+                                         (categorical), the position of its
+                                         test in each phase (-1 for phases
+                                         its family does not use) and the row
+                                         of its representative
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    labels      = sorted(set(''.join(FAMILIES[family][2] for family in families)))
+    arrays      = {label : phase_arrays(phases[label], label) for label in labels}
+    classes     = {label : phase_classes(arrays[label], label) for label in labels}
+    available   = {label for label in labels if classes[label][2].any()}
+    ## Position of every class among the classes that are not absent
+    rank        = {label : np.cumsum(~absent) - 1 for label, (_, _, absent) in classes.items()}
+    grids       = {}
+    members     = []
+    columns     = {label : [] for label in labels}
+    counts      = []
+    for family in families:
+        axes    = FAMILIES[family][2]
+        shape   = tuple(len(arrays[label][0]) for label in axes)
+        ndim    = len(shape)
+        keep    = np.flatnonzero(~conflict_mask(
+            compile_rules([arrays[label][4] for label in axes], rules), shape))
+        row     = np.zeros(shape, dtype = np.int64)
+        ## One box per choice of the phases that take an absent test
+        optional = [label for label in axes if label in available]
+        for code in range(2 ** len(optional)):
+            absent  = {label for bit, label in enumerate(optional) if code >> bit & 1}
+            box     = []
+            for label in axes:
+                _, inverse, absent_class = classes[label]
+                if label in optional:
+                    box.append(np.flatnonzero(absent_class[inverse] == (label in absent)))
+                else:
+                    box.append(np.arange(len(inverse)))
+            if not all(len(position) for position in box):
+                continue
+            target, target_absent, kept = resolve(family, absent, available, families)
+            key = (target, frozenset(target_absent), frozenset(kept))
+            if key not in grids:
+                choices     = reduced_grid(target, target_absent, kept, classes)
+                offset      = sum(int(np.prod([len(x) for x in grid[1]]))
+                                  for grid in grids.values())
+                grids[key]  = (offset, choices)
+            offset, choices = grids[key]
+            size    = [len(x) for x in choices]
+            strides = dict(zip(FAMILIES[target][2], np.cumprod((size + [1])[:0:-1])[::-1]))
+            value   = np.full([1] * ndim, offset, dtype = np.int64)
+            for axis, (label, position) in enumerate(zip(axes, box)):
+                if label in kept:
+                    value = value + axis_view(strides[label] * rank[label][
+                        classes[label][1][position]], axis, ndim)
+            row[np.ix_(*box)] = value
+        members.append(row.ravel()[keep])
+        index   = dict(zip(axes, np.unravel_index(keep, shape)))
+        for label in labels:
+            dtype = index_dtype(len(arrays[label][0]))
+            columns[label].append(index[label].astype(dtype) if label in index
+                                  else np.full(len(keep), -1, dtype = dtype))
+        counts.append(len(keep))
+    members     = np.concatenate(members) if members else np.zeros(0, dtype = np.int64)
+    mapping     = pd.DataFrame({label : np.concatenate(values) if values else []
+                                for label, values in columns.items()})
+    mapping.insert(0, 'family', pd.Categorical.from_codes(
+        np.repeat(np.arange(len(families)), counts), categories = families))
+
+    ## Every point of the reduced grids, then only those with a member
+    frames      = []
+    for (target, _, _), (_, choices) in grids.items():
+        index   = np.unravel_index(np.arange(int(np.prod([len(x) for x in choices]))),
+                                   [len(x) for x in choices])
+        frame   = {label : np.full(len(index[0]), -1, dtype = np.int64) for label in labels}
+        for label, choice, position in zip(FAMILIES[target][2], choices, index):
+            frame[label] = classes[label][0][choice[position]]
+        frame   = pd.DataFrame(frame)
+        frame.insert(0, 'family', target)
+        frames.append(frame)
+    if not frames:
+        mapping['representative'] = members
+        return(pd.DataFrame(columns = ['family'] + labels), mapping)
+    representatives = pd.concat(frames, ignore_index = True)
+    used        = np.bincount(members, minlength = len(representatives)) > 0
+    mapping['representative'] = (np.cumsum(used) - 1)[members]
+    return(representatives[used].reset_index(drop = True), mapping)
+
+###############################################################################
+############## Code Section Three - Evaluation ################################
+###############################################################################
+
+def algorithm_names(frame, phases):
+    '''Builds the Algorithm names of rows holding a family and test positions,
+    as in evaluate_family'''
+
+    names   = np.empty(len(frame), dtype = object)
+    family  = pd.Categorical(frame['family'])
+    codes   = family.codes
+    for code, name in enumerate(family.categories):
+        rows    = np.flatnonzero(codes == code)
+        labels  = FAMILIES[name][2]
+        names[rows] = position_names([phase_arrays(phases[label], label)[4]
+                                      for label in labels],
+                                     [frame[label].to_numpy()[rows] for label in labels],
+                                     name)
+    return(names)
+
+def evaluate_canonical(phases, families = None, rules = None):
+    '''Evaluates one representative of each class of equivalent algorithms
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+
+    Output
+    results         : Pandas Dataframe : one row per class with the COLUMNS of
+                                         evaluate_family (Algorithm is the
+                                         name of the representative, which
+                                         need not itself be viable) and the
+                                         number of members
+    mapping         : Pandas Dataframe : output of canonicalize, rows of
+                                         results as representatives. expand
+                                         builds the full table from it.
+    '''
+
+    families                    = list(FAMILIES) if families is None else families
+    representatives, mapping    = canonicalize(phases, families, rules)
+    values  = np.empty((len(representatives), len(COLUMNS) - 1))
+    codes   = pd.Categorical(representatives['family'])
+    for code, family in enumerate(codes.categories):
+        rows    = np.flatnonzero(codes.codes == code)
+        tests   = []
+        for label in FAMILIES[family][2]:
+            position = representatives[label].to_numpy()[rows]
+            tests.append(tuple(x[position] for x in phase_arrays(phases[label], label)[:4]))
+        for j, value in enumerate(apply_family(family, tests)):
+            values[rows, j] = value
+    results = pd.DataFrame(values, columns = COLUMNS[:-1])
+    results['Algorithm']    = algorithm_names(representatives, phases)
+    results['members']      = np.bincount(mapping['representative'].to_numpy(),
+                                          minlength = len(results))
+    return(results, mapping)
+
+def expand(results, mapping, phases):
+    '''Rebuilds the full table of evaluate_families from evaluate_canonical'''
+
+    output = results[COLUMNS[:-1]].iloc[mapping['representative'].to_numpy()]
+    output = output.reset_index(drop = True)
+    output['Algorithm'] = algorithm_names(mapping, phases)
+    return(output)
@@ -0,0 +1,301 @@
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, phase_arrays, as_phase,
+                                    apply_family, family_index, family_names)
+from UncertaintyAnalysis import sample_values
+
+
+#### This code finds which test parameter moves each algorithm the most. The
+#### partial derivatives of every metric with respect to the sensitivity,
+#### specificity, cost and wait of each test of the algorithm (and to A and G)
+#### are computed exactly, in the same broadcast pass as the metrics, by
+#### running the formulas on dual numbers (forward mode differentiation).
+#### Variance based (Sobol) indices of the sensitivities and specificities
+#### are estimated by sampling, with every sample of every algorithm
+#### evaluated in one batch.
+
+## A Dual holds a value and its derivatives along D directions, one per
+## parameter, on a leading axis. The formulas only use +, - and *, so they
+## run on Duals unchanged, and each operation updates the derivatives by the
+## usual rules. Every algorithm uses one test per phase, so the direction
+## "sens of B" is the sensitivity of whichever test the algorithm uses for B.
+##
+## Parameters of each phase: sens, spec, cost and wait for B-F, sens and spec
+## for A, and g for G (whose pair is [g, 1 - g]).
+##
+## The Sobol indices use the estimators of Saltelli (first order, with fB
+## centred) and Jansen (total) on two independent sample matrices. The
+## sensitivities and specificities of B-F are drawn as in UncertaintyAnalysis,
+## A, G, the costs and the waits are fixed.
+
+## Phase letter -> parameters that are differentiated
+PARAMETERS = {'A' : ('sens', 'spec'), 'G' : ('g',)}
+TEST_PARAMETERS = ('sens', 'spec', 'cost', 'wait')
+
+## Rough number of float64 arrays alive per sampled value (or derivative),
+## used to turn the memory cap into block sizes
+WORKING_ARRAYS = 24
+
+###############################################################################
+############## Code Section One - Forward mode ################################
+###############################################################################
+
+class Dual(object):
+    '''A value and its derivatives (forward mode)
+
+    Inputs
+    value           : Numpy array   : the value
+    tangent         : Numpy array   : derivatives, shape (D,) + a shape that
+                                      broadcasts against value
+    '''
+
+    ## Makes numpy arrays hand the arithmetic over to Dual
+    __array_ufunc__ = None
+
+    def __init__(self, value, tangent):
+        self.value      = value
+        self.tangent    = tangent
+
+    def __repr__(self):
+        return('Dual(%r, %r)' % (self.value, self.tangent))
+
+    @staticmethod
+    def of(value):
+        if isinstance(value, Dual):
+            return(value)
+        return(Dual(value, 0.0))
+
+    def __add__(self, other):
+        other = Dual.of(other)
+        return(Dual(self.value + other.value, self.tangent + other.tangent))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = Dual.of(other)
+        return(Dual(self.value - other.value, self.tangent - other.tangent))
+
+    def __rsub__(self, other):
+        return(Dual.of(other) - self)
+
+    def __neg__(self):
+        return(Dual(-self.value, -self.tangent))
+
+    def __mul__(self, other):
+        other = Dual.of(other)
+        return(Dual(self.value * other.value,
+                    self.tangent * other.value + self.value * other.tangent))
+
+    __rmul__ = __mul__
+
+def parameters(labels):
+    '''Returns the (phase, parameter) directions of a family, in order'''
+
+    return([(label, name) for label in labels
+            for name in PARAMETERS.get(label, TEST_PARAMETERS)])
+
+def seed_tests(labels, phases, index):
+    '''The tests of some algorithms of a family as Duals, each parameter
+    seeded with its own direction
+
+    Inputs
+    index           : List          : position of the test of each algorithm,
+                                      one integer array per phase
+
+    Output
+    tests           : List          : (sens, spec, cost, wait) Duals per
+                                      phase, one value per algorithm
+    '''
+
+    directions  = parameters(labels)
+    tests       = []
+    for label, position in zip(labels, index):
+        arrays  = phase_arrays(phases[label], label)
+        seeds   = []
+        for name in ('sens', 'spec', 'cost', 'wait'):
+            tangent = np.zeros((len(directions), 1))
+            if (label, name) in directions:
+                tangent[directions.index((label, name))] = 1
+            if label == 'G' and name in ('sens', 'spec'):
+                tangent[directions.index((label, 'g'))] = 1 if name == 'sens' else -1
+            seeds.append(tangent)
+        tests.append([Dual(x[position], seed) for x, seed in zip(arrays[:4], seeds)])
+    return(tests)
+
+def family_gradients(family, phases, rules = None, memory = 2 ** 28):
+    '''Evaluates a family and the derivatives of every metric
+
+    Inputs
+    family          : String        : key of FAMILIES
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    rules           : List          : rules to apply, RULES by default
+    memory          : Integer       : rough cap on the working memory in bytes
+
+    Output
+    output          : Pandas Dataframe : the COLUMNS of evaluate_family and,
+                                         for each metric and parameter, a
+                                         column 'metric/phase.parameter', e.g.
+                                         'cost-1/D.sens'
+    '''
+
+    labels      = FAMILIES[family][2]
+    directions  = parameters(labels)
+    index       = family_index(family, phases, rules)
+    count       = len(index[0])
+    output      = {metric : np.empty(count) for metric in COLUMNS[:-1]}
+    columns     = {(metric, label, name) : np.empty(count) for metric in COLUMNS[:-1]
+                   for label, name in directions}
+    ## Blocks of algorithms, each with a (directions, algorithms) tangent
+    block       = max(1, int(memory // (8 * WORKING_ARRAYS * len(directions))))
+    for start in range(0, count, block):
+        rows    = slice(start, start + block)
+        tests   = seed_tests(labels, phases, [position[rows] for position in index])
+        size    = (len(directions), len(index[0][rows]))
+        ## The values are the real parts of the same evaluation
+        for metric, value in zip(COLUMNS[:-1], apply_family(family, tests)):
+            value                   = Dual.of(value)
+            output[metric][rows]    = np.broadcast_to(value.value, size[1:])
+            tangent                 = np.broadcast_to(value.tangent, size)
+            for (label, name), column in zip(directions, tangent):
+                columns[metric, label, name][rows] = column
+    output['Algorithm'] = family_names(family, phases, index = index)
+    for (metric, label, name), values in columns.items():
+        output['%s/%s.%s' % (metric, label, name)] = values
+    return(pd.DataFrame(output))
+
+def run_gradients(phases, families = None, rules = None, memory = 2 ** 28):
+    '''family_gradients of several families (every family by default). Phases
+    a family does not use have no derivative columns, which are NaN.'''
+
+    families = list(FAMILIES) if families is None else families
+    return(pd.concat([family_gradients(family, phases, rules, memory)
+                      for family in families], ignore_index = True))
+
+def tornado(gradients, row, metric, phases):
+    '''The parameters of one algorithm ranked by how far they can move a
+    metric, for a tornado plot
+
+    Inputs
+    gradients       : Pandas Dataframe : output of family_gradients
+    row             : Integer       : position of the algorithm in gradients
+    metric          : String        : one of the COLUMNS
+
+    Output
+    output          : Pandas Dataframe : parameter, test, derivative and
+                                         swing (derivative times the width of
+                                         the [lower, upper] bounds of a sens or
+                                         spec, NaN for other parameters),
+                                         largest swing first
+    '''
+
+    algorithm   = gradients.iloc[row]
+    words       = algorithm['Algorithm'].split()
+    labels      = FAMILIES[words[-1]][2]
+    tests       = dict(zip([label for label in labels if label != 'A'], words[:-1]))
+    rows        = []
+    for label, name in parameters(labels):
+        column  = '%s/%s.%s' % (metric, label, name)
+        width   = np.nan
+        if label not in 'AG' and name in ('sens', 'spec'):
+            phase    = as_phase(phases[label])
+            position = list(phase.names).index(tests[label])
+            width    = (getattr(phase, name + '_upper')[position]
+                        - getattr(phase, name + '_lower')[position])
+        rows.append(('%s.%s' % (label, name), tests.get(label, ''),
+                     algorithm[column], algorithm[column] * width))
+    output  = pd.DataFrame(rows, columns = ['parameter', 'test', 'derivative', 'swing'])
+    order   = np.lexsort((-output['derivative'].abs(), -output['swing'].abs().fillna(-1)))
+    return(output.iloc[order].reset_index(drop = True))
+
+###############################################################################
+############## Code Section Two - Sobol indices ###############################
+###############################################################################
+
+def sobol_family(family, phases, draws = 1024, rules = None, rng = None,
+                 distribution = 'beta', memory = 2 ** 28):
+    '''First order and total Sobol indices of the sensitivities and
+    specificities of the tests of every algorithm of a family
+
+    Inputs
+    draws           : Integer       : rows of each of the two sample matrices
+    distribution    : String        : 'beta' or 'triangular', see
+                                      UncertaintyAnalysis.sample_values
+
+    Output
+    output          : Pandas Dataframe : Algorithm and, for each metric and
+                                         input, 'metric/phase.parameter_first'
+                                         and '_total'
+    '''
+
+    rng         = np.random.default_rng() if rng is None else rng
+    labels      = FAMILIES[family][2]
+    index       = family_index(family, phases, rules)
+    inputs      = [(label, name) for label in labels if label not in 'AG'
+                   for name in ('sens', 'spec')]
+    ## Two independent samples of every test: (matrix, draws, tests)
+    samples     = {}
+    for label in labels:
+        if label in 'AG':
+            continue
+        phase = as_phase(phases[label])
+        for name in ('sens', 'spec'):
+            samples[label, name] = np.stack(
+                [sample_values(getattr(phase, name), getattr(phase, name + '_lower'),
+                               getattr(phase, name + '_upper'), draws, rng, distribution)
+                 for _ in range(2)])
+
+    ## Configurations: A, B, then A with input i taken from B
+    configs     = len(inputs) + 2
+    output      = {'Algorithm' : family_names(family, phases, index = index)}
+    count       = len(index[0])
+    block       = max(1, int(memory // (8 * WORKING_ARRAYS * configs * draws)))
+    results     = {(metric, label, name, kind) : np.empty(count)
+                   for metric in COLUMNS[:-1] for label, name in inputs
+                   for kind in ('first', 'total')}
+    for start in range(0, count, block):
+        rows    = slice(start, start + block)
+        tests   = []
+        for label, position in zip(labels, index):
+            sens, spec, cost, wait, _ = phase_arrays(phases[label], label)
+            position = position[rows]
+            values   = {'sens' : sens[position], 'spec' : spec[position]}
+            if label not in 'AG':
+                for name in ('sens', 'spec'):
+                    matrix  = np.zeros(configs, dtype = np.intp)
+                    matrix[1] = 1
+                    if (label, name) in inputs:
+                        matrix[2 + inputs.index((label, name))] = 1
+                    ## (configs, draws, algorithms)
+                    values[name] = samples[label, name][matrix][:, :, position]
+            tests.append((values['sens'], values['spec'], cost[position], wait[position]))
+        metrics = apply_family(family, tests)
+        for metric, value in zip(COLUMNS[:-1], metrics):
+            value   = np.broadcast_to(value, (configs, draws, len(tests[0][2])))
+            first, second = value[0], value[1]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                both     = np.concatenate([first, second])
+                variance = both.var(axis = 0)
+                ## Centring fB keeps the first order estimate stable when the
+                ## mean is large against the spread (e.g. costs)
+                centred  = second - both.mean(axis = 0)
+                for i, (label, name) in enumerate(inputs):
+                    mixed = value[2 + i]
+                    results[metric, label, name, 'first'][rows] = (
+                        (centred * (mixed - first)).mean(axis = 0) / variance)
+                    results[metric, label, name, 'total'][rows] = (
+                        0.5 * ((first - mixed) ** 2).mean(axis = 0) / variance)
+    for (metric, label, name, kind), values in results.items():
+        output['%s/%s.%s_%s' % (metric, label, name, kind)] = values
+    return(pd.DataFrame(output))
+
+def run_sobol(phases, families = None, draws = 1024, rules = None, seed = None,
+              distribution = 'beta', memory = 2 ** 28):
+    '''sobol_family of several families (every family by default)'''
+
+    families    = list(FAMILIES) if families is None else families
+    rng         = np.random.default_rng(seed)
+    return(pd.concat([sobol_family(family, phases, draws, rules, rng, distribution,
+                                   memory) for family in families],
+                     ignore_index = True))
@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+
+import SensSpecCostCalculator
+from SensSpecCostCalculator import (FAMILIES, PHASE_TYPES, COLUMNS, TestCatalog,
+                                    SubexpressionCache, phase_arrays, family_index,
+                                    evaluate_family)
+from ParetoFront import ParetoFront
+from ResultCache import result_key
+
+
+#### This code keeps the results of every family up to date while the catalog
+#### is revised one test at a time. A new version of the phases is compared
+#### with the previous one test by test, and only the combinations that use a
+#### changed, added or removed test are touched: rows of removed tests are
+#### dropped, rows of changed and added tests are evaluated, and every other
+#### row is kept as it is. The patched results equal a full evaluation of the
+#### new phases, row for row.
+
+## Tests are matched by name (by value for A, which has no names), so a test
+## keeps its rows when other tests are inserted before it. The rows of a
+## changed test are found as the boxes of the grid in which its axis only
+## holds changed or added tests and every earlier axis only clean ones, so
+## each row is evaluated exactly once.
+
+###############################################################################
+############## Code Section One - Differences #################################
+###############################################################################
+
+def take_phase(phase, label, index):
+    '''Returns the tests of a phase at index, in the form of the phase'''
+
+    if label == 'A':
+        return(np.asarray(phase, dtype = float).reshape(-1, 2)[index])
+    if label == 'G':
+        return([phase[i] for i in index])
+    if isinstance(phase, pd.DataFrame):
+        phase = TestCatalog(phase, percent = False).tests
+    return(phase.take(index))
+
+def test_identities(phase, label):
+    '''Returns what identifies each test of a phase (its name and how many
+    tests of the same name come before it) and the values the results depend
+    on (sens, spec, cost and wait)'''
+
+    sens, spec, cost, wait, names = phase_arrays(phase, label)
+    keys    = names if names is not None else list(zip(sens, spec))
+    seen    = {}
+    ids     = []
+    for key in keys:
+        ids.append((key, seen.get(key, 0)))
+        seen[key] = ids[-1][1] + 1
+    return(ids, np.stack([sens, spec, cost, wait], axis = 1))
+
+def diff_phase(old, new, label):
+    '''Compares two versions of a phase
+
+    Output
+    moved           : Numpy array   : new position of every old test, -1 for
+                                      removed tests
+    dirty           : Numpy array   : boolean over the new tests, True for
+                                      tests that were added or changed
+    '''
+
+    old_ids, old_values = test_identities(old, label)
+    new_ids, new_values = test_identities(new, label)
+    position    = {key : i for i, key in enumerate(new_ids)}
+    moved       = np.array([position.get(key, -1) for key in old_ids], dtype = np.intp)
+    dirty       = np.ones(len(new_ids), dtype = bool)
+    kept        = moved >= 0
+    same        = (old_values[kept] == new_values[moved[kept]]).all(axis = 1)
+    dirty[moved[kept][same]] = False
+    return(moved, dirty)
+
+###############################################################################
+############## Code Section Two - Incremental results #########################
+###############################################################################
+
+class IncrementalResults(object):
+    '''The results of several families that are patched when the phases change
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+    pareto          : Boolean       : also keep the joint Pareto front
+    results         : ResultCache   : optional, every patched family is
+                                      stored in it
+
+    Attributes
+    frames          : Dictionary    : family -> result, as evaluate_family
+    index           : Dictionary    : family -> grid position of each row, as
+                                      family_index
+    front           : ParetoFront   : the front of all frames, or None
+    '''
+
+    def __init__(self, phases, families = None, rules = None, pareto = True,
+                 results = None):
+        self.phases     = dict(phases)
+        self.families   = list(FAMILIES) if families is None else families
+        self.rules      = SensSpecCostCalculator.RULES if rules is None else rules
+        self.results    = results
+        self.frames     = {}
+        self.index      = {}
+        cache           = SubexpressionCache()
+        for family in self.families:
+            if results is not None:
+                self.frames[family] = results.evaluate(family, phases, self.rules, cache)
+            else:
+                self.frames[family] = evaluate_family(family, phases, self.rules, cache)
+            self.index[family] = family_index(family, phases, self.rules)
+        self.front      = None
+        if pareto:
+            self.front = ParetoFront().extend(self.frames.values())
+
+    def result(self):
+        '''Returns every family concatenated, as evaluate_families'''
+
+        return(pd.concat([self.frames[family] for family in self.families],
+                         ignore_index = True))
+
+    def update(self, phases):
+        '''Brings the results up to date with a new version of the phases
+
+        Inputs
+        phases          : Dictionary    : phase letter -> phase, with the same
+                                          letters as before
+
+        Output
+        evaluated       : Dictionary    : family -> number of rows evaluated
+        '''
+
+        labels      = sorted(set(''.join(FAMILIES[family][2] for family in self.families)))
+        diffs       = {label : diff_phase(self.phases[label], phases[label], label)
+                       for label in labels}
+        cache       = SubexpressionCache()
+        evaluated   = {}
+        fresh       = []
+        stale       = False
+        for family in self.families:
+            frame, rows, dropped = self.patch(family, phases, diffs, cache)
+            evaluated[family] = len(rows)
+            if len(rows):
+                fresh.append(rows)
+            if self.front is not None and len(dropped) and len(self.front):
+                stale |= len(self.front.frame.merge(dropped, on = COLUMNS)) > 0
+            if self.results is not None:
+                self.results.store(result_key(family, phases, self.rules), frame)
+        self.phases = dict(phases)
+
+        if self.front is not None:
+            ## A row that left the front may have been hiding others, in which
+            ## case the front is built again from every row
+            if stale:
+                self.front = ParetoFront().extend(self.frames.values())
+            else:
+                self.front.extend(fresh)
+        return(evaluated)
+
+    def update_catalog(self, catalog):
+        '''Updates B-F from a new version of the catalog (a TestCatalog),
+        keeping A and G'''
+
+        phases = dict(self.phases)
+        for label, type_ in PHASE_TYPES.items():
+            if label in phases:
+                phases[label] = catalog.phase(type_)
+        return(self.update(phases))
+
+    def patch(self, family, phases, diffs, cache = None):
+        '''Patches the result of one family
+
+        Output
+        frame           : Pandas Dataframe : the new result
+        evaluated       : Pandas Dataframe : the rows that were evaluated
+        dropped         : Pandas Dataframe : the old rows that were replaced or
+                                             removed
+        '''
+
+        labels  = FAMILIES[family][2]
+        moved   = [diffs[label][0] for label in labels]
+        dirty   = [diffs[label][1] for label in labels]
+        shape   = tuple(len(mask) for mask in dirty)
+
+        ## Old rows whose tests are all still there and unchanged are kept
+        index   = [moves[position] for moves, position in zip(moved, self.index[family])]
+        keep    = np.ones(len(self.frames[family]), dtype = bool)
+        for mask, position in zip(dirty, index):
+            keep &= position >= 0
+            keep[keep] &= ~mask[position[keep]]
+        frame   = self.frames[family]
+        dropped = frame[~keep]
+        frames  = [frame[keep]]
+        indices = [[position[keep] for position in index]]
+
+        ## Every other row has a dirty test on some axis, the first of which
+        ## is axis k
+        evaluated = []
+        for k in range(len(labels)):
+            if not dirty[k].any():
+                continue
+            boxes   = ([np.flatnonzero(~mask) for mask in dirty[:k]]
+                       + [np.flatnonzero(dirty[k])]
+                       + [np.arange(n) for n in shape[k + 1:]])
+            if not all(len(box) for box in boxes):
+                continue
+            sub     = {label : take_phase(phases[label], label, box)
+                       for label, box in zip(labels, boxes)}
+            rows    = evaluate_family(family, sub, self.rules, cache)
+            where   = family_index(family, sub, self.rules)
+            evaluated.append(rows)
+            frames.append(rows)
+            indices.append([box[position] for box, position in zip(boxes, where)])
+
+        index   = [np.concatenate(position) for position in zip(*indices)]
+        order   = np.argsort(np.ravel_multi_index(index, shape), kind = 'stable')
+        frame   = pd.concat(frames, ignore_index = True).iloc[order].reset_index(drop = True)
+        self.frames[family] = frame
+        self.index[family]  = tuple(position[order] for position in index)
+        if evaluated:
+            evaluated = pd.concat(evaluated, ignore_index = True)
+        else:
+            evaluated = frame[:0]
+        return(frame, evaluated, dropped)
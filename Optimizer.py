@@ -0,0 +1,325 @@
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, phase_arrays, apply_family,
+                                    axis_view, compile_rules, evaluate_families)
+from ParetoFront import OBJECTIVES
+
+
+#### This code finds the best algorithm for an objective under constraints,
+#### for example the most sensitive algorithm with spec >= 0.999 and
+#### cost-1 <= budget, without enumerating every combination of tests. The
+#### tests are chosen one phase at a time (a branch and bound search). Each
+#### partial choice is given bounds on every metric over all the ways it can
+#### be completed, and it is dropped when no completion can meet the
+#### constraints or beat the best algorithm found so far. What is left is
+#### evaluated exactly, so the answer is that of brute force.
+
+## Bounds of a partial choice. Every phase that is not chosen yet is replaced
+## by the range of its tests. CAS and COS are increasing in every sensitivity
+## and specificity, so the sens and spec of any completion lie between the
+## algorithm evaluated with every open phase at its lowest values and at its
+## highest values. The costs and times are not monotone and are bounded with
+## interval arithmetic (Interval), run through the same formulas.
+##
+## Rounding can move a computed value by a few units in the last place, so
+## bounds are widened by SLACK (relative) before anything is dropped. A
+## choice is then only dropped when it is clearly worse, and ties are kept.
+
+SLACK = 1e-9
+
+###############################################################################
+############## Code Section One - Bounds ######################################
+###############################################################################
+
+class Interval(object):
+    '''A range [low, high] of numbers (or of arrays of numbers) with the
+    arithmetic used by the formulas (+, - and *)'''
+
+    ## Makes numpy arrays hand the arithmetic over to Interval
+    __array_ufunc__ = None
+
+    def __init__(self, low, high):
+        self.low    = low
+        self.high   = high
+
+    def __repr__(self):
+        return('Interval(%r, %r)' % (self.low, self.high))
+
+    @staticmethod
+    def of(value):
+        if isinstance(value, Interval):
+            return(value)
+        return(Interval(value, value))
+
+    def __add__(self, other):
+        other = Interval.of(other)
+        return(Interval(self.low + other.low, self.high + other.high))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = Interval.of(other)
+        return(Interval(self.low - other.high, self.high - other.low))
+
+    def __rsub__(self, other):
+        return(Interval.of(other) - self)
+
+    def __neg__(self):
+        return(Interval(-self.high, -self.low))
+
+    def __mul__(self, other):
+        other       = Interval.of(other)
+        products    = [self.low * other.low, self.low * other.high,
+                       self.high * other.low, self.high * other.high]
+        return(Interval(reduce(np.minimum, products), reduce(np.maximum, products)))
+
+    __rmul__ = __mul__
+
+def widen(low, high):
+    '''Widens bounds by SLACK to cover rounding'''
+
+    low     = np.asarray(low, dtype = float)
+    high    = np.asarray(high, dtype = float)
+    return(low - SLACK * np.maximum(1, np.abs(low)),
+           high + SLACK * np.maximum(1, np.abs(high)))
+
+###############################################################################
+############## Code Section Two - Search ######################################
+###############################################################################
+
+class BranchAndBound(object):
+    '''Exact search for the algorithms that optimise one metric subject to
+    bounds on the others
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    objective       : String        : metric to optimise, one of OBJECTIVES,
+                                      in the direction given there
+    constraints     : Dictionary    : metric -> (lower, upper), None for an
+                                      open end
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+    leaf_size       : Integer       : a partial choice with at most this many
+                                      completions is evaluated exactly rather
+                                      than split further
+
+    Attributes
+    nodes           : Integer       : partial choices that were bounded
+    evaluated       : Integer       : combinations evaluated exactly
+    '''
+
+    def __init__(self, phases, objective = 'sens', constraints = None,
+                 families = None, rules = None, leaf_size = 4096):
+        if objective not in OBJECTIVES:
+            raise ValueError('objective must be one of %s' % list(OBJECTIVES))
+        for metric in (constraints or {}):
+            if metric not in OBJECTIVES:
+                raise ValueError('cannot constrain %r' % metric)
+        self.phases         = phases
+        self.objective      = objective
+        self.sign           = 1 if OBJECTIVES[objective] == 'max' else -1
+        self.constraints    = dict(constraints or {})
+        self.families       = list(FAMILIES) if families is None else families
+        self.rules          = rules
+        self.leaf_size      = leaf_size
+        self.nodes          = 0
+        self.evaluated      = 0
+        self.best           = -np.inf
+        self.found          = []
+
+    def feasible(self, bounds):
+        '''True where the bounds of each metric overlap the constraints'''
+
+        ok = True
+        for metric, (lower, upper) in self.constraints.items():
+            low, high = bounds[metric]
+            if lower is not None:
+                ok = ok & (high >= lower)
+            if upper is not None:
+                ok = ok & (low <= upper)
+        return(ok)
+
+    def bound(self, family, tests, open_axes):
+        '''Bounds every metric over the completions of partial choices
+
+        Inputs
+        tests           : List          : (sens, spec, cost, wait) of the
+                                          chosen tests on each chosen axis
+        open_axes       : List          : (sens, spec, cost, wait) arrays of
+                                          the tests of each open axis
+
+        Output
+        bounds          : Dictionary    : metric -> widened (lower, upper)
+        '''
+
+        low     = [tuple(x.min() for x in test) for test in open_axes]
+        high    = [tuple(x.max() for x in test) for test in open_axes]
+        span    = [tuple(Interval(a, b) for a, b in zip(l, h)) for l, h in zip(low, high)]
+        sens_low, spec_low      = apply_family(family, tests + low)[:2]
+        sens_high, spec_high    = apply_family(family, tests + high)[:2]
+        bounds  = {'sens' : widen(sens_low, sens_high),
+                   'spec' : widen(spec_low, spec_high)}
+        for metric, value in zip(COLUMNS[2:-1], apply_family(family, tests + span)[2:]):
+            bounds[metric] = widen(Interval.of(value).low, Interval.of(value).high)
+        return(bounds)
+
+    def optimistic(self, bounds):
+        '''Best objective any completion can reach, larger is better'''
+
+        low, high = bounds[self.objective]
+        return(high if self.sign > 0 else -low)
+
+    def solve(self):
+        '''Runs the search
+
+        Output
+        output          : Pandas Dataframe : every optimal algorithm (ties
+                                             included) with the COLUMNS, in
+                                             the order of evaluate_families
+        '''
+
+        self.best   = -np.inf
+        self.found  = []
+        for number, family in enumerate(self.families):
+            self.search(number, family)
+        return(self.frame())
+
+    def search(self, number, family):
+        labels  = FAMILIES[family][2]
+        arrays  = [phase_arrays(self.phases[label], label) for label in labels]
+        axes    = [test[:4] for test in arrays]
+        shape   = tuple(len(test[0]) for test in axes)
+        cubes   = compile_rules([names for _, _, _, _, names in arrays], self.rules)
+        if not all(shape):
+            return
+
+        stack   = [()]
+        while stack:
+            chosen  = stack.pop()
+            depth   = len(chosen)
+            if int(np.prod(shape[depth:])) <= self.leaf_size:
+                self.leaf(number, family, axes, shape, cubes, chosen)
+                continue
+
+            ## Bound every choice of the next axis at once
+            self.nodes  += shape[depth]
+            tests       = [tuple(x[i] for x in axes[axis]) for axis, i in enumerate(chosen)]
+            tests.append(axes[depth])
+            bounds      = self.bound(family, tests, axes[depth + 1:])
+            hope        = np.broadcast_to(self.optimistic(bounds), (shape[depth],))
+            keep        = (np.broadcast_to(self.feasible(bounds), (shape[depth],))
+                           & (hope >= self.best))
+            keep        = keep & ~self.conflicts(cubes, chosen, depth, shape[depth])
+            ## Most promising choice last, so it is searched first
+            for i in np.flatnonzero(keep)[np.argsort(hope[keep], kind = 'stable')]:
+                stack.append(chosen + (int(i),))
+
+    def conflicts(self, cubes, chosen, depth, size):
+        '''Choices of axis depth that break a rule whatever the open axes hold'''
+
+        conflict = np.zeros(size, dtype = bool)
+        for cube in cubes:
+            if max(cube) > depth:
+                continue
+            hit = True
+            for axis, mask in cube.items():
+                hit = hit & (mask if axis == depth else mask[chosen[axis]])
+            conflict = conflict | hit
+        return(conflict)
+
+    def leaf(self, number, family, axes, shape, cubes, chosen):
+        '''Evaluates every completion of a partial choice exactly'''
+
+        depth   = len(chosen)
+        ndim    = len(shape) - depth
+        tests   = [tuple(x[i] for x in axes[axis]) for axis, i in enumerate(chosen)]
+        tests  += [tuple(axis_view(x, axis, ndim) for x in axes[depth + axis])
+                   for axis in range(ndim)]
+        size    = shape[depth:]
+        values  = dict(zip(COLUMNS, [np.broadcast_to(x, size).ravel()
+                                     for x in apply_family(family, tests)]))
+        self.evaluated += len(values['sens'])
+
+        keep    = np.ones(size, dtype = bool)
+        for cube in cubes:
+            hit = np.ones([1] * ndim, dtype = bool)
+            for axis, mask in cube.items():
+                if axis < depth:
+                    hit = hit & mask[chosen[axis]]
+                else:
+                    hit = hit & axis_view(mask, axis - depth, ndim)
+            keep &= ~hit
+        keep    = keep.ravel()
+        for metric, (lower, upper) in self.constraints.items():
+            if lower is not None:
+                keep &= values[metric] >= lower
+            if upper is not None:
+                keep &= values[metric] <= upper
+        if not keep.any():
+            return
+
+        score   = self.sign * values[self.objective][keep]
+        top     = score.max()
+        if top < self.best:
+            return
+        if top > self.best:
+            self.best, self.found = top, []
+        rows    = np.flatnonzero(keep)[score == top]
+        index   = np.unravel_index(rows, size) if ndim else ()
+        flat    = np.ravel_multi_index(tuple(np.full(len(rows), i) for i in chosen)
+                                       + index, shape)
+        self.found.append((number, flat, {metric : values[metric][rows]
+                                          for metric in COLUMNS[:-1]}))
+
+    def frame(self):
+        '''The optimal algorithms found, in the order of evaluate_families'''
+
+        frames = []
+        for number, flat, values in sorted(self.found, key = lambda found: found[0]):
+            family  = self.families[number]
+            labels  = FAMILIES[family][2]
+            arrays  = [phase_arrays(self.phases[label], label) for label in labels]
+            index   = np.unravel_index(flat, tuple(len(sens) for sens, _, _, _, _ in arrays))
+            name    = np.full(len(flat), '', dtype = object)
+            for (_, _, _, _, names), position in zip(arrays, index):
+                if names is not None:
+                    name = name + names[position] + ' '
+            frame   = pd.DataFrame(dict(values, Algorithm = name + family))
+            frames.append(frame.assign(family = number, flat = flat))
+        if not frames:
+            return(pd.DataFrame({column : [] for column in COLUMNS}))
+        ## Several leaves of one family can tie, so sort within each family
+        output = pd.concat(frames, ignore_index = True)
+        output = output.sort_values(['family', 'flat'], kind = 'stable')
+        return(output[COLUMNS].reset_index(drop = True))
+
+def optimize(phases, objective = 'sens', constraints = None, families = None,
+             rules = None):
+    '''Returns every algorithm that optimises objective subject to the
+    constraints (see BranchAndBound), e.g.
+
+        optimize(phases, 'sens', {'spec' : (0.999, None), 'cost-1' : (None, 5)})
+    '''
+
+    return(BranchAndBound(phases, objective, constraints, families, rules).solve())
+
+def brute_force(phases, objective = 'sens', constraints = None, families = None,
+                rules = None):
+    '''The same answer as optimize, found by evaluating every combination'''
+
+    output  = evaluate_families(phases, families, rules)
+    keep    = np.ones(len(output), dtype = bool)
+    for metric, (lower, upper) in (constraints or {}).items():
+        if lower is not None:
+            keep &= output[metric].to_numpy() >= lower
+        if upper is not None:
+            keep &= output[metric].to_numpy() <= upper
+    if not keep.any():
+        return(pd.DataFrame({column : [] for column in COLUMNS}))
+    score   = output[objective].to_numpy()
+    best    = score[keep].max() if OBJECTIVES[objective] == 'max' else score[keep].min()
+    return(output[keep & (score == best)].reset_index(drop = True))
@@ -0,0 +1,169 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import SensSpecCostCalculator
+from SensSpecCostCalculator import (FAMILIES, Phase, TestCatalog, family_shape,
+                                    evaluate_shard)
+
+
+#### This code spreads the evaluation of the families over several processes.
+#### The combinations of a family are numbered 0 .. N-1 (the flat number is
+#### decoded in mixed radix by decode_combinations) and cut into contiguous
+#### shards, so no process ever builds the list of combinations. Every worker
+#### reads the test arrays from one block of shared memory, and the shards are
+#### merged back in order, so the result equals the single process one.
+
+## Set by attach() in each worker process
+WORKER_PHASES       = None
+WORKER_MEMORY       = None
+WORKER_RULES        = None
+WORKER_PREVALENCES  = None
+
+###############################################################################
+############## Code Section One - Shared catalog ##############################
+###############################################################################
+
+def share_phases(phases):
+    '''Copies the float arrays of the test phases into one shared memory block
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+
+    Output
+    shared          : SharedMemory  : the block, to be closed and unlinked by
+                                      the caller
+    layout          : Dictionary    : phase letter -> (ids, name table, offset
+                                      of each field in the block)
+    fixed           : Dictionary    : the phases that are not tests (A and G),
+                                      which are small and sent as they are
+    '''
+
+    tests   = {}
+    fixed   = {}
+    for label, phase in phases.items():
+        if label in 'AG':
+            fixed[label] = phase
+        elif isinstance(phase, pd.DataFrame):
+            tests[label] = TestCatalog(phase, percent = False).tests
+        else:
+            tests[label] = phase
+
+    size    = sum(len(phase) * len(Phase.FIELDS) for phase in tests.values())
+    shared  = shared_memory.SharedMemory(create = True, size = max(size, 1) * 8)
+    buffer  = np.ndarray((size,), dtype = float, buffer = shared.buf)
+    layout  = {}
+    offset  = 0
+    for label, phase in tests.items():
+        offsets = {}
+        for field in Phase.FIELDS:
+            buffer[offset:offset + len(phase)] = getattr(phase, field)
+            offsets[field] = offset
+            offset += len(phase)
+        layout[label] = (phase.ids, phase.table, offsets)
+    return(shared, layout, fixed)
+
+def attach(name, layout, fixed, rules = None, prevalences = None):
+    '''Initialiser of the worker processes: builds the phases on top of the
+    shared memory block without copying it'''
+
+    global WORKER_PHASES, WORKER_MEMORY, WORKER_RULES, WORKER_PREVALENCES
+    WORKER_RULES        = rules
+    WORKER_PREVALENCES  = prevalences
+    WORKER_MEMORY       = shared_memory.SharedMemory(name = name)
+    size                = WORKER_MEMORY.size // 8
+    buffer              = np.ndarray((size,), dtype = float, buffer = WORKER_MEMORY.buf)
+    WORKER_PHASES       = dict(fixed)
+    for label, (ids, table, offsets) in layout.items():
+        WORKER_PHASES[label] = Phase(ids, table,
+                                     **{field : buffer[offset:offset + len(ids)]
+                                        for field, offset in offsets.items()})
+
+def run_shard(task):
+    '''Evaluates one shard (family, start, stop) in a worker process'''
+
+    family, start, stop = task
+    return(evaluate_shard(family, WORKER_PHASES, start, stop, WORKER_RULES,
+                          WORKER_PREVALENCES))
+
+###############################################################################
+############## Code Section Two - Sharded runs ################################
+###############################################################################
+
+def shard_tasks(phases, families, shard_size):
+    '''Cuts the combinations of each family into contiguous shards
+
+    Output
+    tasks           : List          : (family, start, stop) in result order
+    '''
+
+    tasks = []
+    for family in families:
+        total = int(np.prod(family_shape(family, phases)))
+        for start in range(0, total, shard_size):
+            tasks.append((family, start, min(start + shard_size, total)))
+    return(tasks)
+
+def iter_sharded(phases, families = None, workers = None, shard_size = 2 ** 16,
+                 rules = None, window = None, prevalences = None):
+    '''Evaluates families on a pool of processes and yields the shards in
+    order, so the caller can consume them (e.g. with a ParetoFront) without
+    holding every result
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    workers         : Integer       : number of processes, all cores by default
+    shard_size      : Integer       : combinations per task
+    rules           : List          : rules to apply, RULES of the parent
+                                      process by default
+    window          : Integer       : shards submitted but not yet yielded,
+                                      2 * workers by default. Memory is
+                                      bounded by window shards, whatever the
+                                      size of the run.
+    prevalences     : List          : also give PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
+
+    Output
+    chunks          : Generator     : one Dataframe per shard
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    rules       = SensSpecCostCalculator.RULES if rules is None else rules
+    tasks       = shard_tasks(phases, families, shard_size)
+    workers     = os.cpu_count() if workers is None else workers
+    window      = 2 * workers if window is None else max(1, window)
+    shared, layout, fixed = share_phases(phases)
+    try:
+        with ProcessPoolExecutor(workers, initializer = attach,
+                                 initargs = (shared.name, layout, fixed, rules,
+                                             prevalences)) as pool:
+            ## Futures in task order: a new shard is only submitted once the
+            ## oldest one has been handed to the caller
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= window:
+                    yield(pending.popleft().result())
+                pending.append(pool.submit(run_shard, task))
+            while pending:
+                yield(pending.popleft().result())
+    finally:
+        shared.close()
+        shared.unlink()
+
+def run_sharded(phases, families = None, workers = None, shard_size = 2 ** 16,
+                rules = None, prevalences = None):
+    '''Evaluates families on a pool of processes. The result equals
+    evaluate_family of each family concatenated in the order of families.'''
+
+    chunks = list(iter_sharded(phases, families, workers, shard_size, rules,
+                               prevalences = prevalences))
+    if not chunks:
+        return(pd.DataFrame())
+    return(pd.concat(chunks, ignore_index = True))
@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, SubexpressionCache, evaluate_family,
+                                    prevalence_column)
+
+
+#### This code keeps the Pareto front (the set of non-dominated algorithms) of
+#### the results of SensSpecCostCalculator while they are produced. Results
+#### are fed in chunks, for example one family at a time, and only the
+#### current front is held in memory.
+
+## An algorithm dominates another if it is at least as good in every
+## objective and strictly better in at least one. Sensitivity and specificity
+## should be high and the costs and times low.
+
+## Column : 'max' or 'min'
+OBJECTIVES = {'sens' : 'max', 'spec' : 'max', 'cost-0' : 'min', 'cost-1' : 'min',
+              'time-0' : 'min', 'time-1' : 'min'}
+
+## The same at one prevalence (see SensSpecCostCalculator.PREVALENCE_METRICS),
+## for results evaluated with prevalences
+PREVALENCE_OBJECTIVES = {'ppv' : 'max', 'npv' : 'max', 'cost' : 'min',
+                         'cost-per-case' : 'min'}
+
+###############################################################################
+############## Code Section One - Dominance ###################################
+###############################################################################
+
+def orient(frame, objectives):
+    '''Returns the objective columns of a Dataframe as a float array in which
+    larger is always better (minimised columns are negated)
+
+    Inputs
+    frame           : Pandas Dataframe
+    objectives      : Dictionary    : column -> 'max' or 'min'
+
+    Output
+    values          : Numpy array   : shape (rows, objectives)
+    '''
+
+    values = np.empty((len(frame), len(objectives)))
+    for j, (column, sense) in enumerate(objectives.items()):
+        if sense not in ('max', 'min'):
+            raise ValueError('objective %r must be max or min, not %r' % (column, sense))
+        values[:, j] = frame[column].to_numpy(dtype = float)
+        if sense == 'min':
+            values[:, j] *= -1
+    return(values)
+
+def dominated_by(points, others, block = 512):
+    '''Finds the points that are dominated by at least one of the others
+
+    Inputs
+    points          : Numpy array   : shape (n, k), larger is better
+    others          : Numpy array   : shape (m, k), larger is better
+    block           : Integer       : rows of others compared at once, which
+                                      bounds the temporary arrays to n*block
+
+    Output
+    dominated       : Numpy array   : boolean, one entry per point
+    '''
+
+    dominated = np.zeros(len(points), dtype = bool)
+    for start in range(0, len(others), block):
+        other   = others[start:start + block]
+        ## Points already known to be dominated are not compared again
+        alive   = np.flatnonzero(~dominated)
+        if not len(alive):
+            break
+        point   = points[alive]
+        ## One objective at a time, which is much faster than reducing over
+        ## a short last axis of a three dimensional array
+        atleast = np.ones((len(point), len(other)), dtype = bool)
+        better  = np.zeros((len(point), len(other)), dtype = bool)
+        for j in range(points.shape[1]):
+            atleast &= other[None, :, j] >= point[:, j, None]
+            better  |= other[None, :, j] >  point[:, j, None]
+        dominated[alive] = (atleast & better).any(axis = 1)
+    return(dominated)
+
+def skyline(values, block = 512):
+    '''Returns the indices of the rows that no other row dominates.
+
+    The rows are visited in descending lexicographic order, in which a row can
+    only be dominated by rows visited before it. Each block of rows is checked
+    against the front found so far and against itself, so the front only ever
+    grows and no row is compared twice.
+
+    Inputs
+    values          : Numpy array   : shape (n, k), larger is better
+    block           : Integer       : rows handled at once
+
+    Output
+    index           : Numpy array   : sorted indices of the non-dominated rows
+    '''
+
+    values  = np.asarray(values, dtype = float)
+    order   = np.lexsort(-values[:, ::-1].T)
+    front   = []
+    kept    = values[:0]
+    for start in range(0, len(order), block):
+        index   = order[start:start + block]
+        block_  = values[index]
+        alive   = ~dominated_by(block_, kept, block)
+        index, block_ = index[alive], block_[alive]
+        alive   = ~dominated_by(block_, block_, block)
+        front.append(index[alive])
+        kept    = np.concatenate([kept, block_[alive]])
+    if not front:
+        return(np.zeros(0, dtype = np.intp))
+    return(np.sort(np.concatenate(front)))
+
+###############################################################################
+############## Code Section Two - Streaming front #############################
+###############################################################################
+
+class ParetoFront(object):
+    '''The Pareto front of a stream of result chunks.
+
+    Each chunk is first checked against the current front, which usually
+    discards most of it, and the survivors are merged with the front. Memory
+    is bounded by the size of the front plus one chunk.
+
+    Inputs
+    objectives      : Dictionary    : column -> 'max' or 'min', OBJECTIVES by
+                                      default
+    block           : Integer       : rows compared at once in the dominance
+                                      checks
+
+    Attributes
+    frame           : Pandas Dataframe : the rows of the current front
+    values          : Numpy array   : their objectives, larger is better
+    '''
+
+    def __init__(self, objectives = None, block = 512):
+        self.objectives = dict(OBJECTIVES if objectives is None else objectives)
+        self.block      = block
+        self.frame      = None
+        self.values     = np.zeros((0, len(self.objectives)))
+
+    def __len__(self):
+        return(len(self.values))
+
+    def update(self, chunk):
+        '''Merges one chunk of results (a Dataframe with the objective
+        columns) into the front and returns the front'''
+
+        values  = orient(chunk, self.objectives)
+        alive   = ~dominated_by(values, self.values, self.block)
+        if not alive.any():
+            return(self)
+        chunk   = chunk[alive]
+        values  = values[alive]
+        if self.frame is not None:
+            chunk   = pd.concat([self.frame, chunk], ignore_index = True)
+            values  = np.concatenate([self.values, values])
+        keep        = skyline(values, self.block)
+        self.frame  = chunk.iloc[keep].reset_index(drop = True)
+        self.values = values[keep]
+        return(self)
+
+    def extend(self, chunks):
+        '''Merges every chunk of an iterable into the front'''
+
+        for chunk in chunks:
+            self.update(chunk)
+        return(self)
+
+    def dominates(self, chunk):
+        '''Returns a boolean array that is True for the rows of chunk that are
+        dominated by the current front'''
+
+        return(dominated_by(orient(chunk, self.objectives), self.values, self.block))
+
+def prevalence_objectives(prevalence, metrics = None):
+    '''Objectives at one prevalence, e.g. {'ppv@0.01' : 'max', ...}
+
+    Inputs
+    prevalence      : Float         : one of the prevalences of the results
+    metrics         : List          : keys of PREVALENCE_OBJECTIVES, all by
+                                      default
+    '''
+
+    metrics = list(PREVALENCE_OBJECTIVES) if metrics is None else metrics
+    return({prevalence_column(metric, prevalence) : PREVALENCE_OBJECTIVES[metric]
+            for metric in metrics})
+
+def pareto_front(chunks, objectives = None):
+    '''Returns the Pareto front of an iterable of result chunks as a Dataframe'''
+
+    front = ParetoFront(objectives).extend(chunks)
+    if front.frame is None:
+        return(pd.DataFrame())
+    return(front.frame)
+
+def family_front(phases, families = None, objectives = None, rules = None,
+                 prevalence = None):
+    '''Evaluates families of SensSpecCostCalculator one at a time and keeps
+    only their joint Pareto front
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    families        : List          : family codes, every family by default
+    objectives      : Dictionary    : column -> 'max' or 'min'
+    rules           : List          : rules to apply, RULES by default
+    prevalence      : Float         : evaluate the prevalence metrics at this
+                                      prevalence, whose prevalence_objectives
+                                      are then the default objectives
+
+    Output
+    front           : Pandas Dataframe : the non-dominated algorithms
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    cache       = SubexpressionCache()
+    prevalences = None
+    if prevalence is not None:
+        prevalences = [prevalence]
+        objectives  = prevalence_objectives(prevalence) if objectives is None else objectives
+    return(pareto_front((evaluate_family(family, phases, rules, cache,
+                                         prevalences = prevalences)
+                         for family in families), objectives))
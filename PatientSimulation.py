@@ -0,0 +1,225 @@
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, phase_arrays, family_index,
+                                    evaluate_family, compile_rules, conflict_mask)
+from AlgorithmCompiler import TOPOLOGIES, parse
+
+
+#### This code checks the closed form results of SensSpecCostCalculator by
+#### simulation. Large cohorts of patients with and without HAT are drawn,
+#### every test result is drawn from the sensitivity and specificity of the
+#### test, and the patients are routed through the tree of each algorithm
+#### with boolean array operations. The share of positives and the mean cost
+#### and time per patient then estimate sens, spec, cost-0/1 and time-0/1,
+#### and any formula that disagrees by more than the Monte Carlo error is
+#### flagged.
+
+## The tree of a family is its expression in AlgorithmCompiler.TOPOLOGIES,
+## which is what the formulas are meant to compute. Test results are
+## independent given the disease status, as CAS and COS assume.
+##
+## Every algorithm of a family sees the same patients and the same uniform
+## draw per patient and test (common random numbers): a test is positive for
+## a patient with HAT when the draw is below its sensitivity, and for one
+## without HAT when it is below 1 - specificity. A test is only paid for and
+## waited on when the patient reaches it.
+
+## Uniform draws are float32, and so are the thresholds they are compared with
+DRAW_TYPE = np.float32
+
+## Rough number of bytes per (algorithm, patient) while a block is routed
+ROUTE_BYTES = 24
+
+###############################################################################
+############## Code Section One - Routing #####################################
+###############################################################################
+
+def route(tree, thresholds, draws, costs, waits):
+    '''Routes one cohort of patients through a tree
+
+    Inputs
+    tree            : Tuple         : output of AlgorithmCompiler.parse
+    thresholds      : Dictionary    : test -> (algorithms, 1) probability of a
+                                      positive result in this cohort
+    draws           : Dictionary    : test -> (patients,) uniform draws
+    costs, waits    : Dictionary    : test -> (algorithms, 1) cost and wait
+
+    Output
+    positive        : Numpy array   : (algorithms, patients) boolean result
+    cost, time      : Numpy array   : (algorithms, patients) float32 spent on
+                                      each patient
+    '''
+
+    shape   = (len(next(iter(thresholds.values()))), len(next(iter(draws.values()))))
+    cost    = np.zeros(shape, dtype = np.float32)
+    time    = np.zeros(shape, dtype = np.float32)
+
+    def walk(node, reached):
+        if node[0] == 'test':
+            test = node[1]
+            if costs[test].any():
+                cost[...] += reached * costs[test]
+            if waits[test].any():
+                time[...] += reached * waits[test]
+            return(reached & (draws[test] < thresholds[test]))
+        first = walk(node[1], reached)
+        if node[0] == 'and':
+            return(walk(node[2], first))
+        return(first | walk(node[2], reached & ~first))
+
+    positive = walk(tree, np.ones(shape, dtype = bool))
+    return(positive, cost, time)
+
+def simulate_algorithms(tree, tests, patients = 10 ** 6, rng = None, block = 2 ** 14,
+                        memory = 2 ** 28):
+    '''Estimates the metrics of many algorithms of one tree by simulation
+
+    Inputs
+    tree            : Tuple         : output of AlgorithmCompiler.parse
+    tests           : Dictionary    : test -> (sens, spec, cost, wait) arrays
+                                      with one entry per algorithm
+    patients        : Integer       : patients in each cohort (with and
+                                      without HAT)
+    block           : Integer       : patients routed at once
+    memory          : Integer       : rough cap on the working memory in bytes
+
+    Output
+    estimates       : Dictionary    : metric (COLUMNS) -> (mean, standard
+                                      error) arrays, one entry per algorithm
+    '''
+
+    rng         = np.random.default_rng() if rng is None else rng
+    count       = len(next(iter(tests.values()))[0])
+    chunk       = max(1, int(memory // (block * ROUTE_BYTES)))
+    ## Cohort 1 has HAT (positive with the sensitivity), cohort 0 does not
+    sums        = {cohort : {name : np.zeros(count) for name in
+                             ('positive', 'cost', 'cost2', 'time', 'time2')}
+                   for cohort in (0, 1)}
+    for start in range(0, patients, block):
+        size = min(block, patients - start)
+        for cohort in (0, 1):
+            draws = {test : rng.random(size, dtype = DRAW_TYPE) for test in tests}
+            for first in range(0, count, chunk):
+                rows        = slice(first, first + chunk)
+                thresholds  = {test : np.asarray(sens[rows] if cohort else 1 - spec[rows],
+                                                 dtype = DRAW_TYPE)[:, None]
+                               for test, (sens, spec, _, _) in tests.items()}
+                costs       = {test : np.asarray(cost[rows], dtype = DRAW_TYPE)[:, None]
+                               for test, (_, _, cost, _) in tests.items()}
+                waits       = {test : np.asarray(wait[rows], dtype = DRAW_TYPE)[:, None]
+                               for test, (_, _, _, wait) in tests.items()}
+                positive, cost, time = route(tree, thresholds, draws, costs, waits)
+                total       = sums[cohort]
+                total['positive'][rows] += np.count_nonzero(positive, axis = 1)
+                total['cost'][rows]     += cost.sum(axis = 1, dtype = float)
+                total['cost2'][rows]    += np.square(cost, dtype = float).sum(axis = 1)
+                total['time'][rows]     += time.sum(axis = 1, dtype = float)
+                total['time2'][rows]    += np.square(time, dtype = float).sum(axis = 1)
+
+    def proportion(positive):
+        p = positive / patients
+        return(p, np.sqrt(p * (1 - p) / patients))
+
+    def mean(total, squares):
+        m = total / patients
+        return(m, np.sqrt(np.maximum(squares / patients - m ** 2, 0) / patients))
+
+    sens, sens_error = proportion(sums[1]['positive'])
+    fall, spec_error = proportion(sums[0]['positive'])
+    return({'sens'      : (sens, sens_error),
+            'spec'      : (1 - fall, spec_error),
+            'cost-0'    : mean(sums[0]['cost'], sums[0]['cost2']),
+            'cost-1'    : mean(sums[1]['cost'], sums[1]['cost2']),
+            'time-0'    : mean(sums[0]['time'], sums[0]['time2']),
+            'time-1'    : mean(sums[1]['time'], sums[1]['time2'])})
+
+###############################################################################
+############## Code Section Two - Validation ##################################
+###############################################################################
+
+def compare(frame, estimates, patients, threshold):
+    '''Puts the closed form results and the estimates side by side
+
+    Output
+    report          : Pandas Dataframe : Algorithm, and for each metric the
+                                         _formula and _simulated values and
+                                         the _z score of their difference,
+                                         and consistent (every |z| at most
+                                         threshold)
+    '''
+
+    report      = {'Algorithm' : frame['Algorithm'].to_numpy()}
+    consistent  = np.ones(len(frame), dtype = bool)
+    for metric in COLUMNS[:-1]:
+        formula         = frame[metric].to_numpy()
+        value, error    = estimates[metric]
+        ## A metric that never varies has no error, allow one patient's worth
+        z               = (formula - value) / np.maximum(error, 1 / patients)
+        report[metric + '_formula']     = formula
+        report[metric + '_simulated']   = value
+        report[metric + '_z']           = z
+        consistent     &= np.abs(z) <= threshold
+    report['consistent'] = consistent
+    return(pd.DataFrame(report))
+
+def validate_family(family, phases, patients = 10 ** 6, threshold = 6, rules = None,
+                    rng = None, memory = 2 ** 28):
+    '''Checks the formulas of one family against a simulation of its tree in
+    TOPOLOGIES, see compare'''
+
+    labels  = FAMILIES[family][2]
+    index   = family_index(family, phases, rules)
+    tests   = {}
+    for label, position in zip(labels, index):
+        sens, spec, cost, wait, _ = phase_arrays(phases[label], label)
+        tests[label] = (sens[position], spec[position], cost[position], wait[position])
+    frame   = evaluate_family(family, phases, rules)
+    if not len(frame):
+        return(compare(frame, {metric : (np.zeros(0), np.zeros(0))
+                               for metric in COLUMNS[:-1]}, patients, threshold))
+    estimates = simulate_algorithms(parse(TOPOLOGIES[family]), tests, patients, rng,
+                                    memory = memory)
+    return(compare(frame, estimates, patients, threshold))
+
+def validate_families(phases, families = None, patients = 10 ** 6, threshold = 6,
+                      rules = None, seed = None, memory = 2 ** 28):
+    '''Checks every closed form result of several families (every family by
+    default), see validate_family'''
+
+    families    = list(FAMILIES) if families is None else families
+    rng         = np.random.default_rng(seed)
+    return(pd.concat([validate_family(family, phases, patients, threshold, rules, rng,
+                                      memory) for family in families],
+                     ignore_index = True))
+
+def validate_topology(topology, phases, patients = 10 ** 6, threshold = 6, rules = None,
+                      seed = None, memory = 2 ** 28):
+    '''The same as validate_family for an AlgorithmCompiler.Topology, which
+    checks the compiled kernel'''
+
+    frame   = topology.evaluate(phases, rules)
+    arrays  = [phase_arrays(phases[test], test) for test in topology.tests]
+    shape   = tuple(len(test[0]) for test in arrays)
+    ## The rows of evaluate are the feasible grid positions in grid order
+    cubes   = compile_rules([test[4] for test in arrays], rules)
+    index   = np.unravel_index(np.flatnonzero(~conflict_mask(cubes, shape)), shape)
+    tests   = {test : tuple(x[position] for x in values[:4])
+               for test, values, position in zip(topology.tests, arrays, index)}
+    estimates = simulate_algorithms(topology.tree, tests, patients,
+                                    np.random.default_rng(seed), memory = memory)
+    return(compare(frame, estimates, patients, threshold))
+
+def summary(report, threshold = 6):
+    '''Number of algorithms of each family whose formula for a metric is off
+    by more than threshold standard errors
+
+    Inputs
+    report          : Pandas Dataframe : output of validate_families
+    '''
+
+    flagged = pd.DataFrame({metric : report[metric + '_z'].abs() > threshold
+                            for metric in COLUMNS[:-1]})
+    flagged['algorithms'] = 1
+    family  = report['Algorithm'].str.rsplit(n = 1).str[-1].rename('family')
+    return(flagged.groupby(family, sort = False).sum())
@@ -0,0 +1,170 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
+#### This code answers ranking queries such as "the 20 cheapest algorithms
+#### with sensitivity above 0.9" or "the top 50 by Youden index per family"
+#### over a stream of result chunks (iter_families, iter_sharded, ...). Each
+#### query keeps a heap of at most k rows per group, so the full result table
+#### is never held or sorted, and any number of queries share one pass.
+
+## Queries are written as pandas expressions over the columns of the chunks.
+## Column names that are not valid Python names are written with '_' for '-'
+## and '.', and '_at_' for '@' (cost-0 is cost_0 and ppv@0.01, the PPV at a
+## prevalence of 0.01, is ppv_at_0_01), e.g.  'sens + spec - 1'  or
+## 'cost_1 / sens'  or  'cost_per_case_at_0_01'.
+##
+## Ties are broken by arrival order, so a query returns the same rows as
+## sorting the whole (filtered) table with a stable sort and taking the first
+## k rows of each group.
+
+YOUDEN = 'sens + spec - 1'
+
+###############################################################################
+############## Code Section One - Queries #####################################
+###############################################################################
+
+def evaluate(frame, expression):
+    '''Evaluates an expression (or a function of the frame) on every row'''
+
+    if callable(expression):
+        return(np.asarray(expression(frame)))
+    if expression in frame.columns:
+        return(frame[expression].to_numpy())
+    renamed = frame.rename(columns = lambda column: str(column).replace('-', '_')
+                           .replace('.', '_').replace('@', '_at_'))
+    return(np.asarray(renamed.eval(expression)))
+
+class TopK(object):
+    '''The k best rows of a stream by an expression
+
+    Inputs
+    by              : String/Function : expression to rank by, e.g. 'time-1'
+                                        or YOUDEN
+    k               : Integer       : rows kept per group
+    ascending       : Boolean       : True to keep the smallest values
+    where           : String/Function : optional filter, e.g. 'sens > 0.9'
+    per             : String/Function : optional grouping, 'family' for one
+                                        ranking per family (the family column
+                                        or the last word of the Algorithm
+                                        name) or an expression
+    name            : String        : used in reports, by by default
+
+    Attributes
+    seen            : Integer       : rows that passed the filter
+    arrivals        : Integer       : rows offered so far
+    '''
+
+    def __init__(self, by, k = 20, ascending = False, where = None, per = None,
+                 name = None):
+        if k < 1:
+            raise ValueError('k must be at least 1, not %r' % k)
+        self.by         = by
+        self.k          = k
+        self.ascending  = ascending
+        self.where      = where
+        self.per        = per
+        self.name       = name if name is not None else str(by)
+        self.heaps      = {}
+        self.columns    = None
+        self.seen       = 0
+        self.arrivals   = 0
+
+    def __repr__(self):
+        return('TopK(%r, k=%d)' % (self.name, self.k))
+
+    def groups(self, chunk):
+        if self.per is None:
+            return(np.zeros(len(chunk), dtype = np.intp))
+        if self.per == 'family' and 'family' in chunk:
+            ## Compact results (CompactResults) carry the family as a column
+            return(chunk['family'].to_numpy())
+        if self.per == 'family':
+            return(chunk['Algorithm'].str.rsplit(n = 1).str[-1].to_numpy())
+        return(evaluate(chunk, self.per))
+
+    def update(self, chunk):
+        '''Offers the rows of one chunk to the heaps'''
+
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        score   = np.asarray(evaluate(chunk, self.by), dtype = float)
+        keep    = ~np.isnan(score)
+        if self.where is not None:
+            keep &= np.asarray(evaluate(chunk, self.where), dtype = bool)
+        rows    = np.flatnonzero(keep)
+        self.seen += len(rows)
+        if not len(rows):
+            self.arrivals += len(chunk)
+            return(self)
+        ## The heaps hold (score, -arrival), smallest (worst) first
+        score   = score if not self.ascending else -score
+        groups  = self.groups(chunk)[rows]
+        arrays  = [chunk[column].to_numpy() for column in self.columns]
+        for group in pd.unique(groups):
+            members = rows[groups == group]
+            heap    = self.heaps.setdefault(group, [])
+            values  = score[members]
+            if len(heap) == self.k:
+                ## Later rows only get in by being strictly better
+                better  = values > heap[0][0]
+                members = members[better]
+                values  = values[better]
+            if len(members) > self.k:
+                best    = np.lexsort((members, -values))[:self.k]
+                members = members[best]
+                values  = values[best]
+            for row, value in zip(members, values):
+                item = (value, -(self.arrivals + row),
+                        tuple(column[row] for column in arrays))
+                if len(heap) < self.k:
+                    heapq.heappush(heap, item)
+                elif item[:2] > heap[0][:2]:
+                    heapq.heapreplace(heap, item)
+        self.arrivals += len(chunk)
+        return(self)
+
+    def extend(self, chunks):
+        '''Offers every chunk of an iterable to the heaps'''
+
+        for chunk in chunks:
+            self.update(chunk)
+        return(self)
+
+    @property
+    def frame(self):
+        '''The rows kept, best first within each group, groups in the order
+        they first appeared'''
+
+        rows = []
+        for heap in self.heaps.values():
+            rows.extend(item[2] for item in sorted(heap, reverse = True))
+        frame = pd.DataFrame(rows, columns = self.columns)
+        return(frame.infer_objects())
+
+def run_queries(chunks, queries):
+    '''Feeds every chunk of a stream to every query in a single pass
+
+    Inputs
+    chunks          : Iterable      : result Dataframes
+    queries         : List          : TopK queries (or a dictionary of them)
+
+    Output
+    results         : List/Dictionary : the frame of each query
+    '''
+
+    named   = isinstance(queries, dict)
+    members = list(queries.values()) if named else list(queries)
+    for chunk in chunks:
+        for query in members:
+            query.update(chunk)
+    if named:
+        return({name : query.frame for name, query in queries.items()})
+    return([query.frame for query in members])
+
+def top_k(chunks, by, k = 20, ascending = False, where = None, per = None):
+    '''Returns the k best rows of a stream, see TopK'''
+
+    return(TopK(by, k, ascending, where, per).extend(chunks).frame)
@@ -0,0 +1,218 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+import SensSpecCostCalculator
+from SensSpecCostCalculator import (COLUMNS, FAMILIES, FAMILY_TREES, phase_arrays,
+                                    evaluate_family, tree_times, SubexpressionCache)
+
+
+#### This code keeps the results of SensSpecCostCalculator on disk, so a rerun
+#### with an unchanged catalog, scenario and algorithm loads them instead of
+#### evaluating them again. An entry is addressed by a hash of everything the
+#### result depends on: the values and names of the tests of each phase, the
+#### values of A and G, the formulas and tree of a family (or the expression
+#### of a compiled topology) and the rules. Anything else, for example an
+#### edit to an unused row of algorithmcsv.csv, leaves the entry valid.
+
+## Layout of an entry, <directory>/<key>/
+##
+## sens.npy, spec.npy, cost-0.npy, cost-1.npy   : float64 columns
+## time-0.npy, time-1.npy                       : float64 columns
+## Algorithm.arrow                              : names, as Arrow IPC when
+##                                                pyarrow is installed
+## Algorithm.npy                                : names, as fixed width
+##                                                unicode otherwise
+## meta.json                                    : what the entry holds
+##
+## Columns are reloaded with memory mapping, so a warm rerun reads only the
+## pages it touches and several processes (e.g. notebooks sharing one cache
+## directory) share the same pages. Entries are written to a temporary
+## directory first and renamed into place, so a reader never sees half of one.
+
+## Bumped whenever the layout of an entry, or the results it holds, change
+VERSION = 3
+
+###############################################################################
+############## Code Section One - Keys ########################################
+###############################################################################
+
+def topology_source(topology):
+    '''Returns the text that defines an algorithm: the source of the formulas
+    of a family code with its tree and the source of tree_times (which give
+    the times), or the expression of a compiled Topology'''
+
+    if isinstance(topology, str):
+        formula, cost_formula, labels = FAMILIES[topology]
+        return(labels + inspect.getsource(formula) + inspect.getsource(cost_formula)
+               + repr(FAMILY_TREES[topology]) + inspect.getsource(tree_times))
+    return(' '.join(topology.tests) + topology.source)
+
+def topology_labels(topology):
+    '''Returns the phase letters an algorithm uses, in order'''
+
+    if isinstance(topology, str):
+        return(FAMILIES[topology][2])
+    return(topology.tests)
+
+def result_key(topology, phases, rules = None):
+    '''Hashes everything a result depends on
+
+    Inputs
+    topology        : String/Topology : key of FAMILIES or a Topology of
+                                        AlgorithmCompiler
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family
+    rules           : List          : rules to apply, RULES by default
+
+    Output
+    key             : String        : hexadecimal SHA-256 digest
+    '''
+
+    rules   = SensSpecCostCalculator.RULES if rules is None else rules
+    digest  = hashlib.sha256()
+
+    def update(text):
+        digest.update(text.encode('utf-8') + b'\0')
+
+    update('version %d' % VERSION)
+    update(str(getattr(topology, 'code', topology)))
+    update(topology_source(topology))
+    update(repr(list(rules)))
+    for label in topology_labels(topology):
+        sens, spec, cost, wait, names = phase_arrays(phases[label], label)
+        update(label)
+        for values in (sens, spec, cost, wait):
+            values = np.ascontiguousarray(values, dtype = float)
+            update(str(values.shape))
+            digest.update(values.tobytes())
+        update('\0'.join(str(name) for name in names) if names is not None else '')
+    return(digest.hexdigest())
+
+###############################################################################
+############## Code Section Two - Cache directory #############################
+###############################################################################
+
+class ResultCache(object):
+    '''A directory of results addressed by result_key
+
+    Inputs
+    directory       : String        : created when it does not exist
+
+    Attributes
+    hits, misses    : Integer       : results loaded and computed by evaluate
+    '''
+
+    def __init__(self, directory):
+        self.directory  = directory
+        self.hits       = 0
+        self.misses     = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return(os.path.join(self.directory, key))
+
+    def __contains__(self, key):
+        return(os.path.exists(os.path.join(self.path(key), 'meta.json')))
+
+    def store(self, key, frame):
+        '''Writes a result (a Dataframe with the COLUMNS) under key'''
+
+        if key in self:
+            return
+        staging = tempfile.mkdtemp(prefix = '.' + key, dir = self.directory)
+        try:
+            for column in COLUMNS[:-1]:
+                np.save(os.path.join(staging, column + '.npy'),
+                        frame[column].to_numpy(dtype = float))
+            names = frame['Algorithm'].to_numpy(dtype = object)
+            if pa is not None:
+                table = pa.table({'Algorithm' : pa.array(names, type = pa.string())})
+                with pa.ipc.new_file(os.path.join(staging, 'Algorithm.arrow'),
+                                     table.schema) as writer:
+                    writer.write_table(table)
+            else:
+                np.save(os.path.join(staging, 'Algorithm.npy'), names.astype(str))
+            with open(os.path.join(staging, 'meta.json'), 'w') as meta:
+                json.dump({'version' : VERSION, 'rows' : len(frame)}, meta)
+            os.rename(staging, self.path(key))
+        except OSError:
+            ## Another process stored the same key first
+            shutil.rmtree(staging, ignore_errors = True)
+            if key not in self:
+                raise
+
+    def load(self, key):
+        '''Reloads a result with its columns memory mapped (read only)'''
+
+        path    = self.path(key)
+        columns = {column : np.load(os.path.join(path, column + '.npy'), mmap_mode = 'r')
+                   for column in COLUMNS[:-1]}
+        if os.path.exists(os.path.join(path, 'Algorithm.arrow')):
+            if pa is None:
+                raise ImportError('reading %s needs pyarrow' % path)
+            source  = pa.memory_map(os.path.join(path, 'Algorithm.arrow'))
+            columns['Algorithm'] = pa.ipc.open_file(source).read_all().column(0).to_pandas()
+        else:
+            names   = np.load(os.path.join(path, 'Algorithm.npy'), mmap_mode = 'r')
+            columns['Algorithm'] = pd.Series(names, dtype = str)
+        return(pd.DataFrame(columns, columns = COLUMNS, copy = False))
+
+    def evaluate(self, topology, phases, rules = None, cache = None):
+        '''Loads the result of an algorithm, or evaluates and stores it
+
+        Inputs
+        topology        : String/Topology : key of FAMILIES or a Topology
+        phases          : Dictionary    : phase letter -> phase
+        rules           : List          : rules to apply, RULES by default
+        cache           : SubexpressionCache : optional, used for families
+                                          that have to be evaluated
+
+        Output
+        output          : Pandas Dataframe : as evaluate_family
+        '''
+
+        key = result_key(topology, phases, rules)
+        if key in self:
+            self.hits += 1
+            return(self.load(key))
+        self.misses += 1
+        if isinstance(topology, str):
+            frame = evaluate_family(topology, phases, rules, cache)
+        else:
+            frame = topology.evaluate(phases, rules)
+        self.store(key, frame)
+        return(frame)
+
+    def clear(self):
+        '''Removes every entry'''
+
+        for entry in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, entry), ignore_errors = True)
+
+def cached_families(phases, directory, families = None, rules = None):
+    '''Evaluates families through a ResultCache in directory, computing only
+    the ones whose inputs changed
+
+    Output
+    output          : Pandas Dataframe : evaluate_family of each family
+                                         concatenated in the order of families
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    results     = ResultCache(directory)
+    cache       = SubexpressionCache()
+    return(pd.concat([results.evaluate(family, phases, rules, cache)
+                      for family in families], ignore_index = True))
@@ -0,0 +1,293 @@
+import os
+import json
+import heapq
+import shutil
+import tempfile
+
+import numpy as np
+
+
+#### This code indexes a result set (the output of evaluate_family,
+#### evaluate_families or a ResultCache entry) so that it can be filtered
+#### over and over without scanning it. Every numeric column is kept sorted,
+#### which answers range queries by bisection, and a k-d tree over the
+#### scaled metrics answers nearest neighbour queries ("the algorithms
+#### closest to sens 0.95, spec 0.99 and cost-1 2").
+
+## A range query bisects the sorted order of each bounded column, starts from
+## the column with the fewest matches and checks only those rows against the
+## other bounds, so it costs O(log n) plus the size of that smallest match.
+##
+## The metrics are on different scales (costs are not probabilities), so the
+## k-d tree works on the columns divided by a scale, their standard deviation
+## unless one is given.
+
+## Columns indexed by default
+METRICS = ['sens', 'spec', 'cost-0', 'cost-1', 'time-0', 'time-1']
+
+## Sub-directory of a ResultCache entry that holds its index
+INDEX = 'index'
+
+###############################################################################
+############## Code Section One - k-d tree ####################################
+###############################################################################
+
+class KDTree(object):
+    '''A k-d tree over the rows of a float array, held in flat arrays so it
+    can be saved and memory mapped
+
+    Inputs
+    points          : Numpy array   : shape (n, k)
+    leaf_size       : Integer       : most points in a leaf
+
+    Attributes
+    order           : Numpy array   : row of each position, leaves are
+                                      contiguous ranges of it
+    start, stop     : Numpy array   : range of order held by each node
+    left, right     : Numpy array   : children of each node, -1 for leaves
+    lower, upper    : Numpy array   : bounding box of each node, (nodes, k)
+    '''
+
+    FIELDS = ('order', 'start', 'stop', 'left', 'right', 'lower', 'upper')
+
+    def __init__(self, points = None, leaf_size = 32, **arrays):
+        if points is None:
+            for field in self.FIELDS:
+                setattr(self, field, arrays[field])
+            return
+        points  = np.asarray(points, dtype = float)
+        order   = np.arange(len(points))
+        nodes   = []
+        stack   = [(0, len(points), None, None)]
+        while stack:
+            start, stop, parent, side = stack.pop()
+            node    = len(nodes)
+            box     = points[order[start:stop]]
+            nodes.append([start, stop, -1, -1,
+                          box.min(axis = 0) if len(box) else np.zeros(points.shape[1]),
+                          box.max(axis = 0) if len(box) else np.zeros(points.shape[1])])
+            if parent is not None:
+                nodes[parent][side] = node
+            if stop - start <= leaf_size:
+                continue
+            ## Split the widest dimension at its median
+            dim     = int(np.argmax(nodes[node][5] - nodes[node][4]))
+            middle  = (stop - start) // 2
+            part    = np.argpartition(box[:, dim], middle, kind = 'introselect')
+            order[start:stop] = order[start:stop][part]
+            stack.append((start + middle, stop, node, 3))
+            stack.append((start, start + middle, node, 2))
+        self.order  = order
+        self.start  = np.array([node[0] for node in nodes], dtype = np.intp)
+        self.stop   = np.array([node[1] for node in nodes], dtype = np.intp)
+        self.left   = np.array([node[2] for node in nodes], dtype = np.intp)
+        self.right  = np.array([node[3] for node in nodes], dtype = np.intp)
+        self.lower  = np.array([node[4] for node in nodes], dtype = float).reshape(len(nodes), -1)
+        self.upper  = np.array([node[5] for node in nodes], dtype = float).reshape(len(nodes), -1)
+
+    def distance(self, node, point):
+        '''Distance from a point to the bounding box of a node'''
+
+        gap = np.maximum(self.lower[node] - point, 0) + np.maximum(point - self.upper[node], 0)
+        return(float(np.sqrt((gap ** 2).sum())))
+
+    def nearest(self, points, point, k = 1):
+        '''Returns the rows of the k points nearest to point and their
+        distances, nearest first (ties by row)
+
+        Inputs
+        points          : Numpy array   : the points the tree was built on
+        point           : Numpy array   : shape (k,)
+        '''
+
+        point   = np.asarray(point, dtype = float)
+        rows    = np.zeros(0, dtype = np.intp)
+        dists   = np.zeros(0)
+        if k < 1 or not len(self.order):
+            return(rows, dists)
+        queue   = [(self.distance(0, point), 0)]
+        while queue:
+            gap, node = heapq.heappop(queue)
+            if len(rows) == k and gap > dists[-1]:
+                break
+            if self.left[node] < 0:
+                members = self.order[self.start[node]:self.stop[node]]
+                found   = np.sqrt(((points[members] - point) ** 2).sum(axis = 1))
+                rows    = np.concatenate([rows, members])
+                dists   = np.concatenate([dists, found])
+                best    = np.lexsort((rows, dists))[:k]
+                rows, dists = rows[best], dists[best]
+                continue
+            for child in (self.left[node], self.right[node]):
+                heapq.heappush(queue, (self.distance(child, point), int(child)))
+        return(rows, dists)
+
+###############################################################################
+############## Code Section Two - Result store ################################
+###############################################################################
+
+class ResultStore(object):
+    '''An indexed result set
+
+    Inputs
+    frame           : Pandas Dataframe : results, e.g. from evaluate_families
+    columns         : List          : numeric columns to index, METRICS by
+                                      default
+    scale           : Dictionary    : column -> scale used by nearest, the
+                                      standard deviation by default
+
+    Attributes
+    sorted          : Dictionary    : column -> rows in increasing order
+    ordered         : Dictionary    : column -> its values in that order
+    tree            : KDTree        : over the scaled columns
+    '''
+
+    def __init__(self, frame, columns = None, scale = None, leaf_size = 32,
+                 index = None):
+        self.frame      = frame
+        self.columns    = list(METRICS if columns is None else columns)
+        self.values     = {column : frame[column].to_numpy(dtype = float)
+                           for column in self.columns}
+        self.scaled     = None
+        if index is not None:
+            self.sorted, self.ordered, self.scale, self.tree = index
+            return
+        self.sorted     = {column : np.argsort(values, kind = 'stable')
+                           for column, values in self.values.items()}
+        self.ordered    = {column : self.values[column][rows]
+                           for column, rows in self.sorted.items()}
+        if scale is None:
+            scale = {column : values.std() if len(values) else 1.0
+                     for column, values in self.values.items()}
+        self.scale      = {column : float(scale[column]) if scale[column] > 0 else 1.0
+                           for column in self.columns}
+        self.tree       = KDTree(self.points(), leaf_size)
+
+    def __len__(self):
+        return(len(self.frame))
+
+    def points(self):
+        '''The indexed columns divided by their scale, one row per result'''
+
+        if self.scaled is None:
+            self.scaled = np.stack([self.values[column] / self.scale[column]
+                                    for column in self.columns], axis = 1)
+        return(self.scaled)
+
+    def matches(self, bounds):
+        '''Returns the rows, in increasing order, whose columns lie inside
+        the bounds
+
+        Inputs
+        bounds          : Dictionary    : column -> (lower, upper), both
+                                          inclusive, None for an open end
+        '''
+
+        ranges = {}
+        for column, (lower, upper) in bounds.items():
+            if column not in self.sorted:
+                raise KeyError('column %r is not indexed' % column)
+            values  = self.ordered[column]
+            ## NaN (e.g. a ppv with a zero denominator) sorts after inf and
+            ## matches no bound, so an open upper end stops before it
+            upper   = np.inf if upper is None else upper
+            start   = 0 if lower is None else np.searchsorted(values, lower, 'left')
+            stop    = np.searchsorted(values, upper, 'right')
+            ranges[column] = (start, max(start, stop))
+        if not ranges:
+            return(np.arange(len(self.frame)))
+
+        ## Start from the narrowest range and check the rest on its rows
+        column  = min(ranges, key = lambda column: ranges[column][1] - ranges[column][0])
+        start, stop = ranges[column]
+        rows    = self.sorted[column][start:stop]
+        for other, (lower, upper) in bounds.items():
+            if other == column:
+                continue
+            values = self.values[other][rows]
+            keep   = np.ones(len(rows), dtype = bool)
+            if lower is not None:
+                keep &= values >= lower
+            if upper is not None:
+                keep &= values <= upper
+            rows = rows[keep]
+        return(np.sort(rows))
+
+    def query(self, bounds = None, **kwargs):
+        '''Returns the rows inside the bounds, in their original order, e.g.
+        query({'cost-1' : (None, 2)}, sens = (0.9, None))'''
+
+        bounds = dict(bounds or {})
+        bounds.update({column.replace('_', '-') : value for column, value in kwargs.items()})
+        return(self.frame.iloc[self.matches(bounds)])
+
+    def count(self, bounds = None, **kwargs):
+        '''Number of rows inside the bounds'''
+
+        bounds = dict(bounds or {})
+        bounds.update({column.replace('_', '-') : value for column, value in kwargs.items()})
+        return(len(self.matches(bounds)))
+
+    def nearest(self, point, k = 5):
+        '''Returns the k rows nearest to a point (column -> value for every
+        indexed column) in scaled distance, nearest first, with a distance
+        column'''
+
+        missing = [column for column in self.columns if column not in point]
+        if missing:
+            raise KeyError('point has no value for %s' % missing)
+        target  = np.array([point[column] / self.scale[column] for column in self.columns])
+        rows, dists = self.tree.nearest(self.points(), target, min(k, len(self.frame)))
+        return(self.frame.iloc[rows].assign(distance = dists))
+
+    def save(self, directory):
+        '''Writes the index (not the results) to a directory, replacing any
+        index already there'''
+
+        parent  = os.path.dirname(os.path.abspath(directory))
+        staging = tempfile.mkdtemp(prefix = '.index', dir = parent)
+        for number, column in enumerate(self.columns):
+            np.save(os.path.join(staging, 'sorted-%d.npy' % number), self.sorted[column])
+            np.save(os.path.join(staging, 'ordered-%d.npy' % number), self.ordered[column])
+        for field in KDTree.FIELDS:
+            np.save(os.path.join(staging, 'tree-%s.npy' % field), getattr(self.tree, field))
+        with open(os.path.join(staging, 'index.json'), 'w') as meta:
+            json.dump({'columns' : self.columns, 'scale' : self.scale,
+                       'rows' : len(self.frame)}, meta)
+        shutil.rmtree(directory, ignore_errors = True)
+        os.rename(staging, directory)
+
+    @classmethod
+    def load(cls, directory, frame):
+        '''Reloads an index written by save for the same frame, memory mapped'''
+
+        with open(os.path.join(directory, 'index.json')) as meta:
+            meta = json.load(meta)
+        if meta['rows'] != len(frame):
+            raise ValueError('index of %d rows does not fit %d results'
+                             % (meta['rows'], len(frame)))
+        columns = meta['columns']
+        sorted_ = {column : np.load(os.path.join(directory, 'sorted-%d.npy' % number),
+                                    mmap_mode = 'r')
+                   for number, column in enumerate(columns)}
+        ordered = {column : np.load(os.path.join(directory, 'ordered-%d.npy' % number),
+                                    mmap_mode = 'r')
+                   for number, column in enumerate(columns)}
+        tree    = KDTree(**{field : np.load(os.path.join(directory, 'tree-%s.npy' % field),
+                                            mmap_mode = 'r')
+                            for field in KDTree.FIELDS})
+        return(cls(frame, columns, index = (sorted_, ordered, meta['scale'], tree)))
+
+def cached_store(cache, key, columns = None):
+    '''Returns the ResultStore of a ResultCache entry, building its index and
+    saving it next to the results the first time'''
+
+    frame   = cache.load(key)
+    path    = os.path.join(cache.path(key), INDEX)
+    if os.path.exists(os.path.join(path, 'index.json')):
+        store = ResultStore.load(path, frame)
+        if columns is None or store.columns == list(columns):
+            return(store)
+    store   = ResultStore(frame, columns)
+    store.save(path)
+    return(store)
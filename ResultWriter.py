@@ -0,0 +1,139 @@
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+from SensSpecCostCalculator import FAMILIES, iter_families
+
+
+#### This code writes results to disk while they are produced, one chunk at a
+#### time, so the full result set of a run never has to fit in memory. It is
+#### meant to be fed by SensSpecCostCalculator.iter_families (or iter_family,
+#### or ParallelEngine.iter_sharded).
+
+## CSV needs nothing but pandas. Parquet and Arrow IPC need pyarrow and keep
+## the column types of the first chunk for the whole file.
+
+## File extension : format
+FORMATS = {'.csv' : 'csv', '.parquet' : 'parquet', '.arrow' : 'arrow',
+           '.feather' : 'arrow', '.ipc' : 'arrow'}
+
+###############################################################################
+############## Code Section One - Sinks #######################################
+###############################################################################
+
+class CSVSink(object):
+    '''Appends chunks to a CSV file, writing the header with the first one'''
+
+    def __init__(self, path):
+        self.path   = path
+        self.rows   = 0
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.path, mode = 'w' if self.header else 'a',
+                     header = self.header, index = False)
+        self.header = False
+        self.rows  += len(chunk)
+
+    def close(self):
+        ## An empty run still leaves a file behind
+        if self.header:
+            open(self.path, 'w').close()
+
+class ArrowSink(object):
+    '''Appends chunks to a Parquet or an Arrow IPC file. The schema is taken
+    from the first chunk and every later chunk is cast to it.'''
+
+    def __init__(self, path, format = 'parquet'):
+        if pa is None:
+            raise ImportError('writing %s files needs pyarrow' % format)
+        if format not in ('parquet', 'arrow'):
+            raise ValueError('unknown format %r' % format)
+        self.path   = path
+        self.format = format
+        self.rows   = 0
+        self.schema = None
+        self.writer = None
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk, schema = self.schema, preserve_index = False)
+        if self.writer is None:
+            self.schema = table.schema
+            if self.format == 'parquet':
+                self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+        self.writer.write_table(table)
+        self.rows += len(chunk)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def open_sink(path, format = None):
+    '''Opens a sink for path. The format ('csv', 'parquet' or 'arrow') is taken
+    from the file extension when it is not given.'''
+
+    if format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in FORMATS:
+            raise ValueError('cannot tell the format of %r, pass format' % path)
+        format = FORMATS[extension]
+    if format == 'csv':
+        return(CSVSink(path))
+    return(ArrowSink(path, format))
+
+###############################################################################
+############## Code Section Two - Writing runs ################################
+###############################################################################
+
+def write_results(chunks, path, format = None):
+    '''Writes an iterable of result chunks to one file
+
+    Inputs
+    chunks          : Iterable      : Dataframes with the same columns
+    path            : String        : output file
+    format          : String        : 'csv', 'parquet' or 'arrow', taken from
+                                      the extension by default
+
+    Output
+    rows            : Integer       : number of rows written
+    '''
+
+    sink = open_sink(path, format)
+    try:
+        for chunk in chunks:
+            if len(chunk):
+                sink.write(chunk)
+    finally:
+        sink.close()
+    return(sink.rows)
+
+def write_families(phases, directory, families = None, format = 'csv',
+                   chunk_size = 2 ** 16, rules = None, prevalences = None):
+    '''Writes every family to its own file <directory>/<family>.<format>,
+    evaluating and writing one chunk at a time
+
+    Inputs
+    rules           : List          : rules to apply, RULES by default
+    prevalences     : List          : also write PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
+
+    Output
+    rows            : Dictionary    : family -> number of rows written
+    '''
+
+    extension   = {'csv' : '.csv', 'parquet' : '.parquet', 'arrow' : '.arrow'}[format]
+    families    = list(FAMILIES) if families is None else families
+    rows        = {}
+    for family in families:
+        path = os.path.join(directory, family + extension)
+        rows[family] = write_results(iter_families(phases, [family], chunk_size, rules,
+                                                   prevalences),
+                                     path, format)
+    return(rows)
@@ -1,7 +1,9 @@
+import sys
+import fnmatch
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import itertools as it
 
 
 #### This code is designed to calculate the sensitivity and specificity of
@@ -21,20 +23,21 @@ import itertools as it
 ###############################################################################
 
 ## The data originally used for this code is available from (GITHUB LINK)
-## It needs to be imported to a pandas Dataframe with the following layout
+## It is read into a TestCatalog (see Code Section Three), which checks that
+## the following columns are present and numeric
 ##
-## Column      : Content
+## Column              : Content
 ##
-## 0             String : Name of diagnostic tests
-## 1
-## 2
-## 3             Float  : Mean Sensitivity of test
-## 4
-## 5
-## 6             Float  : Mean Specificity of test
-##
-## The unlabeled columns can be empty in the dataframe and exist only
-## as a possible future work
+## Values              String : Name of diagnostic tests
+## Sensitivity_lower   Float  : Lower bound of the sensitivity (percent)
+## Sensitivity_upper   Float  : Upper bound of the sensitivity (percent)
+## Sensitivity_mean    Float  : Mean Sensitivity of test (percent)
+## Specificity_lower   Float  : Lower bound of the specificity (percent)
+## Specificity_upper   Float  : Upper bound of the specificity (percent)
+## Specificity_mean    Float  : Mean Specificity of test (percent)
+## Wait_Time           Float  : Time until the result is available
+## Cost                Float  : Cost of running the test
+## type                Int    : Phase the test belongs to (see PHASE_TYPES)
 
 
 ###############################################################################
@@ -44,72 +47,176 @@ import itertools as it
 ### These are general rules for calculating combinations of diagnostic tests
 
 
-def CAS(A, B):
+def pair_buffer(A, B, out = None):
+	'''Prepares the inputs of the array versions of CAS, COS, CAP and COP.
+	Stacked inputs hold [sensitivity,specificity] on their last axis and are
+	broadcast against each other. The result is written into out, which is
+	allocated when it is not given.
+
+    Inputs:
+    A, B            : Numpy array   : shape (..., 2)
+    out             : Numpy array   : optional buffer of the broadcast shape
+
+    Outputs:
+    A, B, out       : Numpy array   : inputs as float arrays and the buffer
+    '''
+
+	A = np.asarray(A, dtype = float)
+	B = np.asarray(B, dtype = float)
+	shape = np.broadcast_shapes(A.shape, B.shape)
+	if shape[-1:] != (2,):
+		raise ValueError('stacked tests need [sens, spec] on the last axis, got shape %s' % (shape,))
+	if out is None:
+		return(A, B, np.empty(shape))
+	if out.shape != shape:
+		raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+	## The buffer is also used as scratch space so inputs that share memory
+	## with it are copied first.
+	if np.shares_memory(out, A):
+		A = A.copy()
+	if np.shares_memory(out, B):
+		B = B.copy()
+	return(A, B, out)
+
+def stacked(A, B, out):
+	'''True when a combinator was called with stacked arrays rather than
+	two-element lists'''
+
+	return(out is not None or
+		   any(isinstance(x, np.ndarray) and x.ndim > 0 for x in (A, B)))
+
+def cached(A, B, out):
+	'''True when both tests are Terms of the same SubexpressionCache, in which
+	case a combinator looks its result up instead of computing it'''
+
+	return(out is None and isinstance(A, Term) and isinstance(B, Term)
+		   and A.cache is B.cache)
+
+def CAS(A, B, out = None):
 	'''Function for combining the sensitivity and specificity of two tests
 	CAS = Combine.And.Serial. Meaning we are combining tests that  are in serial
 	and that both have to be true to be taken as a positive
 
     Inputs:
-    A               : Numpy list    : [sensitivity,specificity]
+    A               : Numpy list    : [sensitivity,specificity], or a Numpy
+                                      array of shape (..., 2)
+    out             : Numpy array   : optional (..., 2) buffer for the result
 
     Outputs:
     combinedsens    : Integer       : values for sensitivity
     combinedspec    : Integer       : values for specificity
+
+    With stacked arrays the output is one (..., 2) array instead.
     '''
 
+	if cached(A, B, out):
+		return(A.cache.combine(CAS, A, B))
+	if stacked(A, B, out):
+		A, B, out = pair_buffer(A, B, out)
+		np.multiply(A[..., 0], B[..., 0], out = out[..., 0])
+		np.subtract(1, A[..., 1], out = out[..., 1])
+		np.multiply(out[..., 1], B[..., 1], out = out[..., 1])
+		np.add(A[..., 1], out[..., 1], out = out[..., 1])
+		return(out)
+
 	combinedsens = A[0] * B[0]
 	combinedspec = A[1] + (1 - A[1]) * B[1]
 
 	return(combinedsens, combinedspec)
 
-def COS(A, B):
+def COS(A, B, out = None):
 	'''Function for combining the sensitivity and specificity of two tests
 	COS = Combine.'OR'.Serial Meaning we are combining tests that  are in serial
 	and if one of them is true then it is positive
 
     Inputs:
-    A               : Numpy list    : [sensitivity,specificity]
+    A               : Numpy list    : [sensitivity,specificity], or a Numpy
+                                      array of shape (..., 2)
+    out             : Numpy array   : optional (..., 2) buffer for the result
 
     Outputs:
     combinedsens    : Integer       : values for sensitivity
     combinedspec    : Integer       : values for specificity
+
+    With stacked arrays the output is one (..., 2) array instead.
     '''
+
+	if cached(A, B, out):
+		return(A.cache.combine(COS, A, B))
+	if stacked(A, B, out):
+		A, B, out = pair_buffer(A, B, out)
+		np.subtract(1, A[..., 0], out = out[..., 0])
+		np.multiply(out[..., 0], B[..., 0], out = out[..., 0])
+		np.add(A[..., 0], out[..., 0], out = out[..., 0])
+		np.multiply(A[..., 1], B[..., 1], out = out[..., 1])
+		return(out)
+
 	combinedsens = A[0] + (1 - A[0]) * B[0]
 	combinedspec = A[1] * B[1]
 
 	return(combinedsens, combinedspec)
 
-def CAP(A, B):
+def CAP(A, B, out = None):
 	'''Function for combining the sensitivity and specificity of two tests
 	CAP = Combine.'AND'.Parallel Meaning we are combining tests that are in
 	Parallel and if both of them is true then it is positive
 
     Inputs:
-    A               : Numpy list    : [sensitivity,specificity]
+    A               : Numpy list    : [sensitivity,specificity], or a Numpy
+                                      array of shape (..., 2)
+    out             : Numpy array   : optional (..., 2) buffer for the result
 
     Outputs:
     combinedsens    : Integer       : values for sensitivity
     combinedspec    : Integer       : values for specificity
+
+    With stacked arrays the output is one (..., 2) array instead.
     '''
 
+	if cached(A, B, out):
+		return(A.cache.combine(CAP, A, B))
+	if stacked(A, B, out):
+		A, B, out = pair_buffer(A, B, out)
+		## out[..., 0] holds A[1] + B[1] until the sensitivity is written
+		np.add(A[..., 1], B[..., 1], out = out[..., 0])
+		np.multiply(A[..., 1], B[..., 1], out = out[..., 1])
+		np.subtract(out[..., 0], out[..., 1], out = out[..., 1])
+		np.multiply(A[..., 0], B[..., 0], out = out[..., 0])
+		return(out)
+
 	combinedsens = A[0] * B[0]
 	combinedspec = A[1] + B[1]-(A[1] * B[1])
 
 	return(combinedsens, combinedspec)
 
-def COP(A, B):
+def COP(A, B, out = None):
 	'''Function for combining the sensitivity and specificity of two tests
 	COP = Combine.'OR'.Parallel Meaning we are combining tests that are in
 	Parallel and if one of them is true then it is positive
 
     Inputs:
-    A               : Numpy list    : [sensitivity,specificity]
+    A               : Numpy list    : [sensitivity,specificity], or a Numpy
+                                      array of shape (..., 2)
+    out             : Numpy array   : optional (..., 2) buffer for the result
 
     Outputs:
     combinedsens    : Integer       : values for sensitivity
     combinedspec    : Integer       : values for specificity
+
+    With stacked arrays the output is one (..., 2) array instead.
     '''
 
+	if cached(A, B, out):
+		return(A.cache.combine(COP, A, B))
+	if stacked(A, B, out):
+		A, B, out = pair_buffer(A, B, out)
+		## out[..., 1] holds A[0] + B[0] until the specificity is written
+		np.add(A[..., 0], B[..., 0], out = out[..., 1])
+		np.multiply(A[..., 0], B[..., 0], out = out[..., 0])
+		np.subtract(out[..., 1], out[..., 0], out = out[..., 0])
+		np.multiply(A[..., 1], B[..., 1], out = out[..., 1])
+		return(out)
+
 	combinedsens = A[0] + B[0] - (A[0] * B[0])
 	combinedspec = A[1] * B[1]
 
@@ -569,7 +676,9 @@ def il(list_):
     return(range(len( list_)))
 
 def prep(df, index, ret_cost = False):
-    '''Prep function is neccesary to pluck the items from the Pandas Dataframe
+    '''Prep function is neccesary to pluck the items from the Pandas Dataframe.
+    The columns are found by name, so the Dataframe must follow CATALOG_COLUMNS.
+    The engine reads from a TestCatalog instead, prep is kept for single tests.
 
     Inputs
     df              : Pandas Dataframe
@@ -581,268 +690,1051 @@ def prep(df, index, ret_cost = False):
     '''
 
     df          = df.iloc[index]
-    values      = [df.iloc[3],df.iloc[6]]
-    test_name   = str(df.iloc[0])
+    values      = [df['Sensitivity_mean'], df['Specificity_mean']]
+    test_name   = str(df['Values'])
     cost        = df['Cost']
     if ret_cost:
         return(values, test_name, cost)
     return(values, test_name)
 
+## Column of algorithmcsv.csv : attribute of Phase. Surrounding whitespace in
+## the header is ignored ('Wait_Time ' has a trailing space in the source file).
+CATALOG_COLUMNS = {
+    'Values'            : 'name',
+    'Sensitivity_lower' : 'sens_lower',
+    'Sensitivity_upper' : 'sens_upper',
+    'Sensitivity_mean'  : 'sens',
+    'Specificity_lower' : 'spec_lower',
+    'Specificity_upper' : 'spec_upper',
+    'Specificity_mean'  : 'spec',
+    'Wait_Time'         : 'wait',
+    'Cost'              : 'cost',
+    'type'              : 'type',
+}
+
+## The columns that hold probabilities (given in percent in the source file)
+PROBABILITY_COLUMNS = ['Sensitivity_lower', 'Sensitivity_upper', 'Sensitivity_mean',
+                       'Specificity_lower', 'Specificity_upper', 'Specificity_mean']
+
+## Phase letter : value of the type column
+PHASE_TYPES = {'B' : 1, 'C' : 0, 'D' : 2, 'E' : 3, 'F' : 4}
+
+class Phase(object):
+    '''The tests of one phase held as contiguous float arrays
+
+    Attributes
+    ids             : Numpy array   : position of each name in the name table
+    table           : Tuple         : interned name table of the catalog
+    sens, spec      : Numpy array   : mean sensitivity and specificity
+    sens_lower/upper: Numpy array   : bounds of the sensitivity
+    spec_lower/upper: Numpy array   : bounds of the specificity
+    cost            : Numpy array   : cost of each test
+    wait            : Numpy array   : Wait_Time of each test
+    '''
+
+    FIELDS = ('sens', 'sens_lower', 'sens_upper',
+              'spec', 'spec_lower', 'spec_upper', 'cost', 'wait')
+
+    def __init__(self, ids, table, **arrays):
+        self.ids    = np.ascontiguousarray(ids, dtype = np.intp)
+        self.table  = table
+        for field in self.FIELDS:
+            setattr(self, field, np.ascontiguousarray(arrays[field], dtype = float))
+
+    def __len__(self):
+        return(len(self.ids))
+
+    @property
+    def names(self):
+        '''Names of the tests in order, as an object array'''
+        return(np.array([self.table[i] for i in self.ids], dtype = object))
+
+    def take(self, index):
+        '''Returns a new Phase holding only the tests at index'''
+        return(Phase(self.ids[index], self.table,
+                     **{field : getattr(self, field)[index] for field in self.FIELDS}))
+
+class TestCatalog(object):
+    '''The test catalog (algorithmcsv.csv) compiled once into columnar arrays.
+    The schema is checked when the catalog is built so the engine never has to
+    rely on column positions.
+
+    Inputs
+    data            : Pandas Dataframe : columns as in CATALOG_COLUMNS
+    percent         : Boolean       : True if the probabilities are given in
+                                      percent, as they are in algorithmcsv.csv
+
+    Attributes
+    names           : Tuple         : interned name table, one entry per name
+    types           : Numpy array   : type (phase) of each test
+    tests           : Phase         : every test in file order
+    phases          : Dictionary    : type -> Phase of the tests of that type
+    '''
+
+    def __init__(self, data, percent = True):
+        data    = data.rename(columns = lambda column: str(column).strip())
+        missing = [column for column in CATALOG_COLUMNS if column not in data.columns]
+        if missing:
+            raise ValueError('catalog is missing the columns %s' % missing)
+
+        arrays  = {}
+        for column, field in CATALOG_COLUMNS.items():
+            if field == 'name':
+                continue
+            try:
+                values = data[column].to_numpy(dtype = float)
+            except (TypeError, ValueError):
+                raise ValueError('catalog column %r is not numeric' % column)
+            if np.isnan(values).any():
+                raise ValueError('catalog column %r has missing values' % column)
+            if column in PROBABILITY_COLUMNS:
+                if percent:
+                    values = values / 100
+                if ((values < 0) | (values > 1)).any():
+                    raise ValueError('catalog column %r is not a probability' % column)
+            arrays[field] = values
+
+        names       = [sys.intern(str(name)) for name in data['Values']]
+        position    = {}
+        for name in names:
+            position.setdefault(name, len(position))
+        self.names  = tuple(position)
+        self.types  = arrays.pop('type').astype(int)
+        self.tests  = Phase([position[name] for name in names], self.names, **arrays)
+        self.phases = {int(type_) : self.tests.take(np.flatnonzero(self.types == type_))
+                       for type_ in np.unique(self.types)}
+
+    @classmethod
+    def from_csv(cls, path, percent = True):
+        '''Reads and compiles a catalog file such as algorithmcsv.csv'''
+        return(cls(pd.read_csv(path), percent))
+
+    def __len__(self):
+        return(len(self.tests))
+
+    def phase(self, type_):
+        '''Returns the Phase of all tests with the given type'''
+        return(self.phases[type_])
+
 def rdtcattconflict(i):
-    '''A function to test if Catt dilutions and RDT appear in the same algorithm '''
+    '''A function to test if Catt dilutions and RDT appear in the same algorithm.
+    This is the positional form of the first entry of RULES.'''
     if i[1] == 1 and i[4] != 3:
         return(True)
 
+## Rules are logistics constraints between named tests. Names may be fnmatch
+## patterns such as 'CATT_*_Dilution'. For each grid a rule is compiled into
+## cubes: dictionaries of axis -> boolean mask over the tests of that axis. A
+## combination breaks the rule when, on every axis of some cube, its test is
+## inside the mask. The engine removes the cubes from the grid before anything
+## is evaluated (see feasible_boxes).
+
+def match_tests(patterns, names):
+    '''Returns a boolean mask of the names matched by any of the patterns, or
+    None for an axis without names (A)'''
+
+    if names is None:
+        return(None)
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return(np.array([any(fnmatch.fnmatchcase(str(name), pattern) for pattern in patterns)
+                     for name in names], dtype = bool))
+
+class Excludes(object):
+    '''Mutual exclusion: no algorithm may use a test of first together with a
+    test of second
+
+    Inputs
+    first, second   : String or List : test names or patterns
+    '''
+
+    def __init__(self, first, second):
+        self.first  = first
+        self.second = second
+
+    def __repr__(self):
+        return('Excludes(%r, %r)' % (self.first, self.second))
+
+    def cubes(self, names):
+        '''Compiles the rule for a grid whose axes hold the given names'''
+
+        first   = [match_tests(self.first, axis) for axis in names]
+        second  = [match_tests(self.second, axis) for axis in names]
+        cubes   = []
+        for i, used in enumerate(first):
+            for j, other in enumerate(second):
+                ## An axis holds a single test so it cannot conflict with itself
+                if i == j or used is None or other is None:
+                    continue
+                if used.any() and other.any():
+                    cubes.append({i : used, j : other})
+        return(cubes)
+
+class Requires(object):
+    '''Co-requirement: an algorithm that uses a test of first must also use a
+    test of second. Where no axis can hold second, first cannot be used.
+
+    Inputs
+    first, second   : String or List : test names or patterns
+    '''
+
+    def __init__(self, first, second):
+        self.first  = first
+        self.second = second
+
+    def __repr__(self):
+        return('Requires(%r, %r)' % (self.first, self.second))
+
+    def cubes(self, names):
+        '''Compiles the rule for a grid whose axes hold the given names'''
+
+        first   = [match_tests(self.first, axis) for axis in names]
+        second  = [match_tests(self.second, axis) for axis in names]
+        cubes   = []
+        for i, used in enumerate(first):
+            if used is None or not used.any():
+                continue
+            ## Broken when first is used and no axis holds a test of second
+            cube = {i : used.copy()}
+            for j, other in enumerate(second):
+                if other is None or not other.any():
+                    continue
+                if j == i:
+                    cube[i] &= ~other
+                else:
+                    cube[j] = ~other
+            if all(mask.any() for mask in cube.values()):
+                cubes.append(cube)
+        return(cubes)
+
+## The rules applied when none are given. The RDT is not used together with a
+## CATT dilution (rdtcattconflict).
+RULES = [Excludes('RDT1_SD', 'CATT_*_Dilution')]
+
 ###############################################################################
 ############## Code Section Four - Implementation #############################
 ###############################################################################
 
-def run_no_extra_paths(A, B, C, D):
-    ''' This runs the no_extra_paths algorithm for all possibile combinations
-    of tests
+## Every family is evaluated for the whole grid of combinations at once. Each
+## phase is turned into arrays a single time, the arrays are reshaped so that
+## every phase lies on its own axis, and the formulas from Section Two are
+## broadcast over the resulting grid. The formulas only use arithmetic and
+## indexing so they accept the arrays unchanged.
+##
+## time-0 and time-1 are the expected time to diagnosis (from Wait_Time) of
+## patients without and with HAT. The tests of a pathway are run one after
+## the other, so a test adds its wait exactly when it would add its cost. The
+## times are worked out on the tree of each family (FAMILY_TREES, the same
+## trees as AlgorithmCompiler.TOPOLOGIES) with the recurrences
+##     time(X and Y) = time(X) + P(X positive) * time(Y)
+##     time(X or Y)  = time(X) + P(X negative) * time(Y)
+## rather than from the hand written *_cost formulas, which do not all follow
+## their tree (extra_path_1_cost has a (1 - Bcost) term, which would turn
+## into (1 - Bwait) and give negative times).
+
+COLUMNS = ['sens', 'spec', 'cost-0', 'cost-1', 'time-0', 'time-1', 'Algorithm']
+
+## Programme metrics at a prevalence p of HAT among the people screened:
+##   ppv             p sens / (p sens + (1 - p)(1 - spec))
+##   npv             (1 - p) spec / ((1 - p) spec + p (1 - sens))
+##   cost            p cost-1 + (1 - p) cost-0, the expected cost per person
+##                   screened
+##   cost-per-case   cost / (p sens), the cost per true case detected
+## They are computed on an extra trailing axis of the grid (one entry per
+## prevalence) and give one column per metric and prevalence, named
+## metric@prevalence, e.g. 'ppv@0.01'.
+PREVALENCE_METRICS = ['ppv', 'npv', 'cost', 'cost-per-case']
+
+## family code : tree of the algorithm, ('and' or 'or', left, right) with the
+## phase letters as leaves
+FAMILY_TREES = {
+    'NOXP'  : ('and', 'A', ('or', ('and', 'B', 'C'), 'D')),
+    'XP1'   : ('or', ('and', 'B', 'C'), ('and', 'A', 'D')),
+    'XP2'   : ('and', 'A', ('or', ('or', ('and', 'B', 'C'), 'D'), 'E')),
+    'XP3'   : ('and', 'A', ('or', ('or', ('and', 'B', 'C'), 'D'), ('and', 'F', 'G'))),
+    'XP23'  : ('and', 'A', ('or', ('or', ('or', ('and', 'B', 'C'), 'D'), 'E'),
+                            ('and', 'F', 'G'))),
+    'XP12'  : ('or', ('and', 'B', 'C'), ('and', 'A', ('or', 'D', 'E'))),
+    'XP13'  : ('or', ('and', 'B', 'C'), ('and', 'A', ('or', 'D', ('and', 'F', 'G')))),
+    'XP123' : ('or', ('and', 'B', 'C'), ('and', 'A', ('or', ('or', 'D', 'E'),
+                                                       ('and', 'F', 'G')))),
+}
+
+## family code : (formula, cost formula, phases in argument order)
+FAMILIES = {
+    'NOXP'  : (no_extra_paths,   no_extra_paths_cost,   'ABCD'),
+    'XP1'   : (extra_path_1,     extra_path_1_cost,     'ABCD'),
+    'XP2'   : (extra_path_2,     extra_path_2_cost,     'ABCDE'),
+    'XP3'   : (extra_path_3,     extra_path_3_cost,     'ABCDFG'),
+    'XP23'  : (extra_path_2and3, extra_path_2and3_cost, 'ABCDEFG'),
+    'XP12'  : (extra_path_1and2, extra_path_1and2_cost, 'ABCDE'),
+    'XP13'  : (extra_path_1and3, extra_path_1and3_cost, 'ABCDFG'),
+    'XP123' : (all_paths,        all_extra_paths_cost,  'ABCDEFG'),
+}
+
+def phase_arrays(phase, label):
+    '''Turns one phase into flat arrays so it can be broadcast
+
+    Inputs
+    phase           : List or Phase : A is a list of [sens, spec], G a list
+                                      of probabilities and B-F are Phases of
+                                      a TestCatalog (Dataframes are compiled
+                                      into one first)
+    label           : String        : letter of the phase
+
+    Output
+    sens, spec      : Numpy array   : sensitivity and specificity of each test
+    cost            : Numpy array   : cost of each test (zero for A and G)
+    wait            : Numpy array   : Wait_Time of each test (zero for A and
+                                      G)
+    names           : Numpy array   : names used in the Algorithm column, None
+                                      for A as it never appears in the name
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    if label == 'A':
+        values  = np.asarray(phase, dtype = float).reshape(-1, 2)
+        return(values[:, 0], values[:, 1], np.zeros(len(values)),
+               np.zeros(len(values)), None)
+    if label == 'G':
+        sens    = np.asarray(phase, dtype = float)
+        names   = np.array([str(g) for g in phase], dtype = object)
+        return(sens, 1 - sens, np.zeros(len(sens)), np.zeros(len(sens)), names)
+    phase = as_phase(phase)
+    return(phase.sens, phase.spec, phase.cost, phase.wait, phase.names)
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D)))
+def as_phase(phase):
+    '''Returns a test phase (B-F) as a Phase, compiling a Dataframe (with the
+    probabilities as fractions) into one first'''
 
-    for i in combinations:
-        Bi,Bstr = prep(B, i[1])
-        Ci,Cstr = prep(C, i[2])
-        Di,Dstr = prep(D, i[3])
-        values  = list(no_extra_paths(A[i[0]], Bi, Ci, Di))
-        cost = list(no_extra_paths_cost(A[i[0]], prep(B, i[1], True), prep(C, i[2], True), prep(D, i[3],True)))
-        name    = Bstr +' '+ Cstr + ' ' + Dstr+' NOXP'
-        values += cost
-        values.append(name)
-        temp    = pd.DataFrame([values])
-        temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-        #temp.loc[0,'Algorithm'] = name
-        output.loc[len(output)] = values
-    return(output)
+    if isinstance(phase, pd.DataFrame):
+        return(TestCatalog(phase, percent = False).tests)
+    return(phase)
 
-def run_extra_path_1(A, B, C, D):
-    ''' This runs the extra_path_1 algorithm for all possibile combinations
-    of tests
+def axis_view(values, axis, ndim):
+    '''Reshapes an array so that its last axis lies along one axis of the
+    grid. Any leading axes (e.g. samples) are kept in front of the grid.'''
+
+    shape       = [1] * ndim
+    shape[axis] = -1
+    return(values.reshape(values.shape[:-1] + tuple(shape)))
+
+def compile_rules(names, rules = None):
+    '''Compiles rules for one grid
+
+    Inputs
+    names           : List          : names of the tests on each axis (None
+                                      for A), as given by phase_arrays
+    rules           : List          : Excludes / Requires rules, RULES by
+                                      default
+
+    Output
+    cubes           : List          : dictionaries of axis -> boolean mask
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    rules = RULES if rules is None else rules
+    return([cube for rule in rules for cube in rule.cubes(names)])
+
+def conflict_mask(cubes, shape):
+    '''Returns a flat boolean array over the grid that is True for every
+    combination that breaks a rule'''
+
+    ndim        = len(shape)
+    conflict    = np.zeros(shape, dtype = bool)
+    for cube in cubes:
+        hit = np.ones([1] * ndim, dtype = bool)
+        for axis, mask in cube.items():
+            hit = hit & axis_view(mask, axis, ndim)
+        conflict |= hit
+    return(conflict.ravel())
+
+def conflict_rows(cubes, index):
+    '''The row version of conflict_mask for combinations given by their index
+    on each axis (see decode_combinations)'''
+
+    conflict = np.zeros(len(index[0]), dtype = bool)
+    for cube in cubes:
+        hit = np.ones(len(index[0]), dtype = bool)
+        for axis, mask in cube.items():
+            hit &= mask[index[axis]]
+        conflict |= hit
+    return(conflict)
+
+def feasible_boxes(cubes, shape):
+    '''Splits the grid into boxes (a set of tests on every axis) that together
+    hold exactly the combinations breaking no rule. Each cube is cut out of
+    every box it overlaps: the part of the box outside the cube on the first
+    axis of the cube is kept, then the part inside on the first axis but
+    outside on the second, and so on. What is left lies inside the cube and is
+    dropped, so infeasible combinations are never generated.
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D)))
+    Output
+    boxes           : List          : per box, one integer array of test
+                                      positions per axis
+    '''
 
-    for i in combinations:
-        Bi,Bstr = prep(B, i[1])
-        Ci,Cstr = prep(C, i[2])
-        Di,Dstr = prep(D, i[3])
+    boxes = [[np.ones(n, dtype = bool) for n in shape]]
+    for cube in cubes:
+        split = []
+        for box in boxes:
+            if not all((box[axis] & mask).any() for axis, mask in cube.items()):
+                split.append(box)
+                continue
+            rest = list(box)
+            for axis, mask in cube.items():
+                outside = rest[axis] & ~mask
+                if outside.any():
+                    piece       = list(rest)
+                    piece[axis] = outside
+                    split.append(piece)
+                rest[axis] = rest[axis] & mask
+        boxes = split
+    return([[np.flatnonzero(mask) for mask in box] for box in boxes])
+
+## The families share most of their sub-expressions: CAS(B, C) is part of all
+## eight, COS(CAS(B, C), D) of NOXP, XP2, XP3 and XP23, and the Algorithm
+## names of XP23 and XP123 only differ in the suffix. When families are
+## evaluated with a SubexpressionCache the combinators of Section One and the
+## names look such results up by content, so each is computed once per run.
+
+class Term(tuple):
+    '''A [sens, spec] pair on the grid of a cached run. It also records which
+    sub-expression it holds (key) and which axes of the grid it spans, so the
+    same sub-expression can be placed on the grid of another family.'''
+
+    def __new__(cls, pair, key, cache):
+        term        = tuple.__new__(cls, pair)
+        term.key    = key
+        term.axes   = grid_axes(pair)
+        term.cache  = cache
+        return(term)
+
+def grid_axes(values):
+    '''Returns the axes along which any of the arrays varies'''
+
+    shape = np.broadcast_shapes(*[np.shape(x) for x in values])
+    return(tuple(axis for axis, n in enumerate(shape) if n > 1))
+
+def object_nbytes(values):
+    '''Rough size in bytes of an array, counting the strings of object arrays'''
+
+    if values.dtype != object or not values.size:
+        return(values.nbytes)
+    return(values.nbytes + values.size * sys.getsizeof(values.flat[0]))
+
+class SubexpressionCache(object):
+    '''Least recently used cache of partial results shared between families.
+
+    Entries are keyed on the sub-expression and the content of the tests it
+    is made of, so equal partial products of different families, scenarios
+    (values of A) or boxes of feasible combinations are found whatever grid
+    they were first computed on. They are stored over only the axes they span
+    and reshaped onto the grid of the caller. Entries larger than the budget
+    are not kept.
 
-        values  = list(extra_path_1(A[i[0]], Bi, Ci, Di))
-        cost = list(extra_path_1_cost(A[i[0]], prep(B, i[1], True), prep(C, i[2], True), prep(D, i[3],True)))
-        name    = Bstr +' '+ Cstr + ' ' + Dstr+' XP1'
-        values += cost
-        values.append(name)
-        temp    = pd.DataFrame([values])
-        temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-        output  = output.append(temp)
+    Inputs
+    memory          : Integer       : budget of the cached arrays in bytes
 
-    return(output)
+    Attributes
+    used            : Integer       : bytes currently held
+    hits, misses    : Integer       : lookups that were and were not cached
+    '''
 
-def run_extra_path_2(A, B, C, D, E):
-    ''' This runs the extra_path_2 algorithm for all possibile combinations
-    of tests
+    def __init__(self, memory = 2 ** 28):
+        self.memory     = memory
+        self.entries    = OrderedDict()
+        self.used       = 0
+        self.hits       = 0
+        self.misses     = 0
+
+    def __len__(self):
+        return(len(self.entries))
+
+    def __contains__(self, key):
+        return(key in self.entries)
+
+    def lookup(self, key, axes, ndim, compute):
+        '''Returns the arrays of a sub-expression on the grid of the caller
+
+        Inputs
+        key             : Tuple         : identifies the sub-expression
+        axes            : Tuple         : axes of the grid the arrays span
+        ndim            : Integer       : number of axes of the grid
+        compute         : Function      : returns the arrays on that grid when
+                                          they are not cached
+
+        Output
+        values          : Tuple         : the arrays, broadcastable to the grid
+        '''
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            values, _ = self.entries[key]
+            return(tuple(place(x, axes, ndim) for x in values))
+
+        self.misses += 1
+        values  = tuple(compute())
+        shape   = np.broadcast_shapes(*[x.shape for x in values])
+        stored  = []
+        for x in values:
+            x = np.ascontiguousarray(np.broadcast_to(x, shape))
+            x = x.reshape([shape[axis] for axis in axes])
+            x.flags.writeable = False
+            stored.append(x)
+        size    = sum(object_nbytes(x) for x in stored)
+        if size <= self.memory:
+            self.entries[key] = (tuple(stored), size)
+            self.used += size
+            while self.used > self.memory:
+                _, (_, old) = self.entries.popitem(last = False)
+                self.used -= old
+        return(tuple(place(x, axes, ndim) for x in stored))
+
+    def leaf(self, label, sens, spec):
+        '''Wraps the arrays of one phase, already placed on the grid, into a
+        Term'''
+
+        key = (label, np.asarray(sens).tobytes(), np.asarray(spec).tobytes())
+        return(Term((sens, spec), key, self))
+
+    def combine(self, combinator, A, B):
+        '''Looks up, or computes, combinator(A, B) for two Terms'''
+
+        key     = (combinator.__name__, A.key, B.key)
+        axes    = tuple(sorted(set(A.axes) | set(B.axes)))
+        ndim    = max(np.ndim(x) for x in A + B)
+        pair    = self.lookup(key, axes, ndim,
+                              lambda: combinator(tuple(A), tuple(B)))
+        return(Term(pair, key, self))
+
+def place(values, axes, ndim):
+    '''Reshapes an array stored over some axes onto a grid of ndim axes'''
+
+    shape = [1] * ndim
+    for axis, n in zip(axes, values.shape):
+        shape[axis] = n
+    return(values.reshape(shape))
+
+def decode_combinations(start, stop, shape):
+    '''Decodes a range of flat combination numbers into the index of the test
+    on each axis. The flat number is read as a mixed radix number whose digits
+    are the axis indices, the last axis changing fastest, which is the order
+    evaluate_family produces rows in.
+
+    Inputs
+    start, stop     : Integer       : range of flat combination numbers
+    shape           : Tuple         : number of tests on each axis
+
+    Output
+    index           : List          : one integer array per axis
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    flat    = np.arange(start, min(stop, int(np.prod(shape))), dtype = np.int64)
+    index   = []
+    for radix in reversed(shape):
+        flat, digit = np.divmod(flat, radix)
+        index.append(digit)
+    return(index[::-1])
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(E)))
+def apply_family(family, tests, cache = None):
+    '''Applies the formula and the cost formula of a family to arrays
 
-    for i in combinations:
-        if not rdtcattconflict(i):
-            Bi,Bstr = prep(B, i[1])
-            Ci,Cstr = prep(C, i[2])
-            Di,Dstr = prep(D, i[3])
-            Ei,Estr = prep(E, i[4])
+    Inputs
+    family          : String        : key of FAMILIES
+    tests           : List          : (sens, spec, cost, wait) arrays for each
+                                      phase of the family, in order. The arrays only
+                                      need to broadcast against each other.
+    cache           : SubexpressionCache : optional, shares the partial
+                                      products with other families. The
+                                      arrays must then lie on a grid as given
+                                      by axis_view.
 
-            values  = list(extra_path_2(A[i[0]], Bi, Ci, Di, Ei))
-            cost = list(extra_path_2_cost(A[i[0]], prep(B, i[1], True), prep(C, i[2], True), prep(D, i[3],True),prep(E,i[4],True)))
+    Output
+    sens, spec, cost0, cost1, time0, time1 : Numpy array
+    '''
 
-            name    = Bstr +' '+ Cstr + ' ' + Dstr + ' ' + Estr +' XP2'
+    formula, cost_formula, labels = FAMILIES[family]
+    args        = []
+    cost_args   = []
+    for label, (sens, spec, cost, wait) in zip(labels, tests):
+        pair    = (sens, spec) if cache is None else cache.leaf(label, sens, spec)
+        args.append(pair)
+        ## The cost formulas take the same (values, name, cost) triple as prep
+        ## for the tests and the plain [sens, spec] pair for A and G.
+        if label in 'AG':
+            cost_args.append(pair)
+        else:
+            cost_args.append((pair, None, cost))
+    leaves  = {label : test for label, test in zip(labels, tests)}
+    return(tuple(formula(*args)) + tuple(cost_formula(*cost_args))
+           + tree_times(FAMILY_TREES[family], leaves)[2:])
+
+def tree_times(tree, leaves):
+    '''Expected times of a tree of tests (see FAMILY_TREES)
 
-            values += cost
-            values.append(name)
-            temp    = pd.DataFrame([values])
-            temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-            output  = output.append(temp)
+    Inputs
+    tree            : Tuple/String  : a phase letter or ('and' or 'or', left,
+                                      right)
+    leaves          : Dictionary    : phase letter -> (sens, spec, cost, wait)
 
-    output.drop_duplicates()
+    Output
+    sens, spec, time0, time1 : the sensitivity and specificity of the tree
+                               and the expected time of patients without and
+                               with HAT
+    '''
 
-    return(output)
+    if not isinstance(tree, tuple):
+        sens, spec, _, wait = leaves[tree]
+        return(sens, spec, wait, wait)
+    ls, lp, lw0, lw1 = tree_times(tree[1], leaves)
+    rs, rp, rw0, rw1 = tree_times(tree[2], leaves)
+    if tree[0] == 'and':
+        return(ls * rs, lp + (1 - lp) * rp,
+               lw0 + (1 - lp) * rw0, lw1 + ls * rw1)
+    return(ls + (1 - ls) * rs, lp * rp,
+           lw0 + lp * rw0, lw1 + (1 - ls) * rw1)
 
-def run_extra_path_3(A, B, C, D, F, G):
-    ''' This runs the extra_path_3 algorithm for all possibile combinations
-    of tests
+def prevalence_column(metric, prevalence):
+    '''Name of the column of a metric at one prevalence, e.g. ppv@0.01'''
+
+    return('%s@%g' % (metric, prevalence))
+
+def prevalence_columns(prevalences):
+    '''Names of the columns given by prevalence_metrics, metric by metric'''
+
+    return([prevalence_column(metric, p) for metric in PREVALENCE_METRICS
+            for p in prevalences])
+
+def prevalence_metrics(values, prevalences):
+    '''Computes PREVALENCE_METRICS over a grid of prevalences
+
+    Inputs
+    values          : List          : sens, spec, cost-0, cost-1 (and any
+                                      further) arrays, as given by
+                                      apply_family
+    prevalences     : List          : prevalences of HAT, between 0 and 1
+
+    Output
+    metrics         : List          : one array per column of
+                                      prevalence_columns, each broadcastable
+                                      against the values
     '''
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(F), il(G)))
+    p = np.asarray(prevalences, dtype = float).ravel()
+    if ((p < 0) | (p > 1)).any():
+        raise ValueError('prevalences must lie between 0 and 1')
+    sens, spec, cost0, cost1 = [np.asarray(x)[..., None] for x in values[:4]]
+    positive    = p * sens
+    negative    = (1 - p) * spec
+    cost        = p * cost1 + (1 - p) * cost0
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        metrics = [positive / (positive + (1 - p) * (1 - spec)),
+                   negative / (negative + p * (1 - sens)),
+                   cost,
+                   cost / positive]
+    return([metric[..., j] for metric in metrics for j in range(len(p))])
+
+def with_prevalences(apply, prevalences):
+    '''Wraps an apply function (see evaluate_grid) so that it also returns
+    prevalence_metrics, computed from the same arrays'''
+
+    if prevalences is None:
+        return(apply)
+
+    def wrapped(tests):
+        values = list(apply(tests))
+        return(values + prevalence_metrics(values, prevalences))
+    return(wrapped)
+
+def metric_columns(prevalences = None):
+    '''The metric columns of the results, COLUMNS without Algorithm and the
+    prevalence_columns if any'''
+
+    return(COLUMNS[:-1] + ([] if prevalences is None else prevalence_columns(prevalences)))
+
+def family_index(family, phases, rules = None):
+    '''Returns the grid position of every viable algorithm of a family, in the
+    row order of evaluate_family
 
-    for i in combinations:
-        Bi,Bstr = prep(B, i[1])
-        Ci,Cstr = prep(C, i[2])
-        Di,Dstr = prep(D, i[3])
-        Fi,Fstr = prep(F, i[4])
-        Gi      = [G[i[5]],1-G[i[5]]]
-        values  = list(extra_path_3(A[i[0]], Bi, Ci, Di, Fi, Gi))
-        name    = Bstr +' '+ Cstr + ' ' + Dstr + ' '+Fstr+' ' +str(G[i[5]])+' XP3'
-        cost = list(extra_path_3_cost(A[i[0]], prep(B, i[1], True), prep(C, i[2], True), prep(D, i[3],True),prep(F,i[4],True),Gi))
+    Output
+    index           : Tuple         : one integer array per phase of the family
+    '''
 
-        values += cost
-        values.append(name)
-        temp    = pd.DataFrame([values])
-        temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-        output  = output.append(temp)
-    output.drop_duplicates()
+    labels  = FAMILIES[family][2]
+    arrays  = [phase_arrays(phases[label], label) for label in labels]
+    shape   = tuple(len(sens) for sens, _, _, _, _ in arrays)
+    cubes   = compile_rules([names for _, _, _, _, names in arrays], rules)
+    keep    = np.flatnonzero(~conflict_mask(cubes, shape))
+    return(np.unravel_index(keep, shape))
 
-    return(output)
+def position_names(tables, index, suffix):
+    '''Builds Algorithm names from the position of the test in each phase
 
-def run_extra_path_2and3(A, B, C, D, E, F, G):
-    ''' This runs the extra_path_2and3 algorithm for all possibile combinations
-    of tests
+    Inputs
+    tables          : List          : names of the tests of each phase (None
+                                      for A), as given by phase_arrays
+    index           : Tuple         : one integer array per phase
+    suffix          : String        : appended to the names, e.g. the family
+
+    Output
+    names           : Numpy array   : object array, as in evaluate_family
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
-
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(E), il(F), il(G)))
-
-    for i in combinations:
-        if not rdtcattconflict(i):
-            Bi,Bstr = prep(B, i[1])
-            Ci,Cstr = prep(C, i[2])
-            Di,Dstr = prep(D, i[3])
-            Ei,Estr = prep(E, i[4])
-            Fi,Fstr = prep(F, i[5])
-            Gi      = [G[i[6]],1-G[i[6]]]
-            values  = list(extra_path_2and3(A[i[0]], Bi, Ci, Di, Ei, Fi, Gi))
-            name    = Bstr +' '+ Cstr + ' ' + Dstr + ' '+ Estr + ' '+Fstr+' ' +str(G[i[6]])+' XP23'
-            cost = list(extra_path_2and3_cost(A[i[0]], 
-                            prep(B, i[1], True), 
-                            prep(C, i[2], True), 
-                            prep(D, i[3],True),
-                            prep(E, i[4],True),
-                            prep(F, i[5],True),
-                            Gi))
-            values += cost
-            values.append(name)
-            temp    = pd.DataFrame([values])
-            temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-            output  = output.append(temp)
-    output.drop_duplicates()
-
-    return(output)
+    name = np.full(len(index[0]), '', dtype = object)
+    for table, position in zip(tables, index):
+        if table is not None:
+            name = name + (table + ' ')[position]
+    return(name + suffix)
 
-def run_extra_path_1and2(A, B, C, D, E):
-    ''' This runs the extra_path_1and2 algorithm for all possibile combinations
-    of tests
+def family_names(family, phases, rules = None, index = None):
+    '''The Algorithm names of the viable algorithms of a family (or of the
+    grid positions in index), in the row order of evaluate_family, without
+    evaluating anything'''
+
+    labels  = FAMILIES[family][2]
+    index   = family_index(family, phases, rules) if index is None else index
+    return(position_names([phase_arrays(phases[label], label)[4] for label in labels],
+                          index, family))
+
+def grid_names(arrays, box, ndim, cache = None):
+    '''Builds the names of the tests of a box, separated by spaces, one axis at
+    a time. With a cache every partial name grid is kept, so families that
+    start with the same tests share them.
+
+    Output
+    name            : Numpy array   : object array broadcastable to the box
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    name    = np.full([1] * ndim, '', dtype = object)
+    key     = ('names',)
+    axes    = ()
+    for axis, ((_, _, _, _, names), position) in enumerate(zip(arrays, box)):
+        if names is None:
+            continue
+        words = axis_view(names[position] + ' ', axis, ndim)
+        if cache is None:
+            name = name + words
+            continue
+        key     = key + (tuple(names[position]),)
+        axes    = axes + (axis,)
+        name,   = cache.lookup(key, axes, ndim, lambda: (name + words,))
+    return(name)
+
+def index_dtype(size):
+    '''Smallest signed integer type that can number size tests (and -1)'''
+
+    for dtype in (np.int8, np.int16, np.int32):
+        if size <= np.iinfo(dtype).max:
+            return(dtype)
+    return(np.int64)
+
+def evaluate_grid(apply, labels, arrays, suffix, rules = None, cache = None,
+                  compact = False, prevalences = None):
+    '''Evaluates an algorithm over every feasible combination of tests
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(E), il(F), il(G)))
+    Inputs
+    apply           : Function      : takes (sens, spec, cost, wait) arrays
+                                      for each axis and returns sens, spec,
+                                      cost-0, cost-1, time-0 and time-1 (e.g.
+                                      apply_family)
+    labels          : String/List   : phase letter of each axis
+    arrays          : List          : phase_arrays of each axis
+    suffix          : String        : appended to the Algorithm names
+    rules           : List          : rules to apply, RULES by default
+    cache           : SubexpressionCache : optional, shares the names with
+                                      other calls
+    compact         : Boolean       : give the position of the test on each
+                                      axis (one column per label) instead of
+                                      building the Algorithm names
+    prevalences     : List          : also give PREVALENCE_METRICS at each of
+                                      these prevalences, in the same pass
 
-    for i in combinations:
-        if not rdtcattconflict(i):
-            Bi,Bstr = prep(B, i[1])
-            Ci,Cstr = prep(C, i[2])
-            Di,Dstr = prep(D, i[3])
-            Ei,Estr = prep(E, i[4])
-            values  = list(extra_path_1and2(A[i[0]], Bi, Ci, Di, Ei))
-            name    = Bstr +' '+ Cstr + ' ' + Dstr + ' '+ Estr+' XP12'
-            cost = list(extra_path_1and2_cost(A[i[0]], 
-                        prep(B, i[1], True), 
-                        prep(C, i[2], True), 
-                        prep(D, i[3],True),
-                        prep(E, i[4],True)))
+    Output
+    output          : Pandas Dataframe : one row per feasible combination in
+                                         grid order, columns as in COLUMNS
+                                         with the prevalence_columns before
+                                         Algorithm
+    '''
 
-            values += cost
-            values.append(name)
-            temp    = pd.DataFrame([values])
-            temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-            output  = output.append(temp)
-    output.drop_duplicates()
+    shape   = tuple(len(sens) for sens, _, _, _, _ in arrays)
+    ndim    = len(shape)
+    strides = np.cumprod((shape + (1,))[:0:-1])[::-1]
+    cubes   = compile_rules([names for _, _, _, _, names in arrays], rules)
+    apply   = with_prevalences(apply, prevalences)
+
+    parts   = []
+    flats   = []
+    for box in feasible_boxes(cubes, shape):
+        size    = tuple(len(position) for position in box)
+        tests   = [[axis_view(x[position], axis, ndim) for x in test[:4]]
+                   for axis, (test, position) in enumerate(zip(arrays, box))]
+        columns = [np.broadcast_to(x, size).ravel() for x in apply(tests)]
+
+        if not compact:
+            name    = grid_names(arrays, box, ndim, cache)
+            columns.append(np.broadcast_to(name + suffix, size).ravel())
+        parts.append(columns)
+
+        flat    = np.zeros([1] * ndim, dtype = np.int64)
+        for axis, position in enumerate(box):
+            flat = flat + axis_view(position * strides[axis], axis, ndim)
+        flats.append(np.broadcast_to(flat, size).ravel())
+
+    names   = metric_columns(prevalences) + (list(labels) if compact else ['Algorithm'])
+    if not parts:
+        return(pd.DataFrame({column : [] for column in names}))
+    flat    = np.concatenate(flats)
+    if len(parts) == 1:
+        columns = parts[0]
+    else:
+        ## Boxes interleave in the grid, so put the rows back in grid order
+        order   = np.argsort(flat, kind = 'stable')
+        columns = [np.concatenate(column)[order] for column in zip(*parts)]
+        flat    = flat[order]
+    if compact:
+        columns = columns + [position.astype(index_dtype(n)) for position, n
+                             in zip(np.unravel_index(flat, shape), shape)]
+    return(pd.DataFrame({column : values for column, values in zip(names, columns)}))
+
+def evaluate_family(family, phases, rules = None, cache = None, compact = False,
+                    prevalences = None):
+    '''Evaluates one family of algorithms over every combination of tests that
+    breaks none of the rules
 
-    return(output)
+    Inputs
+    family          : String        : key of FAMILIES, e.g. 'XP23'
+    phases          : Dictionary    : phase letter -> phase (see phase_arrays)
+    rules           : List          : rules to apply, RULES by default
+    cache           : SubexpressionCache : optional, shared with the other
+                                      families of a run
+    compact         : Boolean       : give test positions instead of names
+                                      (see evaluate_grid and CompactResults)
+    prevalences     : List          : also give PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
 
-def run_extra_path_1and3(A, B, C, D, F, G):
-    ''' This runs the extra_path_1and3 algorithm for all possibile combinations
+    Output
+    output          : Pandas Dataframe : one row per viable algorithm with the
+                                         columns in COLUMNS
+    '''
+
+    labels  = FAMILIES[family][2]
+    arrays  = [phase_arrays(phases[label], label) for label in labels]
+    return(evaluate_grid(lambda tests: apply_family(family, tests, cache),
+                         labels, arrays, family, rules, cache, compact, prevalences))
+
+def evaluate_families(phases, families = None, rules = None, memory = 2 ** 28,
+                      prevalences = None):
+    '''Evaluates several families with one SubexpressionCache, so the partial
+    products and names they have in common are computed once
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase (see phase_arrays)
+    families        : List          : family codes, every family by default
+    rules           : List          : rules to apply, RULES by default
+    memory          : Integer       : budget of the cache in bytes
+    prevalences     : List          : also give PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
+
+    Output
+    output          : Pandas Dataframe : evaluate_family of each family
+                                         concatenated in the order of families
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    cache       = SubexpressionCache(memory)
+    return(pd.concat([evaluate_family(family, phases, rules, cache,
+                                      prevalences = prevalences)
+                      for family in families], ignore_index = True))
+
+def family_shape(family, phases):
+    '''Returns the number of tests on each axis of a family'''
+
+    return(tuple(len(phase_arrays(phases[label], label)[0])
+                 for label in FAMILIES[family][2]))
+
+def evaluate_shard(family, phases, start, stop, rules = None, prevalences = None):
+    '''Evaluates the combinations of a family with flat numbers in
+    [start, stop). The rows are those evaluate_family gives for that range,
+    so the shards of a family concatenated in order equal evaluate_family.
+
+    Inputs
+    family          : String        : key of FAMILIES
+    phases          : Dictionary    : phase letter -> phase
+    start, stop     : Integer       : range of flat combination numbers
+    rules           : List          : rules to apply, RULES by default
+    prevalences     : List          : also give PREVALENCE_METRICS at these
+                                      prevalences (see evaluate_grid)
+
+    Output
+    output          : Pandas Dataframe : columns as in COLUMNS
+    '''
+
+    labels  = FAMILIES[family][2]
+    arrays  = [phase_arrays(phases[label], label) for label in labels]
+    shape   = tuple(len(sens) for sens, _, _, _, _ in arrays)
+    index   = decode_combinations(start, stop, shape)
+    cubes   = compile_rules([names for _, _, _, _, names in arrays], rules)
+    keep    = ~conflict_rows(cubes, index)
+    index   = [position[keep] for position in index]
+
+    tests   = [tuple(x[position] for x in test[:4])
+               for test, position in zip(arrays, index)]
+    values  = with_prevalences(lambda tests: apply_family(family, tests),
+                               prevalences)(tests)
+    columns = [np.broadcast_to(x, (len(index[0]),)) for x in values]
+
+    columns.append(position_names([test[4] for test in arrays], index, family))
+    names   = metric_columns(prevalences) + ['Algorithm']
+    return(pd.DataFrame({column : values for column, values in zip(names, columns)}))
+
+def iter_family(family, phases, chunk_size = 2 ** 16, rules = None, prevalences = None):
+    '''Evaluates a family in chunks of chunk_size combinations and yields each
+    chunk as a Dataframe, so only one chunk is in memory at a time. Chunks can
+    hold fewer rows where combinations are not viable, and chunks without any
+    viable combination are skipped.'''
+
+    total = int(np.prod(family_shape(family, phases)))
+    for start in range(0, total, chunk_size):
+        chunk = evaluate_shard(family, phases, start, start + chunk_size, rules,
+                               prevalences)
+        if len(chunk):
+            yield(chunk)
+
+def iter_families(phases, families = None, chunk_size = 2 ** 16, rules = None,
+                  prevalences = None):
+    '''Chains iter_family over families, every family by default'''
+
+    families = list(FAMILIES) if families is None else families
+    for family in families:
+        for chunk in iter_family(family, phases, chunk_size, rules, prevalences):
+            yield(chunk)
+
+def run_family(family, **phases):
+    '''Runs one family by name, e.g. run_family('NOXP', A=A, B=B, C=C, D=D)'''
+
+    return(evaluate_family(family, phases))
+
+def scenario_table(nodes_given_hat, nodes_given_no_hat):
+    '''Every combination of the lymph node parameters, one scenario per row
+
+    Inputs
+    nodes_given_hat     : List      : proportions of HAT patients with nodes
+    nodes_given_no_hat  : List      : proportions of non HAT patients with nodes
+
+    Output
+    scenarios       : Pandas Dataframe : scenario, nodes_given_hat and
+                                         nodes_given_no_hat columns
+    '''
+
+    hat, no_hat = np.meshgrid(np.asarray(nodes_given_hat, dtype = float),
+                              np.asarray(nodes_given_no_hat, dtype = float),
+                              indexing = 'ij')
+    return(pd.DataFrame({'scenario'             : np.arange(hat.size),
+                         'nodes_given_hat'      : hat.ravel(),
+                         'nodes_given_no_hat'   : no_hat.ravel()}))
+
+def run_scenarios(phases, nodes_given_hat, nodes_given_no_hat, families = None,
+                  rules = None):
+    '''Runs families for every lymph node scenario in one pass.
+
+    Each scenario is one value of A = [nodes_given_hat, 1 - nodes_given_no_hat].
+    All scenarios are stacked on the A axis of the grid, so the tests are
+    prepared once and the formulas are broadcast over the scenarios together
+    with the tests. G stays an axis of the algorithms as in the run_*
+    functions, and the G value of each row is also given in its own column.
+
+    Inputs
+    phases              : Dictionary : phase letter -> phase for B-G (any A
+                                       is replaced by the scenarios)
+    nodes_given_hat     : List      : proportions of HAT patients with nodes
+    nodes_given_no_hat  : List      : proportions of non HAT patients with nodes
+    families            : List      : family codes, every family by default
+    rules               : List      : rules to apply, RULES by default
+
+    Output
+    output          : Pandas Dataframe : the COLUMNS of every family for every
+                                         scenario, tagged with the scenario
+                                         columns and G, ordered by scenario
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    scenarios   = scenario_table(nodes_given_hat, nodes_given_no_hat)
+    A           = np.stack([scenarios['nodes_given_hat'],
+                            1 - scenarios['nodes_given_no_hat']], axis = 1)
+    phases      = dict(phases, A = A)
+
+    cache       = SubexpressionCache()
+    frames      = []
+    for family in families:
+        labels  = FAMILIES[family][2]
+        frame   = evaluate_family(family, phases, rules, cache)
+        index   = family_index(family, phases, rules)
+        frame   = pd.concat([scenarios.iloc[index[labels.index('A')]].reset_index(drop = True),
+                             frame], axis = 1)
+        if 'G' in labels:
+            G = phase_arrays(phases['G'], 'G')[0]
+            frame['G'] = G[index[labels.index('G')]]
+        else:
+            frame['G'] = np.nan
+        frames.append(frame)
+    output = pd.concat(frames, ignore_index = True)
+    return(output.sort_values('scenario', kind = 'stable', ignore_index = True))
+
+def run_no_extra_paths(A, B, C, D):
+    ''' This runs the no_extra_paths algorithm for all possibile combinations
     of tests
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    return(run_family('NOXP', A = A, B = B, C = C, D = D))
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(F), il(G)))
+def run_extra_path_1(A, B, C, D):
+    ''' This runs the extra_path_1 algorithm for all possibile combinations
+    of tests
+    '''
 
-    for i in combinations:
-        if not rdtcattconflict(i):
-            Bi,Bstr = prep(B, i[1])
-            Ci,Cstr = prep(C, i[2])
-            Di,Dstr = prep(D, i[3])
-            Fi,Fstr = prep(F, i[4])
-            Gi      = [G[i[5]],1-G[i[5]]]
-            values  = list(extra_path_1and3(A[i[0]], Bi, Ci, Di, Fi, Gi))
-            name    = Bstr +' '+ Cstr + ' ' + Dstr + ' '+Fstr+' ' +str(G[i[5]])+' XP13'
-            cost = list(extra_path_1and3_cost(A[i[0]], prep(B, i[1], True), prep(C, i[2], True), prep(D, i[3],True),prep(F,i[5],True),Gi))
+    return(run_family('XP1', A = A, B = B, C = C, D = D))
 
-            values += cost
-            values.append(name)
-            temp    = pd.DataFrame([values])
-            temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-            output  = output.append(temp)
-    output.drop_duplicates()
+def run_extra_path_2(A, B, C, D, E):
+    ''' This runs the extra_path_2 algorithm for all possibile combinations
+    of tests
+    '''
 
-    return(output)
+    return(run_family('XP2', A = A, B = B, C = C, D = D, E = E))
 
-def run_allpaths(A, B, C, D, E, F, G):
-    ''' This runs the all_paths algorithm for all possibile combinations
+def run_extra_path_3(A, B, C, D, F, G):
+    ''' This runs the extra_path_3 algorithm for all possibile combinations
+    of tests
+    '''
+
+    return(run_family('XP3', A = A, B = B, C = C, D = D, F = F, G = G))
+
+def run_extra_path_2and3(A, B, C, D, E, F, G):
+    ''' This runs the extra_path_2and3 algorithm for all possibile combinations
+    of tests
+    '''
+
+    return(run_family('XP23', A = A, B = B, C = C, D = D, E = E, F = F, G = G))
+
+def run_extra_path_1and2(A, B, C, D, E):
+    ''' This runs the extra_path_1and2 algorithm for all possibile combinations
     of tests
     '''
 
-    output = pd.DataFrame(columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm'])  ## An empty placeholder
+    return(run_family('XP12', A = A, B = B, C = C, D = D, E = E))
 
-    ## Combinations holds all iterations of viable combinations (algorithms)
-    combinations = list(it.product(il(A), il(B), il(C), il(D), il(E), il(F), il(G)))
+def run_extra_path_1and3(A, B, C, D, F, G):
+    ''' This runs the extra_path_1and3 algorithm for all possibile combinations
+    of tests
+    '''
 
-    for i in combinations:
-        if not rdtcattconflict(i):
-            Bi,Bstr = prep(B, i[1])
-            Ci,Cstr = prep(C, i[2])
-            Di,Dstr = prep(D, i[3])
-            Ei,Estr = prep(E, i[4])
-            Fi,Fstr = prep(F, i[5])
-            Gi      = [G[i[6]],1-G[i[6]]]
-            values  = list(all_paths(A[i[0]], Bi, Ci, Di, Ei, Fi, Gi))
-            name    = Bstr +' '+ Cstr + ' ' + Dstr + ' '+ Estr + ' '+Fstr+' ' +str(G[i[6]])+' XP123'
-            cost = list(all_extra_paths_cost(A[i[0]], 
-                            prep(B, i[1], True), 
-                            prep(C, i[2], True), 
-                            prep(D, i[3],True),
-                            prep(E,i[4],True),
-                            prep(F,i[5],True),
-                            Gi))
+    return(run_family('XP13', A = A, B = B, C = C, D = D, F = F, G = G))
 
-            values += cost
-            values.append(name)
-            temp    = pd.DataFrame([values])
-            temp.columns  = ['sens', 'spec', 'cost-0','cost-1', 'Algorithm']
-            output  = output.append(temp)
-    output.drop_duplicates()
+def run_allpaths(A, B, C, D, E, F, G):
+    ''' This runs the all_paths algorithm for all possibile combinations
+    of tests
+    '''
 
-    return(output)
+    return(run_family('XP123', A = A, B = B, C = C, D = D, E = E, F = F, G = G))
 
 
 ###############################################################################
@@ -854,9 +1746,7 @@ def run_allpaths(A, B, C, D, E, F, G):
 if __name__ == '__main__':
     #######
     ## Import the data
-    data=pd.read_csv('algorithmcsv.csv')
-    data.iloc[:,1:7]=data.iloc[:,1:7]/100
-    data
+    catalog = TestCatalog.from_csv('algorithmcsv.csv')
     ##Worst Case scenario WCNGH=WorstCaseNodesGivenHat
     WCNGH   = 0.5
     WCNGNH  = 0.1
@@ -866,11 +1756,11 @@ if __name__ == '__main__':
     ## Create a subset of the data for membership in phases.
     ## Phasem1 is Phase -1 in the literature
     A   = [[OCNGH,1-OCNGNH]]
-    B   = data.loc[data['type'] == 1]
-    C   = data.loc[data['type'] == 0]
-    D   = data.loc[data['type'] == 2]
-    E   = data.loc[data['type'] == 3]
-    F   = data.loc[data['type'] == 4]
+    B   = catalog.phase(PHASE_TYPES['B'])
+    C   = catalog.phase(PHASE_TYPES['C'])
+    D   = catalog.phase(PHASE_TYPES['D'])
+    E   = catalog.phase(PHASE_TYPES['E'])
+    F   = catalog.phase(PHASE_TYPES['F'])
     G   = [0.1 ,0.25]
     ########
 
@@ -883,3 +1773,7 @@ if __name__ == '__main__':
     run_extra_path_1and2(A,B,C,D,E)
     run_extra_path_1and3(A,B,C,D,F,G)
     run_allpaths(A,B,C,D,E,F,G)
+
+    ## Both the worst case and the optimistic scenario in one pass
+    scenarios = run_scenarios(dict(B = B, C = C, D = D, E = E, F = F, G = G),
+                              [WCNGH, OCNGH], [WCNGNH])
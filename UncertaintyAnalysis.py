@@ -0,0 +1,358 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from SensSpecCostCalculator import (FAMILIES, phase_arrays, apply_family,
+                                    family_index, family_names, position_names,
+                                    axis_view, compile_rules, conflict_mask, as_phase)
+from ParetoFront import OBJECTIVES, skyline
+
+
+#### This code propagates the uncertainty in the sensitivity and specificity
+#### of each test (the _lower and _upper columns of algorithmcsv.csv) through
+#### every algorithm. Each test gets a number of random draws, and every
+#### algorithm is evaluated under every draw in vectorised blocks whose size
+#### is chosen so that the working memory stays under a cap.
+
+## Interval bounds (Code Section Three) are the cheap deterministic companion
+## of the sampling: they give the exact worst and best case of every metric
+## when each test may take any value inside its [lower, upper] bounds.
+
+## The same draw of a test is used by every algorithm that contains it, so the
+## algorithms of one draw can be compared with each other (for the Pareto
+## probability). A and G are scenario parameters and are not sampled, nor are
+## the costs and the waits.
+
+METRICS = ['sens', 'spec', 'cost-0', 'cost-1', 'time-0', 'time-1']
+
+## Rough number of float64 arrays alive per evaluated value while a family is
+## evaluated (gathered inputs, temporaries of the formulas and the outputs).
+## Used to turn the memory cap into block sizes.
+WORKING_ARRAYS = 16
+
+###############################################################################
+############## Code Section One - Sampling ####################################
+###############################################################################
+
+def fit_beta(mean, lower, upper, coverage = 0.95):
+    '''Fits Beta distributions by matching the mean and treating [lower, upper]
+    as a normal-approximation interval of the given coverage
+
+    Inputs
+    mean, lower, upper : Numpy array : probabilities of each test
+    coverage        : Float         : coverage of the [lower, upper] interval
+
+    Output
+    alpha, beta     : Numpy array   : parameters of the Beta distributions
+    fixed           : Numpy array   : True where the value has no spread, in
+                                      which case the mean is used as is
+    '''
+
+    z       = NormalDist().inv_cdf(0.5 + coverage / 2)
+    var     = ((upper - lower) / (2 * z)) ** 2
+    limit   = mean * (1 - mean)
+    ## A Beta distribution cannot have a variance of mean * (1 - mean) or more
+    var     = np.minimum(var, 0.99 * limit)
+    fixed   = (var <= 0) | (limit <= 0)
+    kappa   = np.where(fixed, 2, limit / np.where(fixed, 1, var) - 1)
+    alpha   = np.where(fixed, 1, mean * kappa)
+    beta    = np.where(fixed, 1, (1 - mean) * kappa)
+    return(alpha, beta, fixed)
+
+def sample_values(mean, lower, upper, draws, rng, distribution = 'beta'):
+    '''Draws random values for a set of tests
+
+    Inputs
+    mean, lower, upper : Numpy array : probabilities of each test
+    draws           : Integer       : number of draws per test
+    rng             : Generator     : numpy random generator
+    distribution    : String        : 'beta' or 'triangular'. The triangular
+                                      distribution has its mode at the mean.
+
+    Output
+    values          : Numpy array   : shape (draws, tests)
+    '''
+
+    size = (draws, len(mean))
+    if distribution == 'beta':
+        alpha, beta, fixed = fit_beta(mean, lower, upper)
+        values = rng.beta(alpha, beta, size)
+    elif distribution == 'triangular':
+        fixed   = upper <= lower
+        mode    = np.clip(mean, lower, upper)
+        values  = rng.triangular(lower, mode, np.where(fixed, lower + 1, upper), size)
+    else:
+        raise ValueError('unknown distribution %r' % distribution)
+    return(np.where(fixed, mean, values))
+
+def sample_phases(phases, draws, rng, distribution = 'beta'):
+    '''Draws the sensitivity and specificity of every test in the phases
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family. A and G are not sampled.
+
+    Output
+    samples         : Dictionary    : phase letter -> (sens, spec, cost, wait)
+                                      where sens and spec have shape (draws,
+                                      tests)
+    '''
+
+    samples = {}
+    for label, phase in phases.items():
+        sens, spec, cost, wait, _ = phase_arrays(phase, label)
+        if label in 'AG':
+            samples[label] = (sens, spec, cost, wait)
+            continue
+        phase = as_phase(phase)
+        samples[label] = (sample_values(phase.sens, phase.sens_lower, phase.sens_upper,
+                                        draws, rng, distribution),
+                          sample_values(phase.spec, phase.spec_lower, phase.spec_upper,
+                                        draws, rng, distribution),
+                          cost, wait)
+    return(samples)
+
+###############################################################################
+############## Code Section Two - Evaluation ##################################
+###############################################################################
+
+def evaluate_rows(family, samples, index, draws = slice(None)):
+    '''Evaluates some algorithms of a family under some of the draws
+
+    Inputs
+    family          : String        : key of FAMILIES
+    samples         : Dictionary    : output of sample_phases
+    index           : Tuple         : grid position of each algorithm, one
+                                      integer array per phase of the family
+    draws           : Slice         : the draws to use
+
+    Output
+    values          : List          : sens, spec, cost-0, cost-1, time-0 and
+                                      time-1 arrays of shape (draws,
+                                      algorithms)
+    '''
+
+    tests = []
+    for label, position in zip(FAMILIES[family][2], index):
+        sens, spec, cost, wait = samples[label]
+        if sens.ndim == 2:
+            sens, spec = sens[draws][:, position], spec[draws][:, position]
+        else:
+            sens, spec = sens[position], spec[position]
+        tests.append((sens, spec, cost[position], wait[position]))
+    values  = apply_family(family, tests)
+    shape   = np.broadcast_shapes(*[np.shape(x) for x in values])
+    return([np.broadcast_to(x, shape) for x in values])
+
+def run_uncertainty(phases, draws = 1000, families = None, distribution = 'beta',
+                    quantiles = (0.025, 0.5, 0.975), pareto = True,
+                    memory = 2 ** 28, seed = None, rules = None):
+    '''Monte Carlo uncertainty analysis of every algorithm
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family. B-F must be Phases of
+                                      a TestCatalog (or catalog Dataframes)
+                                      so the bounds are known.
+    draws           : Integer       : number of draws per test
+    families        : List          : family codes, every family by default
+    distribution    : String        : 'beta' or 'triangular'
+    quantiles       : Tuple         : quantiles reported for each metric
+    pareto          : Boolean       : also report how often each algorithm is
+                                      on the Pareto front of its draw
+    memory          : Integer       : rough cap on the working memory in bytes
+    seed            : Integer       : seed of the random generator
+    rules           : List          : rules to apply, RULES by default
+
+    Output
+    output          : Pandas Dataframe : one row per algorithm with the mean
+                                         and quantiles of each metric and the
+                                         pareto_probability
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    rng         = np.random.default_rng(seed)
+    samples     = sample_phases(phases, draws, rng, distribution)
+    index       = {family : family_index(family, phases, rules) for family in families}
+
+    ## Pass one: blocks of algorithms under all draws, for the statistics
+    rows        = max(1, memory // (8 * WORKING_ARRAYS * draws))
+    frames      = []
+    for family in families:
+        names   = family_names(family, phases, index = index[family])
+        stats   = {'Algorithm' : names}
+        for metric in METRICS:
+            stats[metric + '_mean'] = np.empty(len(names))
+            for q in quantiles:
+                stats['%s_q%g' % (metric, q)] = np.empty(len(names))
+        for start in range(0, len(names), rows):
+            block   = [position[start:start + rows] for position in index[family]]
+            values  = evaluate_rows(family, samples, block)
+            stop    = start + len(block[0])
+            for metric, value in zip(METRICS, values):
+                stats[metric + '_mean'][start:stop] = value.mean(axis = 0)
+                for q, quantile in zip(quantiles, np.quantile(value, quantiles, axis = 0)):
+                    stats['%s_q%g' % (metric, q)][start:stop] = quantile
+        frames.append(pd.DataFrame(stats))
+    output = pd.concat(frames, ignore_index = True)
+
+    if pareto:
+        output['pareto_probability'] = pareto_probability(samples, index, draws,
+                                                          families, memory)
+    return(output)
+
+def pareto_probability(samples, index, draws, families, memory = 2 ** 28):
+    '''Share of the draws in which each algorithm is on the Pareto front of
+    all algorithms of the given families (objectives as in ParetoFront)
+
+    Output
+    probability     : Numpy array   : one entry per algorithm, in the order of
+                                      the families and of family_index
+    '''
+
+    total   = sum(len(index[family][0]) for family in families)
+    block   = max(1, memory // (8 * WORKING_ARRAYS * total))
+    sign    = np.array([1.0 if OBJECTIVES[metric] == 'max' else -1.0
+                        for metric in METRICS])
+    counts  = np.zeros(total)
+    for start in range(0, draws, block):
+        window  = slice(start, min(start + block, draws))
+        values  = [evaluate_rows(family, samples, index[family], window)
+                   for family in families]
+        ## (draws in window, algorithms, metrics), larger is better
+        stacked = np.concatenate([np.stack(v, axis = -1) for v in values], axis = 1) * sign
+        for draw in stacked:
+            counts[skyline(draw)] += 1
+    return(counts / draws)
+
+###############################################################################
+############## Code Section Three - Interval bounds ###########################
+###############################################################################
+
+## CAS and COS are increasing in every sensitivity and every specificity they
+## combine, so the sensitivity and specificity of an algorithm are lowest when
+## every test is at its lower bound and highest at the upper bounds. Two
+## evaluations give the exact bounds.
+##
+## The expected costs (and times) are not monotone (a more sensitive first test sends
+## more patients on to the next one), but they are multilinear: each term is
+## a product of distinct probabilities. A multilinear function reaches its
+## extremes at the corners of the box, so the exact cost bounds are found by
+## evaluating the 2 ** phases corners (at most 32 for XP23 and XP123) and
+## keeping a running minimum and maximum.
+
+def interval_grid(evaluate, labels, phases, costs = True):
+    '''Exact bounds of sens, spec, both costs and both times over the grid
+
+    Inputs
+    evaluate        : Function      : takes (sens, spec, cost, wait) per phase
+                                      and returns sens, spec, cost-0, cost-1,
+                                      time-0, time-1
+    labels          : String/List   : the phases in the order evaluate takes
+    phases          : Dictionary    : phase letter -> phase. B-F must be
+                                      Phases of a TestCatalog (or catalog
+                                      Dataframes).
+    costs           : Boolean       : also bound the costs and times
+
+    Output
+    shape           : Tuple         : size of the grid
+    bounds          : Dictionary    : metric -> (lower, upper) arrays that
+                                      broadcast to shape
+    '''
+
+    ndim    = len(labels)
+    lower   = []
+    upper   = []
+    for axis, label in enumerate(labels):
+        sens, spec, cost, wait, _ = phase_arrays(phases[label], label)
+        if label in 'AG':
+            low, high = (sens, spec), (sens, spec)
+        else:
+            phase       = as_phase(phases[label])
+            low, high   = ((phase.sens_lower, phase.spec_lower),
+                           (phase.sens_upper, phase.spec_upper))
+        lower.append([axis_view(x, axis, ndim) for x in low + (cost, wait)])
+        upper.append([axis_view(x, axis, ndim) for x in high + (cost, wait)])
+    shape   = np.broadcast_shapes(*[x.shape for test in lower for x in test])
+
+    sens_low, spec_low      = evaluate(lower)[:2]
+    sens_high, spec_high    = evaluate(upper)[:2]
+    bounds  = {'sens' : (sens_low, sens_high), 'spec' : (spec_low, spec_high)}
+    if not costs:
+        return(shape, bounds)
+
+    uncertain   = [axis for axis, label in enumerate(labels) if label not in 'AG']
+    cost_bounds = None
+    for corner in range(2 ** len(uncertain)):
+        tests = list(lower)
+        for bit, axis in enumerate(uncertain):
+            if corner >> bit & 1:
+                tests[axis] = upper[axis]
+        values = evaluate(tests)[2:]
+        if cost_bounds is None:
+            cost_bounds = [[np.array(x, dtype = float), np.array(x, dtype = float)]
+                           for x in values]
+            continue
+        for (low, high), x in zip(cost_bounds, values):
+            np.minimum(low, x, out = low)
+            np.maximum(high, x, out = high)
+    for metric, (low, high) in zip(METRICS[2:], cost_bounds):
+        bounds[metric] = (low, high)
+    return(shape, bounds)
+
+def rule_cubes(labels, phases, rules = None):
+    '''Compiles the rules for the grid of the given phases'''
+
+    return(compile_rules([phase_arrays(phases[label], label)[4] for label in labels],
+                         rules))
+
+def interval_frame(names, shape, bounds, keep):
+    '''Flattens the output of interval_grid into a Dataframe'''
+
+    output = {'Algorithm' : names}
+    for metric, (low, high) in bounds.items():
+        output[metric + '_lower'] = np.broadcast_to(low, shape).ravel()[keep]
+        output[metric + '_upper'] = np.broadcast_to(high, shape).ravel()[keep]
+    return(pd.DataFrame(output))
+
+def run_intervals(phases, families = None, costs = True, rules = None):
+    '''Exact worst and best case of every algorithm when each test may take
+    any sensitivity and specificity inside its [lower, upper] bounds
+
+    Inputs
+    phases          : Dictionary    : phase letter -> phase, as for
+                                      evaluate_family. B-F must be Phases of
+                                      a TestCatalog (or catalog Dataframes)
+                                      so the bounds are known.
+    families        : List          : family codes, every family by default
+    costs           : Boolean       : also bound cost-0, cost-1, time-0 and
+                                      time-1
+    rules           : List          : rules to apply, RULES by default
+
+    Output
+    output          : Pandas Dataframe : Algorithm and the _lower and _upper
+                                         bound of each metric
+    '''
+
+    families    = list(FAMILIES) if families is None else families
+    frames      = []
+    for family in families:
+        labels  = FAMILIES[family][2]
+        shape, bounds = interval_grid(lambda tests: apply_family(family, tests),
+                                      labels, phases, costs)
+        keep    = ~conflict_mask(rule_cubes(labels, phases, rules), shape)
+        names   = family_names(family, phases,
+                               index = np.unravel_index(np.flatnonzero(keep), shape))
+        frames.append(interval_frame(names, shape, bounds, keep))
+    return(pd.concat(frames, ignore_index = True))
+
+def topology_intervals(topology, phases, costs = True, rules = None):
+    '''The same as run_intervals for an AlgorithmCompiler.Topology'''
+
+    shape, bounds = interval_grid(lambda tests: topology(*tests),
+                                  topology.tests, phases, costs)
+    keep    = ~conflict_mask(rule_cubes(topology.tests, phases, rules), shape)
+    names   = position_names([phase_arrays(phases[test], test)[4] for test in topology.tests],
+                             np.unravel_index(np.flatnonzero(keep), shape), topology.code)
+    return(interval_frame(names, shape, bounds, keep))
@@ -0,0 +1,38 @@
+import os
+
+import pandas as pd
+import pytest
+
+from SensSpecCostCalculator import PHASE_TYPES, TestCatalog
+
+
+#### Shared fixtures of the tests: the phases of algorithmcsv.csv, once as
+#### Phases of a TestCatalog and once as plain Dataframes with the
+#### probabilities as fractions, the way the run_* functions were first fed.
+
+CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'algorithmcsv.csv')
+
+## Worst case lymph node scenario and the G values of the testing area
+A = [[0.74, 0.1]]
+G = [0.1, 0.25]
+
+@pytest.fixture(scope = 'session')
+def catalog():
+    return(TestCatalog.from_csv(CATALOG))
+
+@pytest.fixture(scope = 'session')
+def phases(catalog):
+    output = {'A' : A, 'G' : G}
+    output.update({label : catalog.phase(type_) for label, type_ in PHASE_TYPES.items()})
+    return(output)
+
+@pytest.fixture(scope = 'session')
+def frames():
+    data = pd.read_csv(CATALOG)
+    data.iloc[:, 1:7] = data.iloc[:, 1:7] / 100
+    return({label : data.loc[data['type'] == type_].reset_index(drop = True)
+            for label, type_ in PHASE_TYPES.items()})
+
+@pytest.fixture(scope = 'session')
+def frame_phases(frames):
+    return(dict(frames, A = A, G = G))
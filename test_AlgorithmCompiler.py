@@ -0,0 +1,20 @@
+import numpy as np
+
+from SensSpecCostCalculator import COLUMNS, evaluate_family
+from AlgorithmCompiler import TOPOLOGIES, Topology, check_times
+
+
+#### The compiled topologies against the families they describe.
+
+def test_times_match_topologies(phases):
+    report = check_times(phases)
+    assert report['ok'].all(), report
+    assert (report['negative'] == 0).all()
+
+def test_compiled_sens_spec_match_families(phases):
+    for family in ['NOXP', 'XP2', 'XP3', 'XP23']:
+        expected = evaluate_family(family, phases)
+        compiled = Topology(TOPOLOGIES[family], family).evaluate(phases)
+        assert list(compiled['Algorithm']) == list(expected['Algorithm'])
+        np.testing.assert_allclose(compiled[COLUMNS[:2]].to_numpy(),
+                                   expected[COLUMNS[:2]].to_numpy(), rtol = 1e-12)
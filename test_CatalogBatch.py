@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from SensSpecCostCalculator import COLUMNS, evaluate_families
+from CatalogBatch import (load_catalogs, stack_catalogs, catalog_phases, evaluate_batch,
+                          catalog_fronts, compare_catalogs, pivot_metric)
+from conftest import CATALOG, G
+
+
+#### The stacked evaluation against each catalog evaluated on its own.
+
+## Two lymph node scenarios, whose algorithms share their names
+SCENARIOS = [[0.74, 0.1], [0.5, 0.2]]
+
+@pytest.fixture(scope = 'module')
+def catalogs():
+    rng     = np.random.default_rng(0)
+    data    = pd.read_csv(CATALOG)
+    sources = {}
+    for k in range(3):
+        region = data.copy()
+        region['Cost'] = region['Cost'] * rng.uniform(0.5, 2, len(region))
+        ## Tests in another order than the first catalog
+        sources['region%d' % k] = region.iloc[rng.permutation(len(region))] if k else region
+    return(load_catalogs(sources))
+
+def test_catalogs_match_single_runs(catalogs):
+    phases  = stack_catalogs(catalogs, SCENARIOS, G)
+    results = evaluate_batch(phases, list(catalogs), memory = 2 ** 16)
+    for i, name in enumerate(catalogs):
+        expected    = evaluate_families(catalog_phases(phases, i))
+        output      = results[results['catalog'] == name]
+        assert list(output['Algorithm']) == list(expected['Algorithm'])
+        np.testing.assert_array_equal(output['row'], np.arange(len(expected)))
+        np.testing.assert_allclose(output[COLUMNS[:-1]].to_numpy(),
+                                   expected[COLUMNS[:-1]].to_numpy(), rtol = 1e-12)
+
+def test_scenarios_are_kept_apart(catalogs):
+    phases      = stack_catalogs(catalogs, SCENARIOS, G)
+    results     = evaluate_batch(phases, list(catalogs))
+    fronts      = catalog_fronts(results)
+    comparison  = compare_catalogs(results, fronts)
+    count       = len(results) // len(catalogs)
+    assert results['Algorithm'].iloc[:count].duplicated().any()
+    assert len(comparison) == count
+    for name, front in fronts.items():
+        assert comparison[name].sum() == len(front)
+    cost = pivot_metric(results, 'cost-1')
+    assert cost.shape == (count, len(catalogs))
+    np.testing.assert_array_equal(cost['region1'].to_numpy(),
+                                  results.loc[results['catalog'] == 'region1', 'cost-1'])
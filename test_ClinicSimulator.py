@@ -0,0 +1,27 @@
+import numpy as np
+
+from CompactResults import evaluate_compact
+from ClinicSimulator import Clinic, candidate_tables, draw_days, simulate_batch, simulate_events
+
+
+#### The vectorised clinic day against the plain discrete event simulation
+#### (a heap of events and a queue per pool), candidate by candidate.
+
+def test_batch_matches_events(phases):
+    results = evaluate_compact(phases)
+    clinic  = Clinic({'nurse' : 2, 'microscope' : 1, 'lab' : 1},
+                     {'CATT*' : 'nurse', 'RDT*' : 'nurse', 'GP' : 'nurse', 'No_*' : None,
+                      'CTC' : 'microscope', '*ECT*' : 'microscope', 'QBC' : 'microscope',
+                      '*' : 'lab'},
+                     patients = 40, prevalence = 0.2)
+    tables  = candidate_tables(results.frame, phases, clinic)
+    rng     = np.random.default_rng(3)
+    rows    = np.arange(0, len(results), 5)
+    arrivals, diseased, draws = draw_days(clinic, len(rows), tables['sens'].shape[1], rng)
+    batch   = simulate_batch(tables, rows, arrivals, diseased, draws, clinic.servers,
+                             clinic.hours)
+    for i, candidate in enumerate(rows):
+        events = simulate_events(tables, candidate, arrivals[i], diseased[i], draws[i],
+                                 clinic.servers, clinic.hours)
+        for name, values in batch.items():
+            np.testing.assert_allclose(values[i], events[name], err_msg = name)
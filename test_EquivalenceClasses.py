@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SensSpecCostCalculator import (COLUMNS, PHASE_TYPES, TestCatalog, Requires,
+                                    evaluate_families)
+from EquivalenceClasses import evaluate_canonical, expand
+from conftest import CATALOG, A, G
+
+
+#### The classes must rebuild evaluate_families exactly, and finding them must
+#### cost less than evaluating every algorithm.
+
+def catalog_phases(data, A = A, G = G):
+    catalog = TestCatalog(data)
+    return(dict({label : catalog.phase(type_) for label, type_ in PHASE_TYPES.items()},
+                A = A, G = G))
+
+def copies(data, count):
+    '''The catalog with every test repeated count times under other names'''
+
+    return(pd.concat([data.assign(Values = data['Values'] + '_%d' % k) for k in range(count)],
+                     ignore_index = True))
+
+def check(phases, families = None, rules = None):
+    results, mapping    = evaluate_canonical(phases, families, rules)
+    expected            = evaluate_families(phases, families, rules)
+    output              = expand(results, mapping, phases)
+    assert list(output['Algorithm']) == list(expected['Algorithm'])
+    np.testing.assert_array_equal(output[COLUMNS[:-1]].to_numpy(),
+                                  expected[COLUMNS[:-1]].to_numpy())
+    assert (results['members'] > 0).all()
+    assert results['members'].sum() == len(expected)
+    return(results)
+
+@pytest.mark.parametrize('families', [None, ['XP2'], ['XP23', 'XP3'], ['XP123', 'XP13']])
+@pytest.mark.parametrize('rules', [None, [], [Requires('ELISA', 'CTC')]])
+def test_expand_rebuilds_families(phases, families, rules):
+    check(phases, families, rules)
+
+def test_absent_and_duplicate_tests():
+    data    = pd.read_csv(CATALOG)
+    extra   = data.loc[data['Values'].isin(['No_Dilution', 'GP'])].copy()
+    extra['Values'] = ['GP_copy', 'No_F']
+    extra.loc[extra['Values'] == 'No_F', 'type'] = PHASE_TYPES['F']
+    phases  = catalog_phases(pd.concat([data, extra], ignore_index = True),
+                             A = [[0.74, 0.1], [0.5, 0.3]], G = [0.1, 0.25, 0.1])
+    results = check(phases)
+    ## GP_copy is GP on every axis it sits on, so it never has a class of its own
+    assert not results['Algorithm'].str.contains('GP_copy').any()
+    assert len(results) < results['members'].sum()
+
+def test_faster_than_evaluating_everything():
+    phases = catalog_phases(copies(pd.read_csv(CATALOG), 4))
+
+    def best(function):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            function(phases)
+            times.append(time.perf_counter() - start)
+        return(min(times))
+
+    assert best(evaluate_canonical) < best(evaluate_families)
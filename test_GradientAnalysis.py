@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from SensSpecCostCalculator import FAMILIES, COLUMNS, evaluate_family, evaluate_families
+from GradientAnalysis import (parameters, family_gradients, run_gradients, tornado,
+                              sobol_family)
+
+
+#### The forward mode derivatives against central differences of the
+#### evaluated metrics.
+
+STEP = 1e-6
+
+def perturbed(phases, label, name, step):
+    '''The phases with one parameter of every test of a phase moved by step'''
+
+    output = dict(phases)
+    if label == 'A':
+        output['A'] = [[sens + step * (name == 'sens'), spec + step * (name == 'spec')]
+                       for sens, spec in phases['A']]
+    elif label == 'G':
+        output['G'] = [g + step for g in phases['G']]
+    else:
+        phase = phases[label].take(np.arange(len(phases[label])))
+        setattr(phase, name, getattr(phase, name) + step)
+        output[label] = phase
+    return(output)
+
+def test_values_match_evaluation(phases):
+    gradients   = run_gradients(phases)
+    expected    = evaluate_families(phases)
+    assert list(gradients['Algorithm']) == list(expected['Algorithm'])
+    np.testing.assert_allclose(gradients[COLUMNS[:-1]].to_numpy(),
+                               expected[COLUMNS[:-1]].to_numpy(), rtol = 1e-12)
+
+@pytest.mark.parametrize('family', list(FAMILIES))
+def test_matches_central_differences(family, phases):
+    gradients = family_gradients(family, phases)
+    for label, name in parameters(FAMILIES[family][2]):
+        up      = evaluate_family(family, perturbed(phases, label, name, STEP))
+        down    = evaluate_family(family, perturbed(phases, label, name, -STEP))
+        for metric in COLUMNS[:-1]:
+            difference = (up[metric].to_numpy() - down[metric].to_numpy()) / (2 * STEP)
+            np.testing.assert_allclose(gradients['%s/%s.%s' % (metric, label, name)],
+                                       difference, rtol = 1e-6, atol = 1e-6)
+
+def test_blocks_match_single_pass(phases):
+    pd.testing.assert_frame_equal(family_gradients('XP123', phases, memory = 2 ** 14),
+                                  family_gradients('XP123', phases))
+
+def test_dataframe_phases(phases, frame_phases):
+    gradients = family_gradients('XP2', frame_phases)
+    pd.testing.assert_frame_equal(gradients, family_gradients('XP2', phases))
+    pd.testing.assert_frame_equal(tornado(gradients, 5, 'sens', frame_phases),
+                                  tornado(gradients, 5, 'sens', phases))
+    pd.testing.assert_frame_equal(
+        sobol_family('NOXP', frame_phases, draws = 64, rng = np.random.default_rng(0)),
+        sobol_family('NOXP', phases, draws = 64, rng = np.random.default_rng(0)))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from SensSpecCostCalculator import Requires, evaluate_families
+from ParetoFront import OBJECTIVES
+from Optimizer import BranchAndBound, brute_force
+
+
+#### The branch and bound search must give exactly the answer of brute force,
+#### ties included, whatever the leaf size and the rules.
+
+CASES = [('sens', None),
+         ('sens', {'spec' : (0.999, None), 'cost-1' : (None, 2.0)}),
+         ('cost-1', {'sens' : (0.8, None)}),
+         ('spec', {'cost-0' : (None, 1.5)}),
+         ('cost-0', {'sens' : (0.9, None), 'spec' : (0.99, None)}),
+         ('time-1', {'sens' : (0.85, None)}),
+         ('sens', {'spec' : (2, None)})]
+
+def random_cases(phases, count, seed = 0):
+    '''Random constraints at quantiles of the metrics'''
+
+    rng     = np.random.default_rng(seed)
+    output  = evaluate_families(phases)
+    cases   = []
+    for _ in range(count):
+        constraints = {}
+        for metric, sense in OBJECTIVES.items():
+            if rng.random() < 0.5:
+                bound = np.quantile(output[metric], rng.random())
+                constraints[metric] = (bound, None) if sense == 'max' else (None, bound)
+        cases.append((str(rng.choice(list(OBJECTIVES))), constraints))
+    return(cases)
+
+@pytest.mark.parametrize('leaf_size', [1, 64, 4096])
+@pytest.mark.parametrize('rules', [None, [Requires('ELISA', 'CTC')]])
+def test_matches_brute_force(phases, leaf_size, rules):
+    for objective, constraints in CASES + random_cases(phases, 10):
+        found = BranchAndBound(phases, objective, constraints, rules = rules,
+                               leaf_size = leaf_size).solve()
+        assert found.equals(brute_force(phases, objective, constraints, rules = rules))
+
+def test_prunes_combinations(phases):
+    search = BranchAndBound(phases, 'sens', {'spec' : (0.999, None), 'cost-1' : (None, 2.0)},
+                            leaf_size = 1)
+    search.solve()
+    assert search.evaluated < len(evaluate_families(phases))
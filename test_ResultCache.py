@@ -0,0 +1,30 @@
+import inspect
+
+import pandas as pd
+
+from SensSpecCostCalculator import FAMILY_TREES, evaluate_families, tree_times
+from ResultCache import ResultCache, result_key, topology_source, cached_families
+
+
+#### Entries must reload what was stored and must not survive a change of
+#### anything the result depends on.
+
+def test_reload_matches_evaluation(phases, tmp_path):
+    expected = evaluate_families(phases)
+    for _ in range(2):
+        output = cached_families(phases, str(tmp_path))
+        pd.testing.assert_frame_equal(output, expected, check_dtype = False)
+    cache = ResultCache(str(tmp_path))
+    cache.evaluate('XP23', phases)
+    assert cache.hits == 1 and cache.misses == 0
+
+def test_key_follows_inputs(phases, monkeypatch):
+    key     = result_key('XP3', phases)
+    assert result_key('XP3', dict(phases, G = [0.1, 0.5])) != key
+    assert result_key('XP3', phases, rules = []) != key
+    ## The times come from the tree of the family
+    monkeypatch.setitem(FAMILY_TREES, 'XP3', ('and', 'A', ('or', 'D', ('and', 'B', 'C'))))
+    assert result_key('XP3', phases) != key
+
+def test_source_holds_tree_times():
+    assert inspect.getsource(tree_times) in topology_source('NOXP')
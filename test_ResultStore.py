@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from SensSpecCostCalculator import evaluate_families, prevalence_column
+from ResultStore import METRICS, ResultStore
+
+
+#### Range and nearest neighbour queries against scans of the whole table.
+
+PPV = prevalence_column('ppv', 0.01)
+
+@pytest.fixture(scope = 'module')
+def results(phases):
+    ## Some rows without a ppv, as when its denominator is zero
+    output = evaluate_families(phases, prevalences = [0.01])
+    output.loc[::7, PPV] = np.nan
+    return(output)
+
+def scan(frame, bounds):
+    keep = np.ones(len(frame), dtype = bool)
+    for column, (lower, upper) in bounds.items():
+        values = frame[column].to_numpy(dtype = float)
+        if lower is not None:
+            keep &= values >= lower
+        if upper is not None:
+            keep &= values <= upper
+    return(np.flatnonzero(keep))
+
+def test_matches_scan(results):
+    store   = ResultStore(results, METRICS + [PPV])
+    rng     = np.random.default_rng(0)
+    for _ in range(50):
+        bounds = {}
+        for column in store.columns:
+            if rng.random() < 0.4:
+                lower, upper = np.sort(np.quantile(results[column].dropna(), rng.random(2)))
+                bounds[column] = [(lower, None), (None, upper), (lower, upper)][rng.integers(3)]
+        np.testing.assert_array_equal(store.matches(bounds), scan(results, bounds))
+    assert store.count({PPV : (None, None)}) == results[PPV].notna().sum()
+    assert store.count({PPV : (0.5, None)}) == len(scan(results, {PPV : (0.5, None)}))
+
+def test_nearest_is_closest(results):
+    store   = ResultStore(results)
+    point   = {'sens' : 0.95, 'spec' : 0.99, 'cost-0' : 1, 'cost-1' : 2,
+               'time-0' : 40, 'time-1' : 60}
+    found   = store.nearest(point, k = 5)
+    scaled  = store.points() - np.array([point[c] / store.scale[c] for c in store.columns])
+    expected = np.sort(np.sqrt((scaled ** 2).sum(axis = 1)))[:5]
+    np.testing.assert_allclose(found['distance'].to_numpy(), expected)
@@ -0,0 +1,73 @@
+import fnmatch
+import itertools as it
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SensSpecCostCalculator import (FAMILIES, COLUMNS, prep, evaluate_family,
+                                    evaluate_families, evaluate_shard, family_shape,
+                                    iter_family, run_extra_path_2and3)
+
+
+#### The broadcast engine against the loops it replaced: every combination of
+#### tests run through the formulas one at a time with prep, skipping the RDT
+#### with a CATT dilution (rdtcattconflict).
+
+def reference_family(family, frames, A, G):
+    '''The rows of a family as the original run_* loops built them'''
+
+    formula, cost_formula, labels = FAMILIES[family]
+    sizes   = [len(A) if label == 'A' else len(G) if label == 'G' else len(frames[label])
+               for label in labels]
+    rows    = []
+    for combination in it.product(*[range(n) for n in sizes]):
+        args, cost_args, names = [], [], []
+        for label, i in zip(labels, combination):
+            if label == 'A':
+                args.append(A[i])
+                cost_args.append(A[i])
+            elif label == 'G':
+                args.append([G[i], 1 - G[i]])
+                cost_args.append([G[i], 1 - G[i]])
+                names.append(str(G[i]))
+            else:
+                values, name, cost = prep(frames[label], i, True)
+                args.append(values)
+                cost_args.append((values, name, cost))
+                names.append(name)
+        if 'RDT1_SD' in names and fnmatch.filter(names, 'CATT_*_Dilution'):
+            continue
+        rows.append(list(formula(*args)) + list(cost_formula(*cost_args))
+                    + [' '.join(names + [family])])
+    return(pd.DataFrame(rows, columns = COLUMNS[:4] + ['Algorithm']))
+
+@pytest.mark.parametrize('family', list(FAMILIES))
+def test_family_matches_loops(family, frames, frame_phases):
+    expected    = reference_family(family, frames, frame_phases['A'], frame_phases['G'])
+    output      = evaluate_family(family, frame_phases)
+    assert list(output.columns) == COLUMNS
+    assert list(output['Algorithm']) == list(expected['Algorithm'])
+    np.testing.assert_allclose(output[COLUMNS[:4]].to_numpy(float),
+                               expected[COLUMNS[:4]].to_numpy(float), rtol = 1e-12)
+
+def test_catalog_and_dataframe_phases_agree(phases, frame_phases):
+    pd.testing.assert_frame_equal(evaluate_families(phases), evaluate_families(frame_phases))
+
+def test_run_functions_match_engine(frame_phases):
+    output = run_extra_path_2and3(**{label : frame_phases[label] for label in 'ABCDEFG'})
+    pd.testing.assert_frame_equal(output, evaluate_family('XP23', frame_phases))
+
+def test_times_are_not_negative(phases):
+    output = evaluate_families(phases)
+    assert (output[['time-0', 'time-1']].to_numpy() >= 0).all()
+
+@pytest.mark.parametrize('family', ['NOXP', 'XP23', 'XP123'])
+def test_shards_and_chunks_rebuild_family(family, phases):
+    expected    = evaluate_family(family, phases)
+    total       = int(np.prod(family_shape(family, phases)))
+    shards      = pd.concat([evaluate_shard(family, phases, start, start + 17)
+                             for start in range(0, total, 17)], ignore_index = True)
+    chunks      = pd.concat(iter_family(family, phases, chunk_size = 29), ignore_index = True)
+    pd.testing.assert_frame_equal(shards, expected, check_dtype = False)
+    pd.testing.assert_frame_equal(chunks, expected, check_dtype = False)
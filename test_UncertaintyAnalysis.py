@@ -0,0 +1,26 @@
+import pandas as pd
+
+from SensSpecCostCalculator import evaluate_families
+from UncertaintyAnalysis import run_uncertainty, run_intervals
+
+
+#### The sampled and the interval analysis against the plain evaluation.
+
+def test_intervals_hold_samples(phases):
+    ## Triangular draws stay inside [lower, upper], Beta draws need not
+    intervals   = run_intervals(phases)
+    samples     = run_uncertainty(phases, draws = 200, distribution = 'triangular',
+                                  seed = 0, pareto = False)
+    expected    = evaluate_families(phases)
+    assert list(intervals['Algorithm']) == list(expected['Algorithm'])
+    assert list(samples['Algorithm']) == list(expected['Algorithm'])
+    for metric in ['sens', 'spec']:
+        lower = intervals[metric + '_lower'].to_numpy() - 1e-12
+        upper = intervals[metric + '_upper'].to_numpy() + 1e-12
+        for column in (metric + '_q0.025', metric + '_q0.975'):
+            assert ((lower <= samples[column]) & (samples[column] <= upper)).all()
+
+def test_dataframe_phases(phases, frame_phases):
+    pd.testing.assert_frame_equal(run_intervals(frame_phases), run_intervals(phases))
+    pd.testing.assert_frame_equal(run_uncertainty(frame_phases, draws = 50, seed = 1),
+                                  run_uncertainty(phases, draws = 50, seed = 1))